@@ -0,0 +1,139 @@
+"""
+Benchmark of the thread budget of cgroup_utilities under a CPU quota.
+
+Runs the multi-threaded steps of the pipeline (SimpleITK resampling, the output
+compression of mha_utilities and a BLAS matrix product) with the threads of the budget
+(`available_cpus`, the CPUs of the quota) and with one thread per core of the host
+(what the libraries use by default), each in a fresh process, as the BLAS threads are
+fixed at import. Reported are the wall time and how long the cgroup was throttled.
+Run it in a container with a CPU quota, e.g. `docker run --cpus 2`:
+
+    python benchmark_threads.py [--scale 0.5] [--threads 2 64]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from cgroup_utilities import (
+    THREAD_POOL_ENVS,
+    available_cpus,
+    cgroup_cpu_quota,
+    cgroup_cpu_throttled_seconds,
+)
+
+
+def run_steps(*, threads, scale, repeats=3):
+    """
+    Times each step with `threads` threads, in this process.
+    returns:
+        dict - per step: best wall time and throttled time in seconds
+    """
+    import numpy as np
+    import SimpleITK as sitk
+    from mha_utilities import compress_zlib
+
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+    rng = np.random.default_rng(0)
+    shape = tuple(max(1, int(s * scale)) for s in (512, 512, 300))
+
+    image = sitk.GetImageFromArray(
+        rng.integers(-1000, 1000, shape[::-1], dtype=np.int16)
+    )
+    image.SetSpacing((0.45, 0.45, 0.7))
+    target_spacing = (0.6, 0.6, 0.6)
+    target_size = [
+        int(round(n * s / t))
+        for n, s, t in zip(image.GetSize(), image.GetSpacing(), target_spacing)
+    ]
+    label_map = np.zeros(shape, dtype=np.uint8, order="F")
+    centre = tuple(slice(n // 4, 3 * n // 4) for n in shape)
+    label_map[centre] = rng.integers(0, 14, label_map[centre].shape, dtype=np.uint8)
+    matrix = rng.random((int(2000 * scale), int(2000 * scale)))
+
+    steps = {
+        "sitk resample": lambda: sitk.Resample(
+            image,
+            target_size,
+            sitk.Transform(),
+            sitk.sitkLinear,
+            image.GetOrigin(),
+            target_spacing,
+            image.GetDirection(),
+            0,
+            sitk.sitkFloat32,
+        ),
+        "mha compression": lambda: compress_zlib(label_map, level=1, threads=threads),
+        "BLAS matmul": lambda: matrix @ matrix,
+    }
+    results = {}
+    for name, step in steps.items():
+        seconds = []
+        throttled = []
+        for _ in range(repeats):
+            before = cgroup_cpu_throttled_seconds()
+            start = time.perf_counter()
+            step()
+            seconds.append(time.perf_counter() - start)
+            if before is not None:
+                throttled.append(cgroup_cpu_throttled_seconds() - before)
+        results[name] = {
+            "seconds": min(seconds),
+            "throttled_seconds": min(throttled) if throttled else None,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        help="thread counts to compare (default: the budget and the host's cores)",
+    )
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run_steps(threads=args.child, scale=args.scale)))
+        return 0
+
+    quota = cgroup_cpu_quota()
+    print(
+        f"{os.cpu_count()} CPUs, cgroup quota "
+        f"{'none' if quota is None else f'{quota:g} CPUs'}, "
+        f"budget {available_cpus()} threads"
+    )
+    thread_counts = args.threads or sorted({available_cpus(), os.cpu_count() or 1})
+    for threads in thread_counts:
+        env = dict(os.environ, **{name: str(threads) for name in THREAD_POOL_ENVS})
+        output = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--child",
+                str(threads),
+                "--scale",
+                str(args.scale),
+            ],
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        for name, result in json.loads(output).items():
+            throttled = result["throttled_seconds"]
+            print(
+                f"threads={threads:<4} {name:<16} {result['seconds']:7.3f}s"
+                f"   throttled {'-' if throttled is None else f'{throttled:.3f}s'}"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
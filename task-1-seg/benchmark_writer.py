@@ -0,0 +1,117 @@
+"""
+Benchmark of the .mha label map writers: write time versus file size across settings.
+
+Compares sitk.WriteImage(useCompression=True) with mha_utilities.write_label_map_mha
+at different compression levels, strategies and thread counts, and with the streaming
+mha_utilities.write_label_map_slabs, on a synthetic sparse CoW-like label map
+of clinical CTA size.
+
+    python benchmark_writer.py [--shape 512 512 300]
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import SimpleITK as sitk
+from inference import ImageInformation, array_to_image
+from mha_utilities import write_label_map_mha, write_label_map_slabs
+
+
+def synthetic_label_map(*, shape, seed=0):
+    """
+    Sparse label map in (x,y,z) with 13 tube-like classes, like a CoW segmentation.
+    """
+    rng = np.random.default_rng(seed)
+    label_map = np.zeros(shape, dtype=np.uint8)
+    centre = np.array(shape) // 2
+    upper = np.array(shape) - 4
+    for label in range(1, 14):
+        start = centre + rng.integers(-40, 40, size=3)
+        direction = rng.normal(size=3)
+        direction /= np.linalg.norm(direction)
+        for step in range(60):
+            x, y, z = np.clip(start + step * direction, 0, upper).astype(int)
+            label_map[x : x + 4, y : y + 4, z : z + 3] = label
+    return label_map
+
+
+def benchmark_writer(*, shape, repeats=3):
+    """
+    returns:
+        list of dict - per setting: best write time in seconds and file size in bytes
+    """
+    label_map = synthetic_label_map(shape=shape)
+    information = ImageInformation(
+        size=tuple(shape),
+        spacing=(0.45, 0.45, 0.7),
+        origin=(0.0, 0.0, 0.0),
+        direction=(1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0),
+        pixel_id=sitk.sitkUInt8,
+    )
+
+    def sitk_write(path):
+        image = array_to_image(label_map, dtype=np.uint8, information=information)
+        sitk.WriteImage(image, path, useCompression=True)
+
+    settings = {"sitk.WriteImage useCompression=True": sitk_write}
+    for level in (0, 1, 6, 9):
+        for rle in (False, True) if level else (False,):
+            for threads in (1, None) if level else (1,):
+                name = (
+                    f"write_label_map_mha level={level} rle={rle} "
+                    f"threads={threads or 'all'}"
+                )
+                settings[name] = (
+                    lambda path, level=level, rle=rle, threads=threads: write_label_map_mha(
+                        label_map,
+                        path,
+                        information=information,
+                        compression_level=level,
+                        rle=rle,
+                        threads=threads,
+                    )
+                )
+    # streamed in slabs of 16 slices, as e.g. sliding_window_slabs yields them
+    settings["write_label_map_slabs level=1 rle=True threads=all"] = (
+        lambda path: write_label_map_slabs(
+            (label_map[:, :, z : z + 16] for z in range(0, shape[2], 16)),
+            path,
+            information=information,
+            compression_level=1,
+        )
+    )
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "output.mha"
+        for name, write in settings.items():
+            seconds = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                write(path)
+                seconds.append(time.perf_counter() - start)
+            # every setting must give back the exact label map
+            written = sitk.GetArrayFromImage(sitk.ReadImage(str(path)))
+            assert np.array_equal(
+                written.transpose((2, 1, 0)), label_map
+            ), f"{name} wrote a different label map!"
+            results.append(
+                {"setting": name, "seconds": min(seconds), "bytes": path.stat().st_size}
+            )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shape", type=int, nargs=3, default=[512, 512, 300])
+    args = parser.parse_args()
+
+    print(f"Label map of shape {tuple(args.shape)}")
+    for result in benchmark_writer(shape=tuple(args.shape)):
+        print(
+            f"{result['setting']:<55} {result['seconds']:7.3f}s "
+            f"{result['bytes'] / 1024:10.0f} KB"
+        )
@@ -0,0 +1,230 @@
+"""
+Evaluation of task 1 label maps against the ground truth, e.g. ./test/expected_output.
+
+    python evaluate.py                     # ./test/output against ./test/expected_output
+    python evaluate.py --predictions <output_dir> --ground-truth <gt_dir> --json scores.json
+
+With folders of cases, e.g. the output of `python inference.py --batch`, the prediction in
+<output_dir>/<case>/images/cow-multiclass-segmentation is compared with the one label map
+in <gt_dir>/<case>.
+
+The Dice of every label comes from one confusion matrix per case, counted with
+np.bincount slab by slab in a single pass over both label maps.
+The label maps are loaded like the input images of inference.py, and the cases are
+evaluated in parallel processes (--workers, by default one per CPU of the container's
+quota, see cgroup_utilities).
+"""
+
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from cgroup_utilities import available_cpus
+from inference import load_image_file_as_array
+from label_map_utilities import MAX_LABEL, as_label_map
+
+# TopCoW labels of the CoW vessels
+LABELS = {
+    1: "BA",
+    2: "R-PCA",
+    3: "L-PCA",
+    4: "R-ICA",
+    5: "R-MCA",
+    6: "L-ICA",
+    7: "L-MCA",
+    8: "R-Pcom",
+    9: "L-Pcom",
+    10: "Acom",
+    11: "R-ACA",
+    12: "L-ACA",
+    15: "3rd-A2",
+}
+NUM_LABELS = MAX_LABEL + 1
+
+# Slices per slab, the memory of the temporaries is that of a few slabs
+CHUNK_SLICES = 16
+
+OUTPUT_FOLDER = Path("images/cow-multiclass-segmentation")
+
+
+def confusion_matrix(prediction, ground_truth, *, chunk_slices=CHUNK_SLICES):
+    """
+    Counts every pair of ground-truth and predicted label in a single pass.
+    args:
+        prediction: np.array - label map in (x,y,z)
+        ground_truth: np.array - label map in (x,y,z)
+    returns:
+        np.array - int64 of shape (NUM_LABELS, NUM_LABELS),
+            the number of voxels of [ground-truth label, predicted label]
+    """
+    assert tuple(prediction.shape) == tuple(
+        ground_truth.shape
+    ), "Prediction and ground truth must have the same shape!"
+    # checks the labels and gives uint8, without a copy for uint8 label maps
+    prediction = as_label_map(prediction, warn=False)
+    ground_truth = as_label_map(ground_truth, warn=False)
+
+    counts = np.zeros(NUM_LABELS * NUM_LABELS, dtype=np.int64)
+    for z in range(0, prediction.shape[2], chunk_slices):
+        # NOTE: uint16 pair indices, not intp, as they are below NUM_LABELS**2
+        pairs = ground_truth[:, :, z : z + chunk_slices].astype(np.uint16)
+        pairs *= NUM_LABELS
+        pairs += prediction[:, :, z : z + chunk_slices]
+        counts += np.bincount(pairs.ravel(order="K"), minlength=len(counts))
+    return counts.reshape(NUM_LABELS, NUM_LABELS)
+
+
+def dice_scores(matrix):
+    """
+    Dice of each label and of the whole CoW (all labels as one) from a confusion matrix.
+    returns:
+        dict - Dice by label name and "CoW", None if neither label map has the label
+    """
+    true_positives = np.diag(matrix)
+    ground_truth = matrix.sum(axis=1)
+    prediction = matrix.sum(axis=0)
+
+    def dice(overlap, total):
+        return float(2 * overlap / total) if total else None
+
+    scores = {
+        name: dice(true_positives[label], ground_truth[label] + prediction[label])
+        for label, name in LABELS.items()
+    }
+    scores["CoW"] = dice(
+        matrix[1:, 1:].sum(), ground_truth[1:].sum() + prediction[1:].sum()
+    )
+    return scores
+
+
+def evaluate_case(prediction_path, ground_truth_path):
+    """
+    args:
+        prediction_path: Path - folder with the predicted label map
+        ground_truth_path: Path - folder with the ground-truth label map
+    returns:
+        dict - see `dice_scores`
+    """
+    prediction = load_image_file_as_array(location=prediction_path)
+    ground_truth = load_image_file_as_array(location=ground_truth_path)
+    return dice_scores(confusion_matrix(prediction, ground_truth))
+
+
+def _label_map_file(folder):
+    files = sorted(folder.glob("*.mha")) + sorted(folder.glob("*.nii.gz"))
+    return files[0] if files else None
+
+
+def _has_label_map(folder):
+    return _label_map_file(folder) is not None
+
+
+def case_name(path):
+    """
+    returns:
+        str - the name of a label map file without its suffix, e.g.
+            "expected_output_dummy_mra" for expected_output_dummy_mra.mha
+    """
+    return path.name.removesuffix(".nii.gz").removesuffix(".mha")
+
+
+def find_cases(*, predictions_path, ground_truth_path):
+    """
+    Pairs the predictions with the ground truth, a single case if the ground-truth
+    folder holds a label map itself, named after that file, otherwise one case per
+    subfolder, named after the subfolder.
+    returns:
+        dict - (prediction folder, ground-truth folder) by case name,
+            the prediction folder is None if it is missing
+    """
+    if _has_label_map(ground_truth_path):
+        name = case_name(_label_map_file(ground_truth_path))
+        cases = {name: (predictions_path, ground_truth_path)}
+    else:
+        cases = {
+            p.name: (predictions_path / p.name, p)
+            for p in sorted(ground_truth_path.iterdir())
+            if p.is_dir() and _has_label_map(p)
+        }
+
+    def prediction_folder(case_path):
+        # the output folder of inference.py, or the folder itself
+        if (case_path / OUTPUT_FOLDER).is_dir():
+            case_path = case_path / OUTPUT_FOLDER
+        return case_path if case_path.is_dir() and _has_label_map(case_path) else None
+
+    return {
+        name: (prediction_folder(prediction_path), case_ground_truth)
+        for name, (prediction_path, case_ground_truth) in cases.items()
+    }
+
+
+def evaluate(*, predictions_path, ground_truth_path, workers=None):
+    """
+    returns:
+        dict - the scores of every case, their mean for each label
+            (over the cases that have it) and the cases without prediction
+    """
+    cases = find_cases(
+        predictions_path=predictions_path, ground_truth_path=ground_truth_path
+    )
+    missing = [name for name, (prediction, _) in cases.items() if prediction is None]
+    found = {name: paths for name, paths in cases.items() if paths[0] is not None}
+
+    workers = workers or available_cpus()
+    if workers == 1 or len(found) <= 1:
+        scores = [evaluate_case(*paths) for paths in found.values()]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            scores = list(executor.map(evaluate_case, *zip(*found.values())))
+    scores = dict(zip(found, scores))
+
+    mean = {}
+    for name in [*LABELS.values(), "CoW"]:
+        values = [s[name] for s in scores.values() if s[name] is not None]
+        mean[name] = float(np.mean(values)) if values else None
+    return {"cases": scores, "mean": mean, "missing": missing}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--predictions", type=Path, default=Path("./test/output"))
+    parser.add_argument(
+        "--ground-truth", type=Path, default=Path("./test/expected_output")
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=available_cpus(),
+        help="number of parallel processes (default: one per CPU of the cgroup quota)",
+    )
+    parser.add_argument("--json", type=Path, help="also write the scores as JSON")
+    args = parser.parse_args()
+
+    results = evaluate(
+        predictions_path=args.predictions,
+        ground_truth_path=args.ground_truth,
+        workers=args.workers,
+    )
+
+    for name, scores in results["cases"].items():
+        print(f"{name:24}{scores['CoW']:>8.4f}")
+    print(
+        f"Dice of {len(results['cases'])} case(s), mean over the cases with the label"
+    )
+    for name, value in results["mean"].items():
+        print(f"{name:8}{'-' if value is None else f'{value:.4f}':>8}")
+    if results["missing"]:
+        print(
+            f"[WARNING] No prediction for {len(results['missing'])} case(s): "
+            f"{', '.join(results['missing'])}"
+        )
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=4))
+    return 1 if results["missing"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
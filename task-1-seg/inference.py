@@ -31,77 +31,758 @@ To save the container and prep it for upload to Grand-Challenge.org you can call
   ./save.sh
 """
 
+import argparse
+import json
+import os
+import sys
+import time
+from collections.abc import Iterator
 from glob import glob
 from pathlib import Path
+from typing import NamedTuple
+
+from cgroup_utilities import configure_threads
+from profiling_utilities import (
+    profile_stage,
+    reset_profile,
+    start_import_timing,
+    write_profile,
+)
+
+# Size the thread pools of SimpleITK and BLAS/OpenMP (numpy, torch) to the CPU quota
+# of the container, before numpy is imported, see cgroup_utilities
+# NOTE: only when run as a script, importing inference.py changes nothing
+if __name__ == "__main__":
+    configure_threads()
+
+# Time the imports below if TOPCOW_PROFILE is set, as the start-up time
+# counts against the time limit too
+start_import_timing()
 
 import numpy as np
 import SimpleITK as sitk
-from your_algorithm import TRACK, your_segmentation_algorithm
+from label_map_utilities import as_label_map, as_label_map_slabs
+from memory_utilities import check_allocation, memory_budget_mb, report_peak_rss
+from mha_utilities import write_label_map_mha, write_label_map_slabs
+from your_algorithm import (
+    MODEL_VERSION,
+    TRACK,
+    TTA_BATCHED,
+    load_your_model,
+    your_segmentation_algorithm,
+    your_roi_algorithm,
+)
+from worker_utilities import DEFAULT_HOST, DEFAULT_PORT, serve
 
 # NOTE: uncomment the next line if you use pytorch
 # from torch_utilities import _show_torch_cuda_info
 
 
-def run():
+def run(*, input_path=None, output_path=None):
+    reset_profile()
+
     # Setting correct paths for input, output and resources
     # depending on whether the algorithm is run in a docker container or locally
-    if _is_docker():
-        input_path = Path("/input")
-        output_path = Path("/output")
+    with profile_stage("_is_docker"):
+        exec_in_docker = _is_docker()
+    if exec_in_docker:
+        default_input_path = Path("/input")
+        default_output_path = Path("/output")
     else:
-        input_path = Path("./test/input")
-        output_path = Path("./test/output")
+        default_input_path = Path("./test/input")
+        default_output_path = Path("./test/output")
+    # NOTE: other folders can be given with --input/--output, e.g. by worker_client.py
+    input_path = Path(input_path or default_input_path)
+    output_path = Path(output_path or default_output_path)
 
-    # Read the input
-    # Gives a npy array with shape (x,y,z)
-    input_head_mr_angiography = load_image_file_as_array(
-        location=input_path / "images/head-mr-angio",
-    )
-    input_head_ct_angiography = load_image_file_as_array(
-        location=input_path / "images/head-ct-angio",
-    )
+    run_case(input_path=input_path, output_path=output_path)
 
-    # Check whether torch CUDA is available
+    # Only written if TOPCOW_PROFILE is set, see profiling_utilities
+    write_profile(output_folder=output_path)
+    return 0
 
-    # NOTE: This relies on torch being installed in the environment
-    # _show_torch_cuda_info()
 
-    # Run your prediction algorithm
-    print("Running prediction algorithm...")
-    pred_array = your_segmentation_algorithm(
-        mr_input_array=input_head_mr_angiography,
-        ct_input_array=input_head_ct_angiography,
-    )
+def run_case(*, input_path, output_path):
+    """
+    Runs the inference for a single case.
+    args:
+        input_path: Path - folder with the input images inside /images
+        output_path: Path - folder to store the output predictions in
+    returns:
+        dict - wall time in seconds of the prediction and of saving the output
+    """
+    timings = {}
+
+    # Forget about the images of earlier cases
+    _image_information_cache.clear()
+    _clear_statistics_cache()
+
+    # Skip your algorithm if the result cache holds the prediction of these inputs,
+    # see result_cache_utilities
+    key = result_cache_key(input_path=input_path)
+    pred_array = None
+    if key is not None:
+        from result_cache_utilities import load_result
+
+        pred_array = load_result(key)
+    if pred_array is not None:
+        print("Found the prediction in the result cache, skipping your algorithm")
+        timings["prediction_seconds"] = 0.0
+    else:
+        # Read the input
+        # Gives lazy handles that behave like npy arrays with shape (x,y,z)
+        input_head_mr_angiography, input_head_ct_angiography = read_case(
+            input_path=input_path
+        )
+
+        # Check whether torch CUDA is available
+
+        # NOTE: This relies on torch being installed in the environment
+        # _show_torch_cuda_info()
+
+        # Run your prediction algorithm
+        # NOTE: if your algorithm yields the label map in slabs, they are only predicted
+        # while they are written, so the saving time includes the prediction
+        # (unless the result cache is on, which needs the whole label map)
+        print("Running prediction algorithm...")
+        start = time.perf_counter()
+        pred_array = predict_case(
+            input_head_mr_angiography=input_head_mr_angiography,
+            input_head_ct_angiography=input_head_ct_angiography,
+            stream=key is None,
+        )
+        timings["prediction_seconds"] = time.perf_counter() - start
+        if key is not None:
+            from result_cache_utilities import store_result
+
+            store_result(key, pred_array)
+        report_peak_rss(stage="prediction")
 
     # Save your output
     print("Saving output...")
+    start = time.perf_counter()
     write_array_as_image_file(
         array=pred_array, input_folder=input_path, output_folder=output_path
     )
+    timings["saving_seconds"] = time.perf_counter() - start
+    report_peak_rss(stage="saving output")
     print("Done!")
-    return 0
+    return timings
 
 
-def load_image_file(*, input_path):
-    # Use SimpleITK to read a file
-    input_file = (glob(str(input_path / "*.mha")) + glob(str(input_path / "*.nii.gz")))[
+def predict_case(*, input_head_mr_angiography, input_head_ct_angiography, stream=False):
+    """
+    Runs your algorithm on the inputs of a case.
+    Optionally the image of your TRACK is first preprocessed:
+        TOPCOW_ROI_CASCADE=1: cropped to the region of interest (ROI), see roi_utilities
+        TOPCOW_TARGET_SPACING: resampled to a fixed spacing, see resampling_utilities
+    With TOPCOW_TTA, your algorithm runs on flipped views of it, see tta_utilities.
+    With TOPCOW_POSTPROCESS=1, only the largest component of each label of the prediction
+    is kept, see postprocessing_utilities.
+    The prediction is mapped back to the input image:
+    resampled to its grid and pasted into a full-size zero label map.
+    If your algorithm yields the label map in slabs along z (e.g. sliding_window_slabs)
+    and `stream` is set, they are passed on as they are, to be written slab by slab.
+    Otherwise, and if the prediction must be postprocessed or mapped back,
+    they are put together first.
+    """
+    inputs = {"MR": input_head_mr_angiography, "CT": input_head_ct_angiography}
+    track_input = inputs[TRACK]
+    roi = None
+    grid = None
+
+    # NOTE: the module of each feature is only imported if it is turned on
+    roi_cascade = False
+    if _opted_in("TOPCOW_ROI_CASCADE"):
+        from roi_utilities import roi_cascade_enabled
+
+        roi_cascade = roi_cascade_enabled()
+    if roi_cascade:
+        from roi_utilities import crop_to_roi
+
+        with profile_stage("your_roi_algorithm"):
+            roi = your_roi_algorithm(
+                mr_input_array=input_head_mr_angiography,
+                ct_input_array=input_head_ct_angiography,
+            )
+        # NOTE: the crop is a view of the decoded image, the other modality is left as is
+        inputs[TRACK] = crop_to_roi(track_input, roi)
+        print(
+            f"ROI cascade: {roi['size']} voxels at {roi['location']}, "
+            f"{np.prod(track_input.shape) / np.prod(roi['size']):.1f}x fewer voxels"
+        )
+
+    target_spacing = None
+    if _opted_in("TOPCOW_TARGET_SPACING"):
+        from resampling_utilities import target_spacing_from_env
+
+        target_spacing = target_spacing_from_env()
+    if target_spacing is not None:
+        from resampling_utilities import resample_to_target, resampling_grid
+
+        with profile_stage("resampling"):
+            grid = resampling_grid(
+                size=inputs[TRACK].shape,
+                spacing=track_input.information.spacing,
+                target_spacing=target_spacing,
+            )
+            inputs[TRACK] = resample_to_target(inputs[TRACK], grid)
+        print(f"Resampled to {grid.target_size} voxels of {target_spacing} mm")
+
+    n_flips = 0
+    if _opted_in("TOPCOW_TTA"):
+        from tta_utilities import tta_flips_from_env
+
+        n_flips = tta_flips_from_env()
+    with profile_stage("your_segmentation_algorithm"):
+        if n_flips:
+            from tta_utilities import segmentation_tta, tta_batch_size
+
+            pred_array = segmentation_tta(
+                inputs[TRACK],
+                predict=lambda views: segment_views(views, inputs=inputs),
+                n_flips=n_flips,
+                batch_size=tta_batch_size(
+                    n_flips=n_flips, n_voxels=int(np.prod(inputs[TRACK].shape))
+                ),
+            )
+        else:
+            pred_array = your_segmentation_algorithm(
+                mr_input_array=inputs["MR"], ct_input_array=inputs["CT"]
+            )
+
+    postprocess = False
+    if _opted_in("TOPCOW_POSTPROCESS"):
+        from postprocessing_utilities import postprocessing_enabled
+
+        postprocess = postprocessing_enabled()
+    # Check the prediction right away and make it uint8, see label_map_utilities
+    if not isinstance(pred_array, Iterator):
+        pred_array = as_label_map(pred_array, shape=inputs[TRACK].shape)
+    else:
+        pred_array = as_label_map_slabs(pred_array, shape=inputs[TRACK].shape)
+        if not stream or grid is not None or roi is not None or postprocess:
+            pred_array = collect_slabs(pred_array, shape=inputs[TRACK].shape)
+
+    if postprocess:
+        from postprocessing_utilities import remove_small_components
+
+        with profile_stage("postprocessing"):
+            if not pred_array.flags.writeable:
+                pred_array = pred_array.copy(order="K")
+            removed = remove_small_components(pred_array)
+        print(
+            f"Postprocessing: removed {removed} voxels outside the largest component "
+            f"of their label"
+        )
+
+    if grid is not None:
+        from resampling_utilities import resample_to_input
+
+        with profile_stage("resampling"):
+            pred_array = resample_to_input(pred_array, grid)
+    if roi is not None:
+        from roi_utilities import paste_roi
+
+        # Paste the prediction for the ROI into a full-size label map
+        pred_array = paste_roi(pred_array, roi, shape=track_input.shape)
+    return pred_array
+
+
+def segment_views(views, *, inputs):
+    """
+    Runs your algorithm on flipped views of the image of your TRACK for TTA.
+    With TTA_BATCHED (see your_algorithm.py), it gets all views as a list in one call
+    and returns a list of label maps, otherwise it is called once per view.
+    NOTE: only the image of your TRACK is flipped, the other modality is passed as is.
+    returns:
+        list of np.array - uint8 label map of each view
+    """
+    if TTA_BATCHED:
+        view_inputs = {**inputs, TRACK: list(views)}
+        pred_arrays = your_segmentation_algorithm(
+            mr_input_array=view_inputs["MR"], ct_input_array=view_inputs["CT"]
+        )
+        assert len(pred_arrays) == len(
+            views
+        ), "With TTA_BATCHED, return one prediction per view!"
+    else:
+        pred_arrays = [
+            your_segmentation_algorithm(
+                mr_input_array=view_inputs["MR"], ct_input_array=view_inputs["CT"]
+            )
+            for view_inputs in ({**inputs, TRACK: view} for view in views)
+        ]
+    label_maps = []
+    for view, pred_array in zip(views, pred_arrays):
+        if isinstance(pred_array, Iterator):
+            pred_array = collect_slabs(
+                as_label_map_slabs(pred_array, shape=view.shape), shape=view.shape
+            )
+        label_maps.append(as_label_map(pred_array, shape=view.shape))
+    return label_maps
+
+
+def collect_slabs(slabs, *, shape):
+    """
+    Puts a label map that is given in slabs along z together.
+    args:
+        slabs: iterable of np.array - slabs in (x,y,z), in z order
+        shape: tuple - shape of the whole label map in (x,y,z)
+    returns:
+        np.array - uint8 label map of `shape`
+    """
+    label_map = np.empty(shape, dtype=np.uint8)
+    z = 0
+    for slab in slabs:
+        slab = np.asarray(slab)
+        if slab.ndim == 2:
+            slab = slab[:, :, None]
+        assert (
+            slab.shape[:2] == label_map.shape[:2] and z + slab.shape[2] <= shape[2]
+        ), "Prediction output must have the same shape as the input image!"
+        label_map[:, :, z : z + slab.shape[2]] = slab
+        z += slab.shape[2]
+    assert (
+        z == shape[2]
+    ), "Prediction output must have the same shape as the input image!"
+    return label_map
+
+
+def run_batch(*, cases_path, output_path, prefetch=1, write_behind=1):
+    """
+    Runs the inference for every case folder in `cases_path` in this one process,
+    so that imports and the model (see load_your_model) are only initialized once.
+    Each case folder is laid out like the input folder, i.e. <case>/images/head-mr-angio etc.
+    The outputs of each case are stored in `output_path`/<case>, next to
+    a batch-summary.json with the timings of every case.
+
+    While a case is predicted, the next `prefetch` cases are decoded and the outputs of
+    up to `write_behind` earlier cases are written in the background,
+    see pipeline_utilities.run_pipeline. Set both to 0 to run the cases one after another.
+    """
+    case_paths = sorted(
+        p for p in Path(cases_path).iterdir() if (p / "images").is_dir()
+    )
+    output_path = Path(output_path)
+    print(f"Found {len(case_paths)} cases in {cases_path}")
+
+    from pipeline_utilities import run_pipeline
+
+    # Forget about the images of earlier runs
+    _image_information_cache.clear()
+    _clear_statistics_cache()
+    reset_profile()
+
+    def read(case_path):
+        # NOTE: the key is hashed here, i.e. ahead of the prediction like the decoding
+        key = result_cache_key(input_path=case_path)
+        if key is not None:
+            from result_cache_utilities import load_result
+
+            cached = load_result(key)
+            if cached is not None:
+                return key, cached, None
+        return key, None, read_case(input_path=case_path, decode=True)
+
+    def predict(item):
+        key, cached, inputs = item
+        if cached is not None:
+            print("Found the prediction in the result cache, skipping your algorithm")
+            return cached
+        print("Running prediction algorithm...")
+        input_head_mr_angiography, input_head_ct_angiography = inputs
+        pred_array = predict_case(
+            input_head_mr_angiography=input_head_mr_angiography,
+            input_head_ct_angiography=input_head_ct_angiography,
+        )
+        if key is not None:
+            from result_cache_utilities import store_result
+
+            store_result(key, pred_array)
+        return pred_array
+
+    def write(case_path, pred_array):
+        case_output_path = output_path / case_path.name
+        case_output_path.mkdir(parents=True, exist_ok=True)
+        write_array_as_image_file(
+            array=pred_array, input_folder=case_path, output_folder=case_output_path
+        )
+
+    start = time.perf_counter()
+    records = run_pipeline(
+        items=case_paths,
+        read=read,
+        predict=predict,
+        write=write,
+        prefetch=prefetch,
+        write_behind=write_behind,
+    )
+    total_seconds = time.perf_counter() - start
+
+    summary = {
+        "cases": [{"case": p.name, **r} for p, r in zip(case_paths, records)],
+        "prefetch": prefetch,
+        "write_behind": write_behind,
+        "total_seconds": total_seconds,
+        "cases_per_minute": 60 * len(case_paths) / total_seconds,
+        "failed_cases": [
+            p.name for p, r in zip(case_paths, records) if r["status"] != "ok"
+        ],
+    }
+
+    output_path.mkdir(parents=True, exist_ok=True)
+    with open(output_path / "batch-summary.json", "w") as f:
+        f.write(json.dumps(summary, indent=4))
+    write_profile(output_folder=output_path)
+    print(
+        f"Ran {len(case_paths)} cases in {total_seconds:.1f}s "
+        f"({summary['cases_per_minute']:.1f} cases per minute)"
+    )
+    return 1 if summary["failed_cases"] else 0
+
+
+def serve_cases(*, host, port):
+    """
+    Warm worker: keeps the imports and your model (see load_your_model) initialized
+    and runs one case per local HTTP request, see worker_utilities.
+    Each case is run like `run` with the input and output folder of the request.
+    """
+    # Initialize the model at start-up, not during the first case
+    load_your_model()
+
+    def handle(*, input_path, output_path):
+        output_path = Path(output_path)
+        output_path.mkdir(parents=True, exist_ok=True)
+        reset_profile()
+        timings = run_case(input_path=Path(input_path), output_path=output_path)
+        write_profile(output_folder=output_path)
+        return timings
+
+    return serve(handle=handle, host=host, port=port)
+
+
+def read_case(*, input_path, decode=False):
+    """
+    Gives the input images of a case as lazy handles that behave like
+    npy arrays with shape (x,y,z), see LazyImageArray.
+    args:
+        input_path: Path - folder with the input images inside /images
+        decode: bool - decode the image of your TRACK right away, e.g. to prefetch it
+    returns:
+        tuple - (MR handle, CT handle)
+    """
+    # NOTE: an image is only decoded when your algorithm accesses it,
+    # so the modality that is not used by your TRACK is never read
+    input_head_mr_angiography = LazyImageArray(
+        location=input_path / "images/head-mr-angio",
+    )
+    input_head_ct_angiography = LazyImageArray(
+        location=input_path / "images/head-ct-angio",
+    )
+    if decode:
+        if TRACK == "MR":
+            input_head_mr_angiography.load()
+        elif TRACK == "CT":
+            input_head_ct_angiography.load()
+    return input_head_mr_angiography, input_head_ct_angiography
+
+
+class ImageInformation(NamedTuple):
+    """
+    Geometry of an input image, i.e. everything but the voxel data.
+    NOTE: size is in SimpleITK (x,y,z) order, the same as the npy arrays
+    returned by `load_image_file_as_array`
+    """
+
+    size: tuple
+    spacing: tuple
+    origin: tuple
+    direction: tuple
+    pixel_id: int
+
+    @classmethod
+    def from_image(cls, img):
+        # works for both sitk.Image and sitk.ImageFileReader
+        return cls(
+            size=tuple(img.GetSize()),
+            spacing=tuple(img.GetSpacing()),
+            origin=tuple(img.GetOrigin()),
+            direction=tuple(img.GetDirection()),
+            pixel_id=img.GetPixelID(),
+        )
+
+    @classmethod
+    def from_dict(cls, geometry):
+        # the counterpart of `._asdict()`, e.g. after a round trip through JSON
+        return cls(
+            **{
+                name: tuple(value) if isinstance(value, list) else value
+                for name, value in geometry.items()
+            }
+        )
+
+    @property
+    def nbytes(self):
+        # Memory needed for the decoded voxel data
+        pixel = sitk.Image([1] * len(self.size), self.pixel_id)
+        return (
+            int(np.prod(self.size))
+            * pixel.GetSizeOfPixelComponent()
+            * pixel.GetNumberOfComponentsPerPixel()
+        )
+
+    def copy_to(self, img):
+        # Same as img.CopyInformation(<input image>)
+        img.SetSpacing(self.spacing)
+        img.SetOrigin(self.origin)
+        img.SetDirection(self.direction)
+
+
+# Geometry of the images read in this run, keyed by their input folder.
+# This avoids decoding an input image a second time just for its metadata
+_image_information_cache = {}
+
+
+def result_cache_key(*, input_path):
+    """
+    Key of the prediction of a case in the result cache (TOPCOW_RESULT_CACHE),
+    from the input images of both modalities, see result_cache_utilities.
+    NOTE: a case may lack one modality, only the images that exist are hashed
+    returns:
+        str - the key, None if the result cache is off
+    """
+    if not _opted_in("TOPCOW_RESULT_CACHE"):
+        return None
+    from result_cache_utilities import result_key
+
+    input_files = []
+    for folder in ("images/head-mr-angio", "images/head-ct-angio"):
+        location = input_path / folder
+        # same file as `_find_image_file`, which fails without one
+        image_files = glob(str(location / "*.mha")) + glob(str(location / "*.nii.gz"))
+        input_files += [Path(f) for f in image_files[:1]]
+    return result_key(
+        input_files=input_files,
+        model_version=MODEL_VERSION,
+        track=TRACK,
+    )
+
+
+def _opted_in(env):
+    """
+    Whether the environment variable of an opt-in feature is set at all.
+    NOTE: the module of a feature is only imported if it is, so that the features that
+    are off cost no start-up time; the module then parses the value, e.g. "0" is off
+    """
+    return bool(os.environ.get(env, "").strip())
+
+
+def _clear_statistics_cache():
+    # Only if your algorithm uses normalization_utilities, it is not imported here
+    normalization_utilities = sys.modules.get("normalization_utilities")
+    if normalization_utilities is not None:
+        normalization_utilities.clear_statistics_cache()
+
+
+def _find_image_file(*, input_path):
+    return (glob(str(input_path / "*.mha")) + glob(str(input_path / "*.nii.gz")))[
         0
     ]  # There is just one file in the input folder!
-    return sitk.ReadImage(input_file)
 
 
-def load_image_file_as_array(*, location):
+def load_image_file(*, input_path):
+    # Use SimpleITK to read a file
+    with profile_stage("load image", location=str(input_path)):
+        img = sitk.ReadImage(_find_image_file(input_path=input_path))
+    _image_information_cache[Path(input_path)] = ImageInformation.from_image(img)
+    return img
+
+
+def load_image_information(*, input_path):
+    # Gives the geometry of the image without decoding the voxel data
+    # if the image was not already loaded in this run
+    key = Path(input_path)
+    if key not in _image_information_cache:
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(_find_image_file(input_path=input_path))
+        reader.ReadImageInformation()
+        _image_information_cache[key] = ImageInformation.from_image(reader)
+    return _image_information_cache[key]
+
+
+def load_transcoded_image(*, input_path):
+    """
+    Gives the voxel data of an input image from the transcoding cache
+    (TOPCOW_TRANSCODE_CACHE), the image is decoded and stored on first access,
+    see transcoding_utilities.
+    returns:
+        np.memmap - copy-on-write, in the SimpleITK axis order (z,y,x)
+    """
+    from transcoding_utilities import load_transcoded, store_transcoded
+
+    image_file = _find_image_file(input_path=input_path)
+    with profile_stage("load image", location=str(input_path)):
+        cached = load_transcoded(image_file)
+        if cached is None:
+            img = sitk.ReadImage(image_file)
+            cached = store_transcoded(
+                image_file,
+                array=sitk.GetArrayViewFromImage(img),
+                geometry=ImageInformation.from_image(img)._asdict(),
+            )
+    array, geometry = cached
+    _image_information_cache[Path(input_path)] = ImageInformation.from_dict(geometry)
+    return array
+
+
+def load_image_file_as_array(*, location, layout="xyz"):
+    if _opted_in("TOPCOW_TRANSCODE_CACHE"):
+        # NOTE: a memory map of the raw volume, nothing is decoded
+        return _reorder_axes(load_transcoded_image(input_path=location), layout=layout)
+
     img = load_image_file(input_path=location)
 
     # Convert it to a Numpy array
+    # Gives a npy array with shape (x,y,z) by default, see `image_to_array`
+    return image_to_array(img, layout=layout)
+
 
+def _reorder_axes(array, *, layout):
     # NOTE: SimpleITK npy axis ordering is (z,y,x)!
-    img_array = sitk.GetArrayFromImage(img)
+    # Reordering is a transpose, which gives a view and never copies
+    if layout == "xyz":
+        return array.transpose((2, 1, 0))
+    if layout == "zyx":
+        return array
+    raise ValueError(f"Invalid layout {layout!r}. Choose either 'xyz' or 'zyx'.")
 
-    # reorder from (z,y,x) to (x,y,z)
-    img_array = img_array.transpose((2, 1, 0))
 
-    return img_array
+def image_to_array(img, *, layout="xyz", copy=True):
+    """
+    Converts a SimpleITK image to a npy array with at most one copy.
+    args:
+        img: sitk.Image
+        layout: str - "xyz" (default) gives the (x,y,z) axis order used in this template,
+                "zyx" gives the SimpleITK npy axis order (z,y,x)
+        copy: bool - if False, gives a read-only view of the image buffer without any copy
+              NOTE: then you must keep `img` alive while the view is in use!
+    returns:
+        np.array - C-contiguous for "zyx", Fortran-contiguous for "xyz"
+    """
+    if copy:
+        array = sitk.GetArrayFromImage(img)
+    else:
+        array = sitk.GetArrayViewFromImage(img)
+    return _reorder_axes(array, layout=layout)
+
+
+class LazyImageArray(np.lib.mixins.NDArrayOperatorsMixin):
+    """
+    Handle to an input image that is only decoded on first access.
+
+    It can be used like the npy array with shape (x,y,z) returned by
+    `load_image_file_as_array`: indexing, attributes, arithmetic and numpy
+    functions all decode the image once and then work on the decoded array.
+    Only `.shape` and `.information` are served from the image header.
+    Use `np.asarray(handle)` if you need the plain npy array,
+    e.g. for `torch.from_numpy`.
+
+    Writing through the handle (`handle[...] = value`, `out=handle`) works in every
+    mode. With TOPCOW_MEMORY_BUDGET_MB the decoded array is a read-only view of the
+    image buffer, so the first write replaces it with an owned copy (copy-on-write),
+    which needs the memory of the image a second time; arrays taken with
+    `np.asarray(handle)` before that stay read-only.
+    """
+
+    def __init__(self, *, location):
+        self.location = location
+        self._image = None
+        self._zyx_array = None
+
+    @property
+    def is_loaded(self):
+        return self._zyx_array is not None
+
+    def load(self, *, layout="xyz"):
+        """
+        Decodes the image on first call.
+        args:
+            layout: str - "xyz" (default) or "zyx", see `image_to_array`
+        returns:
+            np.array - the image in the requested axis order, as a view on the same data
+        """
+        if not self.is_loaded:
+            # NOTE: the transcoding cache gives a memory map, which needs no budget
+            if memory_budget_mb() is None or _opted_in("TOPCOW_TRANSCODE_CACHE"):
+                self._zyx_array = load_image_file_as_array(
+                    location=self.location, layout="zyx"
+                )
+            else:
+                # Memory-budget mode: no copy, the npy array is a read-only view
+                # of the image buffer, so the handle also keeps the image alive
+                check_allocation(
+                    nbytes=self.information.nbytes, what=f"decoding {self.location}"
+                )
+                self._image = load_image_file(input_path=self.location)
+                self._zyx_array = image_to_array(self._image, layout="zyx", copy=False)
+                report_peak_rss(stage=f"loading {self.location}")
+        return _reorder_axes(self._zyx_array, layout=layout)
+
+    @property
+    def shape(self):
+        # Read from the image header, so this does not decode the image
+        return load_image_information(input_path=self.location).size
+
+    @property
+    def information(self):
+        # Spacing, origin and direction of the image, see ImageInformation
+        return load_image_information(input_path=self.location)
+
+    def __array__(self, dtype=None, copy=None):
+        if copy:
+            return np.array(self.load(), dtype=dtype, copy=True)
+        return np.asarray(self.load(), dtype=dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = tuple(x.load() if isinstance(x, LazyImageArray) else x for x in inputs)
+        if "out" in kwargs:
+            kwargs["out"] = tuple(
+                x._writable() if isinstance(x, LazyImageArray) else x
+                for x in kwargs["out"]
+            )
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __getattr__(self, name):
+        # Only called for attributes not defined on the handle itself,
+        # everything else (shape, dtype, transpose, ...) comes from the array
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __setitem__(self, key, value):
+        self._writable()[key] = value
+
+    def _writable(self):
+        # Copy-on-write: the read-only view of memory-budget mode is replaced by an
+        # owned copy on the first write
+        # NOTE: the image is kept alive, earlier views of its buffer may still be in use
+        if not self.load(layout="zyx").flags.writeable:
+            check_allocation(
+                nbytes=self._zyx_array.nbytes, what=f"writing to {self.location}"
+            )
+            self._zyx_array = self._zyx_array.copy()
+        return self.load()
+
+    def __len__(self):
+        return len(self.load())
+
+    def __repr__(self):
+        state = "loaded" if self.is_loaded else "not loaded"
+        return f"LazyImageArray(location={str(self.location)!r}, {state})"
 
 
 def write_array_as_image_file(*, array, input_folder, output_folder):
@@ -109,17 +790,25 @@ def write_array_as_image_file(*, array, input_folder, output_folder):
 
     # NOTE: Your output prediction must have the same shape
     # as the input image of the chosen track!
+    # NOTE: the geometry is taken from the load phase (or the image header),
+    # the input image is not decoded again
     required_output_shape = tuple()
-    input_img = sitk.Image
+    input_information = None
     if TRACK == "MR":
-        input_img = load_image_file(input_path=input_folder / "images/head-mr-angio")
+        input_information = load_image_information(
+            input_path=input_folder / "images/head-mr-angio"
+        )
     elif TRACK == "CT":
-        input_img = load_image_file(input_path=input_folder / "images/head-ct-angio")
+        input_information = load_image_information(
+            input_path=input_folder / "images/head-ct-angio"
+        )
 
-    required_output_shape = input_img.GetSize()
-    assert (
-        array.shape == required_output_shape
-    ), "Prediction output must have the same shape as the input image!"
+    required_output_shape = input_information.size
+    with profile_stage("validation"):
+        # NOTE: slabs are checked by the writer, as they come in
+        assert (
+            isinstance(array, Iterator) or array.shape == required_output_shape
+        ), "Prediction output must have the same shape as the input image!"
 
     # Create the output folder
     output_location = output_folder / "images/cow-multiclass-segmentation"
@@ -127,21 +816,46 @@ def write_array_as_image_file(*, array, input_folder, output_folder):
 
     suffix = ".mha"
 
-    # Reorder array from (x,y,z) to (z,y,x) before using sitk.GetImageFromArray
-    array = array.transpose((2, 1, 0)).astype(np.uint8)
-
-    # Converting prediction array back to SimpleITK
-    # copying the metadata from the original image
-    seg_mask = sitk.GetImageFromArray(array.astype(np.uint8))
-
-    # Copies the Origin, Spacing, and Direction from the source image
-    seg_mask.CopyInformation(input_img)
-
-    sitk.WriteImage(
-        seg_mask,
-        output_location / f"output{suffix}",
-        useCompression=True,
+    # Writes the prediction as uint8 .mha with multithreaded compression,
+    # copying the Origin, Spacing, and Direction from the original image
+    # NOTE: set TOPCOW_COMPRESSION_LEVEL to trade write time for file size
+    with profile_stage("write"):
+        if isinstance(array, Iterator):
+            # Slabs of your algorithm are written as they are predicted,
+            # so the whole label map is never in memory, see mha_utilities.MhaSlabWriter
+            write_label_map_slabs(
+                array,
+                output_location / f"output{suffix}",
+                information=input_information,
+            )
+        else:
+            write_label_map_mha(
+                np.asarray(array),
+                output_location / f"output{suffix}",
+                information=input_information,
+            )
+
+
+def array_to_image(array, *, layout="xyz", dtype=None, information=None):
+    """
+    Converts a npy array to a SimpleITK image, the counterpart of `image_to_array`.
+    Reordering (x,y,z) to (z,y,x) and casting to `dtype` are done in a single copy,
+    which is skipped if the array already has the right memory order and dtype.
+    args:
+        array: np.array - in the axis order given by `layout`
+        layout: str - "xyz" (default) or "zyx"
+        dtype: np.dtype - optional dtype of the image
+        information: ImageInformation - optional geometry to copy to the image
+    returns:
+        sitk.Image
+    """
+    array = np.ascontiguousarray(
+        _reorder_axes(np.asarray(array), layout=layout), dtype=dtype
     )
+    img = sitk.GetImageFromArray(array)
+    if information is not None:
+        information.copy_to(img)
+    return img
 
 
 def _is_docker():
@@ -162,4 +876,63 @@ def _is_docker():
 
 
 if __name__ == "__main__":
-    raise SystemExit(run())
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--batch",
+        type=Path,
+        metavar="CASES_DIR",
+        help="run all case folders in CASES_DIR instead of the single input case",
+    )
+    parser.add_argument(
+        "--input",
+        type=Path,
+        metavar="INPUT_DIR",
+        help="input folder of the single case (default: /input or ./test/input)",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        metavar="OUTPUT_DIR",
+        help="where to store the outputs "
+        "(default: /output or ./test/output, CASES_DIR-output in batch mode)",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=1,
+        help="batch mode: number of cases decoded ahead of the prediction (default: 1)",
+    )
+    parser.add_argument(
+        "--write-behind",
+        type=int,
+        default=1,
+        help="batch mode: number of outputs written in the background (default: 1)",
+    )
+    parser.add_argument(
+        "--serve",
+        type=int,
+        nargs="?",
+        const=DEFAULT_PORT,
+        metavar="PORT",
+        help=f"run as a warm worker that serves cases over HTTP on PORT "
+        f"(default: {DEFAULT_PORT}), see worker_utilities",
+    )
+    parser.add_argument(
+        "--host",
+        default=DEFAULT_HOST,
+        help=f"worker mode: address to listen on (default: {DEFAULT_HOST})",
+    )
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        raise SystemExit(serve_cases(host=args.host, port=args.serve))
+    if args.batch is None:
+        raise SystemExit(run(input_path=args.input, output_path=args.output))
+    raise SystemExit(
+        run_batch(
+            cases_path=args.batch,
+            output_path=args.output or Path(f"{args.batch}-output"),
+            prefetch=args.prefetch,
+            write_behind=args.write_behind,
+        )
+    )
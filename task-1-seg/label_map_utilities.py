@@ -0,0 +1,108 @@
+"""
+Output contract of task 1: the prediction is a uint8 label map of the shape of the input image.
+
+A label map needs one byte per voxel, but e.g. `np.ones(shape)` or the argmax of a float
+model output is float64 or int64 and 8x larger. inference.py checks the output of
+`your_segmentation_algorithm` here right after it returns:
+
+- the shape must be that of the input image (of the ROI or the resampled image)
+- the labels must lie between 0 and MAX_LABEL, checked with min/max, without a copy,
+  and a float map must hold whole numbers, checked slab by slab along z, as the cast
+  would truncate e.g. 1.5 to 1
+- uint8 is used as it is and bool is viewed as uint8, both without a copy;
+  any other dtype is cast to uint8 once, and wider dtypes (e.g. float64) get a warning
+  with their memory cost
+"""
+
+import numpy as np
+
+# TopCoW labels are 1-12 for the CoW vessels and 15 for the 3rd-A2, 0 is background;
+# 13 and 14 are not used, but only the range of 0 to MAX_LABEL is checked
+MAX_LABEL = 15
+
+# Slices per slab of the check of float labels, which needs a few temporaries
+CHUNK_SLICES = 16
+
+
+def _check_labels(array):
+    if array.size == 0:
+        return
+    if array.dtype == np.uint8:
+        # can not be negative, so one pass is enough
+        low, high = 0, int(array.max())
+    else:
+        low, high = array.min(), array.max()
+    # NOTE: also fails for NaN, as every comparison with NaN is False
+    assert (
+        0 <= low and high <= MAX_LABEL
+    ), f"Prediction output must hold labels between 0 and {MAX_LABEL}, got {low} to {high}!"
+    if array.dtype.kind == "f":
+        # slab by slab along z, so the temporaries stay small
+        for z in range(0, array.shape[-1], CHUNK_SLICES):
+            slab = array[..., z : z + CHUNK_SLICES]
+            fractional = slab != np.round(slab)
+            assert not np.any(
+                fractional
+            ), f"Prediction output must hold integer labels, got {slab[fractional][0]}!"
+
+
+def _warn_wide_dtype(dtype, *, nbytes, size):
+    print(
+        f"[WARNING] Prediction output is {dtype}, {dtype.itemsize}x the memory of uint8 "
+        f"({nbytes / 2**20:.0f} MB instead of {size / 2**20:.0f} MB). "
+        f"Return a uint8 label map to save the memory, "
+        f"e.g. `logits.argmax(axis=0).astype(np.uint8)`."
+    )
+
+
+def as_label_map(array, *, shape=None, warn=True):
+    """
+    Checks a predicted label map and gives it as uint8, with at most one cast.
+    args:
+        array: np.array - label map in (x,y,z)
+        shape: tuple - required shape in (x,y,z), not checked if None
+        warn: bool - warn if the dtype is wider than uint8
+    returns:
+        np.array - uint8 label map, `array` itself if it is already uint8,
+            in the memory order of `array`
+    """
+    array = np.asarray(array)
+    if shape is not None:
+        assert tuple(array.shape) == tuple(
+            shape
+        ), "Prediction output must have the same shape as the input image!"
+    if array.dtype == bool:
+        return array.view(np.uint8)
+    assert (
+        array.dtype.kind in "uif"
+    ), f"Prediction output must be a label map of integers, got {array.dtype}!"
+    _check_labels(array)
+    if array.dtype == np.uint8:
+        return array
+    if warn and array.dtype.itemsize > 1:
+        _warn_wide_dtype(array.dtype, nbytes=array.nbytes, size=array.size)
+    # NOTE: order "K" keeps a transposed (x,y,z) array Fortran-ordered, so no reordering
+    return array.astype(np.uint8, order="K")
+
+
+def as_label_map_slabs(slabs, *, shape=None):
+    """
+    Checks a label map that is given in slabs along z slab by slab, see `as_label_map`.
+    The number of slices is checked by the writer, see mha_utilities.MhaSlabWriter.
+    args:
+        slabs: iterable of np.array - slabs in (x,y,z), in z order
+        shape: tuple - shape of the whole label map in (x,y,z), for the warning
+    yields:
+        np.array - uint8 slabs
+    """
+    for index, slab in enumerate(slabs):
+        slab = np.asarray(slab)
+        # only warn once, for the whole label map and not for every slab
+        if (
+            index == 0
+            and slab.dtype not in (np.uint8, bool)
+            and slab.dtype.itemsize > 1
+        ):
+            size = int(np.prod(shape)) if shape is not None else slab.size
+            _warn_wide_dtype(slab.dtype, nbytes=size * slab.dtype.itemsize, size=size)
+        yield as_label_map(slab, warn=False)
@@ -0,0 +1,456 @@
+"""
+Fast writer for uint8 label maps in the MetaImage (.mha) format.
+
+sitk.WriteImage(..., useCompression=True) needs a contiguous (z,y,x) copy of the
+prediction and compresses it with single-threaded zlib. This writer reorders and
+compresses the image slab by slab on several threads (like pigz) and concatenates
+the slabs into one regular zlib stream, so the .mha files
+are read by SimpleITK/ITK (and hence grand-challenge) like any other compressed .mha.
+Label maps are mostly zero: for sparse label maps the zlib run-length strategy is used,
+which is faster and compresses them about as well as the default strategy.
+
+The compression level can be set with the environment variable TOPCOW_COMPRESSION_LEVEL
+(0 = uncompressed, 1 = fastest (default), 9 = smallest).
+
+`MhaSlabWriter` writes the same file from z-slabs, e.g. as a tiled predictor produces them,
+so the whole label map never has to be in memory.
+"""
+
+import functools
+import os
+import zlib
+from collections import deque
+
+import numpy as np
+from cgroup_utilities import available_cpus
+
+COMPRESSION_LEVEL_ENV = "TOPCOW_COMPRESSION_LEVEL"
+DEFAULT_COMPRESSION_LEVEL = 1
+
+# Label maps with fewer foreground voxels than this fraction count as sparse
+SPARSE_FRACTION = 0.1
+
+# Approximate size in bytes of the chunks that are compressed in parallel
+CHUNK_SIZE = 1 << 20
+
+# deflate window, each chunk is primed with this much of the previous chunk
+_WINDOW_SIZE = 1 << 15
+
+
+def compression_level_from_env():
+    value = os.environ.get(COMPRESSION_LEVEL_ENV, "").strip()
+    level = int(value) if value else DEFAULT_COMPRESSION_LEVEL
+    if not 0 <= level <= 9:
+        raise ValueError(
+            f"{COMPRESSION_LEVEL_ENV} must be between 0 and 9, got {level}"
+        )
+    return level
+
+
+def _default_threads():
+    # the CPUs of the container's quota, not all cores of the host
+    return available_cpus()
+
+
+def compress_zlib(
+    volume, *, level=DEFAULT_COMPRESSION_LEVEL, rle=False, threads=None, occupied=None
+):
+    """
+    Compresses the voxels of a uint8 volume (in C order) into a single zlib stream,
+    in chunks on several threads.
+    Each chunk is a slab along the first axis that is only made contiguous right before
+    it is compressed, so a transposed view is reordered in parallel and never in full.
+    args:
+        volume: np.array - uint8 array, e.g. a (z,y,x) view of the label map
+        level: int - zlib compression level 1-9
+        rle: bool - use the run-length strategy (Z_RLE), best for sparse label maps
+        threads: int - number of threads, defaults to the number of available CPUs
+        occupied: np.array - optional, per slice along the first axis whether it has any
+            nonzero voxels; empty slabs are then skipped without even being reordered
+    returns:
+        bytes - a zlib stream that decompresses with zlib.decompress
+    """
+    plane_size = max(1, volume[0].size)
+    planes_per_chunk = max(1, CHUNK_SIZE // plane_size)
+    n_chunks = max(1, -(-len(volume) // planes_per_chunk))
+    strategy = zlib.Z_RLE if rle else zlib.Z_DEFAULT_STRATEGY
+
+    def deflate(i):
+        start = i * planes_per_chunk
+        size = min(planes_per_chunk, len(volume) - start) * plane_size
+        last = i == n_chunks - 1
+        if (
+            not last
+            and occupied is not None
+            and not occupied[start : start + planes_per_chunk].any()
+        ):
+            return _zero_chunk(size, level, strategy)
+
+        chunk = np.ascontiguousarray(
+            volume[start : start + planes_per_chunk], dtype=np.uint8
+        )
+        if not last and not chunk.any():
+            return _zero_chunk(size, level, strategy)
+
+        previous = None
+        if not rle and i > 0:
+            n_planes = -(-_WINDOW_SIZE // plane_size)
+            previous = np.ascontiguousarray(
+                volume[max(0, start - n_planes) : start], dtype=np.uint8
+            ).reshape(-1)[-_WINDOW_SIZE:]
+        return _deflate_chunk(
+            chunk, level=level, strategy=strategy, previous=previous, last=last
+        )
+
+    threads = threads or _default_threads()
+    if threads > 1 and n_chunks > 1:
+        # NOTE: imported here, so it does not slow down the start-up of every run
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            chunks = list(pool.map(deflate, range(n_chunks)))
+    else:
+        chunks = [deflate(i) for i in range(n_chunks)]
+
+    # wrap the deflate data in a zlib header and an adler32 checksum trailer
+    checksum = 1
+    for _, chunk_checksum, chunk_size in chunks:
+        checksum = _adler32_combine(checksum, chunk_checksum, chunk_size)
+    return (
+        _zlib_header(level)
+        + b"".join(compressed for compressed, _, _ in chunks)
+        + checksum.to_bytes(4, "big")
+    )
+
+
+def _deflate_chunk(chunk, *, level, strategy, previous=None, last=False):
+    # raw deflate data of a contiguous uint8 chunk, with its adler32 and size
+    if previous is None:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 8, strategy)
+    else:
+        # prime with the end of the previous chunk, so matches can reach back into it
+        # and the ratio is the same as with a single stream
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -15, 8, strategy, zdict=previous.tobytes()
+        )
+    # Z_SYNC_FLUSH ends a chunk on a byte boundary without ending the stream,
+    # so the raw deflate chunks can simply be concatenated
+    compressed = compressor.compress(chunk) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+    return compressed, zlib.adler32(chunk), chunk.size
+
+
+@functools.lru_cache(maxsize=16)
+def _zero_chunk(size, level, strategy):
+    # Sparse fast path: all-zero chunks of the same size compress to the same bytes
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 8, strategy)
+    compressed = compressor.compress(bytes(size)) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    # adler32 of `size` zero bytes
+    return compressed, ((size % 65521) << 16) | 1, size
+
+
+def _adler32_combine(adler1, adler2, length2):
+    # adler32 of the concatenation of two byte strings, as adler32_combine in zlib
+    base = 65521
+    remainder = length2 % base
+    sum1 = adler1 & 0xFFFF
+    sum2 = (remainder * sum1) % base
+    sum1 += (adler2 & 0xFFFF) + base - 1
+    sum2 += ((adler1 >> 16) & 0xFFFF) + ((adler2 >> 16) & 0xFFFF) + base - remainder
+    return (sum1 % base) | ((sum2 % base) << 16)
+
+
+def _zlib_header(level):
+    # deflate with 32K window and the level hint, the same bytes zlib itself writes
+    if level < 2:
+        return b"\x78\x01"
+    if level < 6:
+        return b"\x78\x5e"
+    if level == 6:
+        return b"\x78\x9c"
+    return b"\x78\xda"
+
+
+def mha_header(
+    *, information, element_type="MET_UCHAR", compressed_size=None, size_width=0
+):
+    """
+    MetaImage header for an image with the geometry of `information` (see inference.ImageInformation).
+    args:
+        compressed_size: int - size of the compressed data, None for uncompressed data
+        size_width: int - pad the compressed size with spaces to this many characters,
+            so that it can be overwritten in place once it is known
+    returns:
+        bytes
+    """
+    ndims = len(information.size)
+    # NOTE: the TransformMatrix holds the direction cosines column by column
+    direction = np.array(information.direction).reshape(ndims, ndims)
+    lines = [
+        "ObjectType = Image",
+        f"NDims = {ndims}",
+        "BinaryData = True",
+        "BinaryDataByteOrderMSB = False",
+    ]
+    if compressed_size is None:
+        lines.append("CompressedData = False")
+    else:
+        lines.append("CompressedData = True")
+        lines.append(f"CompressedDataSize = {str(compressed_size).ljust(size_width)}")
+    lines += [
+        "TransformMatrix = " + " ".join(repr(float(v)) for v in direction.T.ravel()),
+        "Offset = " + " ".join(repr(float(v)) for v in information.origin),
+        "CenterOfRotation = " + " ".join(["0"] * ndims),
+        "ElementSpacing = " + " ".join(repr(float(v)) for v in information.spacing),
+        "DimSize = " + " ".join(str(int(v)) for v in information.size),
+        f"ElementType = {element_type}",
+        "ElementDataFile = LOCAL",
+    ]
+    return ("\n".join(lines) + "\n").encode("ascii")
+
+
+def write_label_map_mha(
+    array, path, *, information, compression_level=None, rle=None, threads=None
+):
+    """
+    Writes a label map as .mha file.
+    args:
+        array: np.array - label map in (x,y,z), cast to uint8
+        path: Path - where to write the .mha file
+        information: ImageInformation - geometry of the input image
+        compression_level: int - 0 (uncompressed) to 9, defaults to TOPCOW_COMPRESSION_LEVEL or 1
+        rle: bool - run-length strategy, by default used if the label map is sparse
+        threads: int - compression threads, defaults to the number of available CPUs
+    """
+    if compression_level is None:
+        compression_level = compression_level_from_env()
+
+    # Reorder array from (x,y,z) to (z,y,x), the .mha voxel order
+    # NOTE: this is a view, the reordering and the cast to uint8 are done slab by slab
+    volume = array.transpose((2, 1, 0))
+
+    if compression_level == 0:
+        with open(path, "wb") as f:
+            f.write(mha_header(information=information))
+            for z in range(len(volume)):
+                f.write(np.ascontiguousarray(volume[z], dtype=np.uint8))
+        return
+
+    if rle is None:
+        rle = np.count_nonzero(array) < SPARSE_FRACTION * array.size
+    payload = compress_zlib(
+        volume,
+        level=compression_level,
+        rle=rle,
+        threads=threads,
+        occupied=np.any(array, axis=(0, 1)),
+    )
+    with open(path, "wb") as f:
+        f.write(mha_header(information=information, compressed_size=len(payload)))
+        f.write(payload)
+
+
+class MhaSlabWriter:
+    """
+    Writes a label map as .mha file from slabs along z, so that the whole label map is
+    never in memory, e.g. from sliding_window_utilities.sliding_window_slabs:
+
+        with MhaSlabWriter(path, information=information) as writer:
+            for slab in slabs:
+                writer.write(slab)
+
+    The slabs are reordered and compressed in chunks of about CHUNK_SIZE bytes on several
+    threads and written as soon as they are compressed, which gives the same compressed
+    data as `write_label_map_mha`. The memory use is one slab plus a chunk per thread.
+    The header is written first, with room for the compressed size that is filled in
+    when the writer is closed.
+    NOTE: label maps are sparse, so unlike `write_label_map_mha` the run-length
+    strategy is used by default, it can not be chosen from the whole label map.
+    """
+
+    # characters reserved for the compressed size in the header
+    _SIZE_WIDTH = 20
+
+    def __init__(
+        self, path, *, information, compression_level=None, rle=True, threads=None
+    ):
+        """
+        args:
+            path: Path - where to write the .mha file
+            information: ImageInformation - geometry of the input image
+            compression_level: int - 0 (uncompressed) to 9, defaults to TOPCOW_COMPRESSION_LEVEL or 1
+            rle: bool - run-length strategy
+            threads: int - compression threads, defaults to the number of available CPUs
+        """
+        if compression_level is None:
+            compression_level = compression_level_from_env()
+        self.path = path
+        self.information = information
+        self.level = compression_level
+        self.threads = threads or _default_threads()
+        self._strategy = zlib.Z_RLE if rle else zlib.Z_DEFAULT_STRATEGY
+        self._rle = rle
+
+        size_x, size_y, self._n_slices = (int(n) for n in information.size)
+        self._plane_shape = (size_y, size_x)
+        self._planes_per_chunk = max(1, CHUNK_SIZE // max(1, size_x * size_y))
+        self._n_written = 0
+        # planes (z,y,x) of the chunk that is being filled
+        self._chunk = None
+        self._n_buffered = 0
+        self._previous = None
+        self._pending = deque()
+        self._pool = None
+        self._checksum = 1
+        self._compressed_size = 0
+
+        self._file = open(path, "wb")
+        header = mha_header(
+            information=information,
+            compressed_size=0 if self.level > 0 else None,
+            size_width=self._SIZE_WIDTH,
+        )
+        self._size_offset = header.find(b"CompressedDataSize = ") + len(
+            b"CompressedDataSize = "
+        )
+        self._file.write(header)
+        if self.level > 0:
+            self._file.write(_zlib_header(self.level))
+
+    def write(self, slab):
+        """
+        args:
+            slab: np.array - the next slices of the label map in (x,y,z),
+                or a single slice in (x,y), cast to uint8
+        """
+        slab = np.asarray(slab)
+        if slab.ndim == 2:
+            slab = slab[:, :, None]
+        assert (
+            slab.ndim == 3
+            and tuple(slab.shape[:2]) == self._plane_shape[::-1]
+            and self._n_written + slab.shape[2] <= self._n_slices
+        ), "Prediction output must have the same shape as the input image!"
+
+        # Reorder from (x,y,z) to (z,y,x), the .mha voxel order, plane by plane
+        for plane in slab.transpose((2, 1, 0)):
+            self._n_written += 1
+            if self.level == 0:
+                self._file.write(np.ascontiguousarray(plane, dtype=np.uint8))
+                continue
+            if self._chunk is None:
+                n_planes = min(
+                    self._planes_per_chunk,
+                    self._n_slices - self._n_written + 1,
+                )
+                self._chunk = np.empty((n_planes, *self._plane_shape), dtype=np.uint8)
+            self._chunk[self._n_buffered] = plane
+            self._n_buffered += 1
+            if self._n_buffered == len(self._chunk):
+                self._submit_chunk()
+
+    def _submit_chunk(self):
+        chunk, self._chunk, self._n_buffered = self._chunk, None, 0
+        last = self._n_written == self._n_slices
+        if not last and not chunk.any():
+            self._pending.append(_zero_chunk(chunk.size, self.level, self._strategy))
+        else:
+            previous = self._previous
+            if self.threads > 1:
+                if self._pool is None:
+                    # NOTE: imported here, so it does not slow down the start-up of every run
+                    from concurrent.futures import ThreadPoolExecutor
+
+                    self._pool = ThreadPoolExecutor(max_workers=self.threads)
+                self._pending.append(
+                    self._pool.submit(
+                        _deflate_chunk,
+                        chunk,
+                        level=self.level,
+                        strategy=self._strategy,
+                        previous=previous,
+                        last=last,
+                    )
+                )
+            else:
+                self._pending.append(
+                    _deflate_chunk(
+                        chunk,
+                        level=self.level,
+                        strategy=self._strategy,
+                        previous=previous,
+                        last=last,
+                    )
+                )
+        if not self._rle:
+            self._previous = chunk.reshape(-1)[-_WINDOW_SIZE:].copy()
+        # backpressure: at most one chunk per thread is held in memory
+        while len(self._pending) > self.threads:
+            self._write_oldest()
+
+    def _write_oldest(self):
+        result = self._pending.popleft()
+        compressed, checksum, size = (
+            result if isinstance(result, tuple) else result.result()
+        )
+        self._file.write(compressed)
+        self._compressed_size += len(compressed)
+        self._checksum = _adler32_combine(self._checksum, checksum, size)
+
+    def close(self):
+        """
+        Writes the rest of the data and the compressed size.
+        """
+        try:
+            assert (
+                self._n_written == self._n_slices
+            ), f"Got {self._n_written} of {self._n_slices} slices of the label map!"
+            while self._pending:
+                self._write_oldest()
+            if self.level > 0:
+                self._file.write(self._checksum.to_bytes(4, "big"))
+                # the zlib header and the checksum count as compressed data
+                size = str(self._compressed_size + 6).encode("ascii")
+                assert len(size) <= self._SIZE_WIDTH
+                self._file.seek(self._size_offset)
+                self._file.write(size)
+        except BaseException:
+            self._abort()
+            raise
+        self._shutdown()
+
+    def _shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+        self._pending.clear()
+        self._file.close()
+
+    def _abort(self):
+        # do not leave an incomplete .mha behind
+        self._shutdown()
+        os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+
+def write_label_map_slabs(slabs, path, *, information, **kwargs):
+    """
+    Writes a label map given as slabs along z as .mha file, see `MhaSlabWriter`.
+    args:
+        slabs: iterable of np.array - slabs of the label map in (x,y,z), in z order
+        path: Path - where to write the .mha file
+        information: ImageInformation - geometry of the input image
+        **kwargs: compression_level, rle and threads of `MhaSlabWriter`
+    """
+    with MhaSlabWriter(path, information=information, **kwargs) as writer:
+        for slab in slabs:
+            writer.write(slab)
@@ -0,0 +1,111 @@
+"""
+Connected-component postprocessing of a label map: keep the largest component of each label.
+
+Segmentation models leave small islands of a label away from the vessel, e.g. an
+R-PCA voxel cluster next to the L-PCA. With the environment variable TOPCOW_POSTPROCESS=1,
+inference.py keeps only the largest connected component of each label of your prediction
+and sets the other voxels of that label to background:
+
+    from postprocessing_utilities import remove_small_components
+
+    remove_small_components(pred_array)  # in place on the uint8 label map
+
+Labelling the components of the whole volume once per label is slow, so the bounding
+boxes of all labels are found first, in one pass over the label map (like
+scipy.ndimage.find_objects), and the components of each label are only labelled inside
+its box, with SimpleITK. The label map is changed in place, without a full-size copy.
+"""
+
+import os
+
+import numpy as np
+import SimpleITK as sitk
+from label_map_utilities import MAX_LABEL
+
+POSTPROCESS_ENV = "TOPCOW_POSTPROCESS"
+
+# Slices per slab, the memory of the temporaries is that of a few slabs
+CHUNK_SLICES = 16
+
+
+def postprocessing_enabled():
+    return os.environ.get(POSTPROCESS_ENV, "").strip().lower() not in ("", "0", "false")
+
+
+def label_bounding_boxes(label_map, *, chunk_slices=CHUNK_SLICES):
+    """
+    Bounding boxes of all labels in one pass over the label map, slab by slab along z.
+    Only the coordinates of the labelled voxels (a small part of a CoW label map)
+    are collected, and the minimum and maximum of each label are taken over them.
+    args:
+        label_map: np.array - uint8 label map in (x,y,z) with labels up to MAX_LABEL
+    returns:
+        dict - tuple of slices in (x,y,z) by label, for every label other than 0
+    """
+    n_labels = MAX_LABEL + 1
+    # lowest and highest index along each axis of each label
+    lows = np.full((3, n_labels), np.iinfo(np.intp).max, dtype=np.intp)
+    highs = np.full((3, n_labels), -1, dtype=np.intp)
+
+    for z in range(0, label_map.shape[2], chunk_slices):
+        slab = label_map[:, :, z : z + chunk_slices]
+        coordinates = np.nonzero(slab)
+        if len(coordinates[0]) == 0:
+            continue
+        labels = slab[coordinates]
+        for axis, coordinate in enumerate(coordinates):
+            if axis == 2:
+                coordinate = coordinate + z
+            np.minimum.at(lows[axis], labels, coordinate)
+            np.maximum.at(highs[axis], labels, coordinate)
+
+    return {
+        label: tuple(
+            slice(int(low), int(high) + 1)
+            for low, high in zip(lows[:, label], highs[:, label])
+        )
+        for label in range(1, n_labels)
+        if highs[0, label] >= 0
+    }
+
+
+def remove_small_components(
+    label_map, *, labels=None, min_size=None, fully_connected=True
+):
+    """
+    Removes the small connected components of each label, in place.
+    args:
+        label_map: np.array - writeable uint8 label map in (x,y,z)
+        labels: iterable of int - labels to clean, by default all labels present
+        min_size: int - keep all components of at least this many voxels, if None only
+            the largest component of each label is kept
+        fully_connected: bool - voxels touching at an edge or corner are connected too
+            (26-connectivity), otherwise only at a face (6-connectivity)
+    returns:
+        int - number of voxels set to background
+    """
+    assert label_map.dtype == np.uint8, "The label map must be uint8!"
+    removed = 0
+    for label, box in label_bounding_boxes(label_map).items():
+        if labels is not None and label not in labels:
+            continue
+        crop = label_map[box]  # a view, changed in place
+        mask = crop == label
+        # NOTE: the connectivity does not depend on the axis order,
+        # so the (x,y,z) crop is handed to SimpleITK as it is
+        components = sitk.RelabelComponent(
+            sitk.ConnectedComponent(
+                sitk.GetImageFromArray(mask.view(np.uint8)), fully_connected
+            ),
+            sortByObjectSize=True,
+        )
+        # RelabelComponent numbers the components from the largest one down
+        component = sitk.GetArrayViewFromImage(components)
+        if min_size is None:
+            drop = mask & (component > 1)
+        else:
+            sizes = np.bincount(component.ravel())
+            drop = mask & (sizes[component] < min_size)
+        crop[drop] = 0
+        removed += int(np.count_nonzero(drop))
+    return removed
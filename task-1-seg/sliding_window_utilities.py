@@ -0,0 +1,198 @@
+"""
+Sliding-window (patch-based) inference for segmentation models that do not fit
+a whole volume, e.g. on CPU for large CTA scans.
+
+Overlapping patches are passed through your model in batches and the logits are
+blended with Gaussian weights, so the patch borders (where models are least reliable)
+count less than the patch centres.
+The logits are accumulated in a rolling slab of one patch depth along z, and every
+slab of slices that no later patch overlaps is turned into labels right away.
+The memory use is hence bounded by (number of classes x in-plane size x patch depth)
+and does not grow with the number of slices.
+
+    from sliding_window_utilities import sliding_window_inference
+
+    pred_array = sliding_window_inference(
+        mr_input_array,
+        predict=lambda batch: model(torch.from_numpy(batch)[:, None]).numpy(),
+        patch_size=(128, 128, 64),
+        num_classes=14,
+    )
+
+`sliding_window_slabs` yields the label map slab by slab instead, e.g. to stream it
+into mha_utilities.MhaSlabWriter without ever holding the whole label map.
+"""
+
+import functools
+import itertools
+
+import numpy as np
+
+
+@functools.cache
+def gaussian_importance_map(patch_size, sigma_scale=0.125):
+    """
+    Gaussian weights of a patch, 1 in the centre.
+    args:
+        patch_size: tuple of int - (x,y,z)
+        sigma_scale: float - sigma of the Gaussian as fraction of the patch size
+    returns:
+        np.array - float32 of shape patch_size, read-only as it is cached
+    """
+    weights = np.ones(patch_size, dtype=np.float32)
+    for axis, size in enumerate(patch_size):
+        sigma = max(sigma_scale * size, 1e-6)
+        coordinates = np.arange(size, dtype=np.float32) - (size - 1) / 2
+        profile = np.exp(-0.5 * (coordinates / sigma) ** 2)
+        shape = [1, 1, 1]
+        shape[axis] = size
+        weights = weights * profile.reshape(shape)
+    weights /= weights.max()
+    # NOTE: no zero weights, so every voxel of the volume gets a prediction
+    weights = np.maximum(weights, weights[weights > 0].min())
+    weights.flags.writeable = False
+    return weights
+
+
+def patch_starts(size, patch, overlap):
+    """
+    Start indices of the patches along one axis, evenly spread so that the first
+    patch starts at 0 and the last one ends at `size`.
+    """
+    if size <= patch:
+        return [0]
+    step = max(1, int(patch * (1 - overlap)))
+    n_patches = -(-(size - patch) // step) + 1
+    return [int(round(s)) for s in np.linspace(0, size - patch, n_patches)]
+
+
+def sliding_window_inference(volume, **kwargs):
+    """
+    Segments a volume patch by patch, see `sliding_window_slabs` for the arguments.
+    returns:
+        np.array - uint8 label map in (x,y,z) of the same shape as `volume`
+    """
+    output = np.empty(tuple(volume.shape), dtype=np.uint8)
+    z = 0
+    for slab in sliding_window_slabs(volume, **kwargs):
+        output[:, :, z : z + slab.shape[2]] = slab
+        z += slab.shape[2]
+    return output
+
+
+def sliding_window_slabs(
+    volume,
+    *,
+    predict,
+    patch_size,
+    num_classes,
+    overlap=0.5,
+    batch_size=4,
+    sigma_scale=0.125,
+    labels=None,
+    pad_value=0,
+    accumulator_dtype=np.float32,
+):
+    """
+    Segments a volume patch by patch, yielding the label map in slabs along z
+    as soon as no later patch overlaps them.
+    args:
+        volume: np.array - input image in (x,y,z), e.g. mr_input_array
+        predict: callable(batch) -> logits
+            batch: np.array - float32 of shape (batch, *patch_size)
+            logits: array-like of shape (batch, num_classes, *patch_size), e.g. a CPU tensor
+        patch_size: tuple of int - (x,y,z) patch size of your model
+        num_classes: int - number of output channels of your model, including background
+        overlap: float - overlap of neighbouring patches as fraction of the patch size
+        batch_size: int - maximum number of patches per call of `predict`
+        sigma_scale: float - sigma of the Gaussian blending as fraction of the patch size
+        labels: sequence of int - label value of each channel, by default the channel index
+            (e.g. with the 3rd-A2 as the 14th channel: [*range(13), 15])
+        pad_value: value to pad the patches with where the volume is smaller than a patch
+        accumulator_dtype: dtype of the logit accumulator, float16 halves its memory
+    yields:
+        np.array - uint8 slab of the label map in (x,y,z), the slabs in z order
+            together have the shape of `volume`
+    """
+    shape = tuple(volume.shape)
+    assert len(shape) == 3, "The volume must be 3D in (x,y,z)!"
+    patch_size = tuple(int(p) for p in patch_size)
+    # patches are cropped to the volume and padded back to patch_size for `predict`
+    extent = tuple(min(p, s) for p, s in zip(patch_size, shape))
+    padding = [(0, p - e) for p, e in zip(patch_size, extent)]
+    weights = gaussian_importance_map(patch_size, sigma_scale)[
+        : extent[0], : extent[1], : extent[2]
+    ]
+
+    label_values = np.asarray(
+        range(num_classes) if labels is None else labels, dtype=np.uint8
+    )
+    assert len(label_values) == num_classes, "Need one label value per channel!"
+
+    x_starts, y_starts, z_starts = (
+        patch_starts(s, e, overlap) for s, e in zip(shape, extent)
+    )
+    # rolling slab of logits for the slices [base, base + extent[2])
+    accumulator = np.zeros(
+        (num_classes, shape[0], shape[1], extent[2]), dtype=accumulator_dtype
+    )
+    base = 0
+
+    for z_index, z0 in enumerate(z_starts):
+        corners = list(itertools.product(x_starts, y_starts))
+        for i in range(0, len(corners), batch_size):
+            batch_corners = corners[i : i + batch_size]
+            batch = np.stack(
+                [
+                    np.pad(
+                        np.asarray(
+                            volume[
+                                x0 : x0 + extent[0],
+                                y0 : y0 + extent[1],
+                                z0 : z0 + extent[2],
+                            ],
+                            dtype=np.float32,
+                        ),
+                        padding,
+                        constant_values=pad_value,
+                    )
+                    for x0, y0 in batch_corners
+                ]
+            )
+            logits = np.asarray(predict(batch))
+            assert logits.shape == (
+                len(batch_corners),
+                num_classes,
+                *patch_size,
+            ), f"predict must return logits of shape (batch, {num_classes}, *{patch_size}), got {logits.shape}!"
+
+            for (x0, y0), patch_logits in zip(batch_corners, logits):
+                accumulator[
+                    :,
+                    x0 : x0 + extent[0],
+                    y0 : y0 + extent[1],
+                    z0 - base : z0 - base + extent[2],
+                ] += (
+                    patch_logits[:, : extent[0], : extent[1], : extent[2]] * weights
+                )
+            del batch, logits
+
+        # no later patch reaches below the start of the next one, so these slices are final
+        # NOTE: the argmax of the weighted sum equals that of the weighted mean
+        z_end = z_starts[z_index + 1] if z_index + 1 < len(z_starts) else shape[2]
+        slab = np.empty((shape[0], shape[1], z_end - z0), dtype=np.uint8)
+        for z in range(z0, z_end):
+            slab[:, :, z - z0] = label_values[
+                accumulator[:, :, :, z - base].argmax(axis=0)
+            ]
+        yield slab
+        del slab
+
+        # roll the slab forward to the start of the next patches
+        shift = z_end - base
+        if z_end < shape[2]:
+            # slice by slice, a copy of the whole slab would double its memory
+            for z in range(extent[2] - shift):
+                accumulator[..., z] = accumulator[..., z + shift]
+            accumulator[..., extent[2] - shift :] = 0
+            base = z_end
@@ -0,0 +1,109 @@
+"""
+Cache of the input images as raw volumes, to decode each compressed image only once.
+
+Reading a .mha or .nii.gz image spends most of its time in the zlib/gzip decompression,
+which is single-threaded and slow for a large CTA. For repeated local runs on the same
+images, with the environment variable TOPCOW_TRANSCODE_CACHE=<folder> inference.py
+decodes each input image once and stores its voxel data uncompressed, plus a small JSON
+sidecar with its shape, dtype and geometry:
+
+    TOPCOW_TRANSCODE_CACHE=~/.cache/topcow-images python inference.py --batch <cases_dir>
+
+Later runs memory-map the raw volume instead of decoding the image, so opening an image
+costs about as much as reading its header, only the pages your algorithm touches are
+read from disk, and the pages are shared between processes, e.g. parallel workers.
+The memory map is copy-on-write: your algorithm may change the array, the changes stay
+in its process and never reach the cache.
+
+An entry is keyed by the path, size and modification time of the image file, so a
+changed file is decoded again. The raw volume starts at offset 0 of its file, i.e. it is
+page-aligned, and the sidecar is written last, so an entry without sidecar is never read.
+Old entries are not removed, delete the folder to clear the cache.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+TRANSCODE_CACHE_ENV = "TOPCOW_TRANSCODE_CACHE"
+
+
+def transcode_cache_path():
+    """
+    returns:
+        Path - the cache folder, None if the cache is off
+    """
+    value = os.environ.get(TRANSCODE_CACHE_ENV, "").strip()
+    return Path(value).expanduser() if value else None
+
+
+def _entry_key(image_file):
+    stat = os.stat(image_file)
+    key = hashlib.blake2b(digest_size=20)
+    key.update(
+        json.dumps(
+            [str(Path(image_file).resolve()), stat.st_size, stat.st_mtime_ns]
+        ).encode()
+    )
+    return key.hexdigest()
+
+
+def _replace_atomically(path, write):
+    # written to a temporary file first, so that a cut-off write is never read
+    temporary = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(temporary, "wb") as f:
+        write(f)
+    os.replace(temporary, path)
+
+
+def load_transcoded(image_file):
+    """
+    args:
+        image_file: Path - the compressed input image
+    returns:
+        tuple - (np.memmap in the SimpleITK axis order (z,y,x), dict - the geometry
+            stored with it), None if the image is not in the cache
+    """
+    folder = transcode_cache_path()
+    key = _entry_key(image_file)
+    sidecar = folder / f"{key}.json"
+    if not sidecar.is_file():
+        return None
+    entry = json.loads(sidecar.read_text())
+    array = np.memmap(
+        folder / f"{key}.raw",
+        dtype=np.dtype(entry["dtype"]),
+        mode="c",
+        shape=tuple(entry["shape"]),
+    )
+    return array, entry["geometry"]
+
+
+def store_transcoded(image_file, *, array, geometry):
+    """
+    Stores the decoded voxel data of an image as raw volume with a JSON sidecar.
+    args:
+        image_file: Path - the compressed input image
+        array: np.array - its voxel data in the SimpleITK axis order (z,y,x)
+        geometry: dict - JSON-serializable geometry of the image, given back on load
+    returns:
+        tuple - (np.memmap, dict), as `load_transcoded`
+    """
+    folder = transcode_cache_path()
+    folder.mkdir(parents=True, exist_ok=True)
+    key = _entry_key(image_file)
+    array = np.ascontiguousarray(array)
+    _replace_atomically(folder / f"{key}.raw", array.tofile)
+    entry = {
+        "source": str(image_file),
+        "shape": list(array.shape),
+        "dtype": array.dtype.str,
+        "geometry": geometry,
+    }
+    _replace_atomically(
+        folder / f"{key}.json", lambda f: f.write(json.dumps(entry).encode())
+    )
+    return load_transcoded(image_file)
@@ -0,0 +1,100 @@
+"""
+Warm worker: a long-running inference.py that serves cases over local HTTP.
+
+Every `python inference.py` pays the interpreter start-up, the imports and the
+initialization of your model (see load_your_model) for a single case.
+`python inference.py --serve 8765` pays them once and then runs one case per request:
+
+    POST /cases   {"input": "<input folder>", "output": "<output folder>"}
+                  -> 200 {"status": "ok", "prediction_seconds": ..., ...}
+                  -> 500 {"status": "failed", "error": "..."}, the worker keeps running
+    GET  /health  -> 200 {"status": "ready", "cases": <cases run so far>}
+
+The folders are laid out like /input and /output of the container. Cases are run one
+after another in the main thread, as your model is not expected to be thread-safe.
+NOTE: the worker only listens on 127.0.0.1 by default and runs any folder it is sent,
+it is a local development tool and not part of the container on grand-challenge.
+`python worker_client.py` sends cases to it and compares them with cold runs.
+"""
+
+import json
+import time
+import traceback
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+def serve(*, handle, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """
+    Serves cases until the process is stopped (Ctrl+C or SIGTERM).
+    args:
+        handle: callable(input_path=str, output_path=str) -> dict of timings, runs a case
+        host: str - address to listen on
+        port: int - port to listen on, 0 picks a free port
+    returns:
+        int - exit code
+    """
+    # NOTE: imported here, so the normal runs of inference.py do not import them
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    cases = 0
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status, content):
+            body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/health":
+                return self._reply(404, {"error": f"unknown path {self.path}"})
+            self._reply(200, {"status": "ready", "cases": cases})
+
+        def do_POST(self):
+            nonlocal cases
+            if self.path != "/cases":
+                return self._reply(404, {"error": f"unknown path {self.path}"})
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length))
+                input_path, output_path = request["input"], request["output"]
+            except (ValueError, KeyError, TypeError) as e:
+                return self._reply(400, {"status": "failed", "error": repr(e)})
+
+            print(f"Running case {input_path} -> {output_path}")
+            start = time.perf_counter()
+            try:
+                timings = handle(input_path=input_path, output_path=output_path)
+            except Exception as e:
+                traceback.print_exc()
+                return self._reply(500, {"status": "failed", "error": repr(e)})
+            finally:
+                cases += 1
+            self._reply(
+                200,
+                {
+                    "status": "ok",
+                    **timings,
+                    "total_seconds": time.perf_counter() - start,
+                },
+            )
+
+        def log_message(self, format, *args):
+            # one line per request, like the rest of the output of inference.py
+            print(f"[worker] {self.address_string()} {format % args}")
+
+    # NOTE: not the threading server, so cases never run at the same time
+    server = HTTPServer((host, port), Handler)
+    print(f"Worker ready on http://{host}:{server.server_port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    print(f"Worker stopped after {cases} cases")
+    return 0
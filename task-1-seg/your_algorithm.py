@@ -29,16 +29,86 @@ To save the container and prep it for upload to Grand-Challenge.org you can call
   ./save.sh
 """
 
+import functools
+
 import numpy as np
+from roi_utilities import find_roi
 
 #######################################################################################
 # TODO-1:
 # Choose your TRACK. Track is either 'MR' or 'CT'.
 TRACK = "MR"  # or 'CT'
+
+# Version of your model, part of the key of the result cache (TOPCOW_RESULT_CACHE)
+# NOTE: change it when your model weights change, see result_cache_utilities.py
+MODEL_VERSION = "1"
+
+# With TOPCOW_TTA, your algorithm gets the flipped views of the image of your TRACK
+# as a list in one call (e.g. for one batched model call) and returns a list with
+# one prediction per view, see tta_utilities.py
+# NOTE: set it to False if your algorithm only takes one image, it is then called
+#       once per view
+TTA_BATCHED = True
 # END OF TODO-1
 #######################################################################################
 
 
+@functools.cache
+def load_your_model():
+    """
+    Load and initialize your model here.
+    It is cached, so the model is only loaded once per process,
+    e.g. when many cases are run with `python inference.py --batch <cases_dir>`.
+    returns:
+        your model (None for this dummy algorithm)
+    """
+
+    # NOTE: import heavy libraries like torch here (or in your algorithm) and not at
+    #       the top of this file, so they are only imported when they are needed
+    # import torch
+
+    # model = ...
+    # device = ...
+
+    # You can also place and load additional files in the resources folder
+    # with open(resources / "some_resource.txt", "r") as f:
+    #     print(f.read())
+
+    # Model weights saved with `weight_store_utilities.save_weights` are memory-mapped,
+    # which is much faster and leaner than torch.load of a checkpoint
+    # from weight_store_utilities import load_weights, as_torch_state_dict
+    # weights = load_weights(resources / "weights")
+    # model.load_state_dict(as_torch_state_dict(weights), assign=True)
+
+    return None
+
+
+def your_roi_algorithm(*, mr_input_array: np.array, ct_input_array: np.array) -> dict:
+    """
+    Region of interest (ROI) for the ROI cascade, only used with TOPCOW_ROI_CASCADE=1.
+    `your_segmentation_algorithm` then only gets this crop of the image of your TRACK,
+    see roi_utilities.py.
+    By default a cheap heuristic, a box of fixed size around the bright vessels.
+    You can also use your own detector here, e.g. your task 2 model.
+    args:
+        mr_input_array: np.array - input image for MR track
+        ct_input_array: np.array - input image for CT track
+    returns:
+        dict - bounding box in the form {"size": [x, y, z], "location": [x, y, z]}
+    """
+    if TRACK == "CT":
+        input_array = ct_input_array
+    elif TRACK == "MR":
+        input_array = mr_input_array
+    else:
+        raise ValueError("Invalid TRACK chosen. Choose either 'MR' or 'CT'.")
+
+    # NOTE: the inputs are lazy handles of the images, their geometry is in `.information`
+    return find_roi(
+        input_array, spacing=input_array.information.spacing, modality=TRACK
+    )
+
+
 def your_segmentation_algorithm(
     *, mr_input_array: np.array, ct_input_array: np.array
 ) -> np.array:
@@ -48,8 +118,9 @@ def your_segmentation_algorithm(
     args:
         mr_input_array: np.array - input image for MR track
         ct_input_array: np.array - input image for CT track
+    NOTE: the inputs are decoded lazily, only the one of your TRACK is read
     returns:
-        np.array - prediction
+        np.array - prediction, a uint8 label map in (x,y,z)
     """
 
     #######################################################################################
@@ -59,22 +130,41 @@ def your_segmentation_algorithm(
     # to make your prediction.
 
     # NOTE: the prediction array must have the same shape as the input image of the chosen track!
+    #       Return it as uint8 with labels between 0 and 15, see label_map_utilities.py.
 
     # NOTE: If you extract the array from SimpleITK, note that
     #              SimpleITK npy array axis order is (z,y,x).
     #              Then you might have to transpose this to (x,y,z)
 
-    #######################################################################################
+    # NOTE: normalize_intensities() in normalization_utilities.py clips and z-scores
+    #       the image of your TRACK (HU window for CT, percentiles for MR) into one
+    #       float32 array, with the statistics from a histogram instead of sorting.
 
-    # load and initialize your model here
-    # model = ...
-    # device = ...
+    # NOTE: For patch-based models, sliding_window_inference() in
+    #       sliding_window_utilities.py predicts the volume patch by patch
+    #       with bounded memory and returns the label map in (x,y,z).
+    #       You can also return the generator of sliding_window_slabs() (or your own
+    #       generator of uint8 slabs along z), the slabs are then written as they
+    #       are predicted and the whole label map is never in memory.
 
-    # You can also place and load additional files in the resources folder
-    # with open(resources / "some_resource.txt", "r") as f:
-    #     print(f.read())
+    # NOTE: TOPCOW_TTA=<n> runs this function on up to n flipped views of the image,
+    #       see tta_utilities.py. With TTA_BATCHED, the input of your TRACK is then
+    #       a list of views and you return a list of label maps, one per view.
+
+    # NOTE: TOPCOW_POSTPROCESS=1 keeps the largest connected component of each label
+    #       of your prediction, see postprocessing_utilities.py.
+
+    #######################################################################################
+
+    # load and initialize your model in load_your_model()
+    model = load_your_model()
 
     # For now, let us set make bogus predictions
+    # With TOPCOW_TTA and TTA_BATCHED, one prediction per flipped view
+    track_input = mr_input_array if TRACK == "MR" else ct_input_array
+    if isinstance(track_input, list):
+        return [np.ones(view.shape, dtype=np.uint8) for view in track_input]
+
     output_shape = tuple()
     if TRACK == "CT":
         output_shape = ct_input_array.shape
@@ -83,6 +173,7 @@ def your_segmentation_algorithm(
     else:
         raise ValueError("Invalid TRACK chosen. Choose either 'MR' or 'CT'.")
 
-    pred_array = np.ones(output_shape)
+    # NOTE: uint8 holds all labels, float64 (the default of np.ones) needs 8x the memory
+    pred_array = np.ones(output_shape, dtype=np.uint8)
 
     return pred_array
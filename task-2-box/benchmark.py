@@ -0,0 +1,175 @@
+"""
+Benchmark of the task 2 pipeline on synthetic MRA/CTA volumes of clinical size.
+
+Generates a case with an int16 CTA (512x512x300) and MRA (512x512x180) with realistic
+spacing, and times loading the images (`load_image_file_as_array`), your algorithm
+(`your_detection_algorithm`) and writing its output (`write_json_file`).
+The results are written as JSON, so that regressions can be compared between commits:
+
+    python benchmark.py                      # writes benchmark-results/<commit>.json
+    python benchmark.py --scale 0.5          # half the size along each axis, for a quick run
+    python benchmark.py --compare benchmark-results/<other commit>.json
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import SimpleITK as sitk
+from inference import load_image_file_as_array, read_case, write_json_file
+from your_algorithm import your_detection_algorithm
+
+# shape in (x,y,z) and spacing in mm of the synthetic volumes
+MODALITIES = {
+    "head-ct-angio": {"shape": (512, 512, 300), "spacing": (0.45, 0.45, 0.7)},
+    "head-mr-angio": {"shape": (512, 512, 180), "spacing": (0.3, 0.3, 0.6)},
+}
+
+
+def synthetic_volume(*, modality, shape, seed=0):
+    """
+    int16 volume in (x,y,z) with a noisy head-like background and bright tube-like vessels.
+    """
+    rng = np.random.default_rng(seed)
+    x, y, z = np.ogrid[: shape[0], : shape[1], : shape[2]]
+    centre = np.array(shape) / 2
+    head = ((x - centre[0]) / (0.45 * shape[0])) ** 2 + (
+        (y - centre[1]) / (0.45 * shape[1])
+    ) ** 2 + ((z - centre[2]) / (0.6 * shape[2])) ** 2 < 1
+
+    if modality == "head-ct-angio":
+        # Hounsfield units: air outside, soft tissue inside, contrast-filled vessels
+        volume = np.where(head, 40, -1000).astype(np.int16)
+        vessel_value, noise = 350, 20
+    else:
+        volume = np.where(head, 150, 0).astype(np.int16)
+        vessel_value, noise = 900, 30
+    # add the noise slab by slab, a float64 noise volume of this size would need >600 MB
+    for z in range(shape[2]):
+        volume[:, :, z] += rng.normal(0, noise, size=shape[:2]).astype(np.int16)
+
+    upper = np.array(shape) - 4
+    for _ in range(20):
+        start = centre + rng.normal(0, 0.1, size=3) * shape
+        direction = rng.normal(size=3)
+        direction /= np.linalg.norm(direction)
+        for step in range(0, int(0.3 * max(shape))):
+            i, j, k = np.clip(start + step * direction, 0, upper).astype(int)
+            volume[i : i + 3, j : j + 3, k : k + 3] = vessel_value
+    return volume
+
+
+def write_synthetic_case(*, case_path, scale=1.0):
+    for modality, spec in MODALITIES.items():
+        shape = tuple(max(8, int(round(s * scale))) for s in spec["shape"])
+        volume = synthetic_volume(modality=modality, shape=shape)
+        img = sitk.GetImageFromArray(volume.transpose((2, 1, 0)))
+        img.SetSpacing(spec["spacing"])
+        location = case_path / "images" / modality
+        location.mkdir(parents=True, exist_ok=True)
+        sitk.WriteImage(img, location / "synthetic.mha", useCompression=True)
+
+
+def timed(function, *, repeats):
+    # best of `repeats` runs, together with the result of the last run
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    return min(seconds), result
+
+
+def run_benchmark(*, scale=1.0, repeats=3):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        case_path = Path(tmp) / "input"
+        output_path = Path(tmp) / "output"
+        write_synthetic_case(case_path=case_path, scale=scale)
+        output_path.mkdir()
+
+        for modality in MODALITIES:
+            location = case_path / "images" / modality
+            seconds, array = timed(
+                lambda: load_image_file_as_array(location=location), repeats=repeats
+            )
+            results[f"load_image_file_as_array[{modality}]"] = {
+                "seconds": seconds,
+                "shape": list(array.shape),
+                "dtype": str(array.dtype),
+            }
+
+        def predict():
+            # the same lazy inputs as in run(), so decoding is part of the prediction
+            mr_input_array, ct_input_array = read_case(input_path=case_path)
+            return your_detection_algorithm(
+                mr_input_array=mr_input_array, ct_input_array=ct_input_array
+            )
+
+        seconds, pred_dict = timed(predict, repeats=repeats)
+        results["your_detection_algorithm"] = {"seconds": seconds}
+
+        seconds, _ = timed(
+            lambda: write_json_file(content=pred_dict, output_folder=output_path),
+            repeats=repeats,
+        )
+        results["write_json_file"] = {"seconds": seconds}
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="scale of the volume size"
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", type=Path, help="JSON file to write the results to")
+    parser.add_argument("--compare", type=Path, help="JSON results of an earlier run")
+    args = parser.parse_args()
+
+    commit = _git_commit()
+    report = {
+        "task": "task-2-box",
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "scale": args.scale,
+        "repeats": args.repeats,
+        "results": run_benchmark(scale=args.scale, repeats=args.repeats),
+    }
+
+    output = args.output or Path("benchmark-results") / f"{commit}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        f.write(json.dumps(report, indent=4))
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    for name, result in report["results"].items():
+        line = f"{name:<50} {result['seconds']:8.3f}s"
+        if name in baseline:
+            line += (
+                f"  ({result['seconds'] / baseline[name]['seconds']:.2f}x of baseline)"
+            )
+        print(line)
+    print(f"Wrote the results to {output}")
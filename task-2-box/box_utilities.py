@@ -0,0 +1,103 @@
+"""
+Bounding box of a label map, vessel mask or thresholded image, in the output form of task 2.
+
+    from box_utilities import bounding_box
+
+    pred_dict = bounding_box(label_map, margin=2)                # nonzero voxels
+    pred_dict = bounding_box(ct_input_array, threshold=150, stride=4)  # bright voxels
+
+The box is found with axis projections (`np.any`) and the first/last nonzero index
+instead of listing all foreground voxels. With `stride` > 1 a strided (downsampled) view
+is searched first and only the region around its box is searched at full resolution.
+"""
+
+import numpy as np
+
+
+def _extent(projection):
+    # first and one past the last nonzero index of a 1D projection, None if all zero
+    nonzero = np.flatnonzero(projection)
+    if len(nonzero) == 0:
+        return None
+    return int(nonzero[0]), int(nonzero[-1]) + 1
+
+
+def tight_box(mask):
+    """
+    Exact bounding box of the nonzero voxels of a 3D array.
+    The array is read once for a 2D projection, then only the box in (x,y) for the third axis.
+    returns:
+        list of (start, stop) per axis, None if there is no nonzero voxel
+    """
+    mask = np.asarray(mask)
+    projection = np.any(mask, axis=2)
+    x = _extent(np.any(projection, axis=1))
+    if x is None:
+        return None
+    y = _extent(np.any(projection, axis=0))
+    z = _extent(np.any(mask[x[0] : x[1], y[0] : y[1]], axis=(0, 1)))
+    return [x, y, z]
+
+
+def bounding_box(volume, *, threshold=None, margin=0, stride=1):
+    """
+    Bounding box of the foreground of a volume in (x,y,z) voxel coordinates.
+    args:
+        volume: np.array - in (x,y,z), e.g. a label map, a mask or ct_input_array
+        threshold: number - foreground is `volume > threshold`, by default the nonzero voxels
+        margin: int or list of 3 int - voxels added on each side, the box is clamped to the image
+        stride: int - search a strided view first (coarse-to-fine), 1 searches every voxel
+            NOTE: foreground smaller than `stride` voxels outside of the coarse box
+            can be missed, use stride=1 for an exact box
+    returns:
+        dict - {"size": [x, y, z], "location": [x, y, z]} as Python int lists,
+            None if there is no foreground
+    """
+    shape = tuple(volume.shape)
+    margins = [margin] * 3 if np.isscalar(margin) else list(margin)
+
+    def foreground_box(region):
+        # tight box of the foreground within `region`, in image coordinates
+        part = np.asarray(volume[tuple(slice(start, stop) for start, stop in region)])
+        box = tight_box(part if threshold is None else part > threshold)
+        if box is None:
+            return None
+        return [
+            (start + offset, stop + offset)
+            for (start, stop), (offset, _) in zip(box, region)
+        ]
+
+    region = [(0, n) for n in shape]
+    if stride > 1:
+        coarse = np.asarray(volume[::stride, ::stride, ::stride])
+        box = tight_box(coarse if threshold is None else coarse > threshold)
+        if box is not None:
+            # one stride around the coarse box, where the real border must lie
+            region = [
+                (max(0, (start - 1) * stride), min(n, stop * stride + 1))
+                for (start, stop), n in zip(box, shape)
+            ]
+
+    box = foreground_box(region)
+    while box is not None:
+        # grow the region where the foreground touches its border, until it does not
+        grown = [
+            (
+                max(0, start - stride) if box_start == start else start,
+                min(n, stop + stride) if box_stop == stop else stop,
+            )
+            for (start, stop), (box_start, box_stop), n in zip(region, box, shape)
+        ]
+        if grown == region:
+            break
+        region = grown
+        box = foreground_box(region)
+    if box is None:
+        return None
+
+    location = [max(0, start - m) for (start, _), m in zip(box, margins)]
+    stop = [min(n, stop + m) for (_, stop), m, n in zip(box, margins, shape)]
+    return {
+        "size": [int(b - a) for a, b in zip(location, stop)],
+        "location": [int(a) for a in location],
+    }
@@ -0,0 +1,154 @@
+"""
+CPU budget of the container, from its cgroup quota.
+
+A container on grand-challenge sees all cores of the host (os.cpu_count), but may only
+use the CPU time of its quota, e.g. `docker run --cpus 4`. SimpleITK, BLAS/OpenMP
+(numpy, torch) and the output compression size their thread pools to the cores they see,
+so with a quota they run many more threads than they get CPUs for, and the threads
+wait for each other instead of working.
+
+inference.py hence sizes all thread pools to the CPUs of the quota: when it is run as
+a script, `configure_threads` sets OMP_NUM_THREADS, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS
+etc. before numpy is imported. Importing this module (or inference.py, e.g. from
+evaluate.py) changes nothing. The number of threads can be set with the environment
+variable TOPCOW_THREADS instead.
+
+Both cgroup v1 (cpu.cfs_quota_us) and v2 (cpu.max) are read.
+NOTE: no numpy here, as this module is imported before numpy.
+"""
+
+import math
+import os
+import sys
+from pathlib import Path
+
+THREADS_ENV = "TOPCOW_THREADS"
+
+# Thread counts of SimpleITK, BLAS and OpenMP, read once when the libraries are loaded
+THREAD_POOL_ENVS = (
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+
+
+def _cgroup_paths():
+    """
+    returns:
+        dict - cgroup path of this process by controller ("" for cgroup v2)
+    """
+    paths = {}
+    try:
+        lines = Path("/proc/self/cgroup").read_text().splitlines()
+    except OSError:
+        return paths
+    for line in lines:
+        _, controllers, path = line.split(":", 2)
+        for controller in controllers.split(","):
+            paths[controller] = path
+        paths[controllers] = path
+    return paths
+
+
+def _read_cgroup_file(controller, name):
+    """
+    Reads a file of the cgroup of this process, or of the root cgroup as seen
+    from within the container (with a cgroup namespace, that is its own cgroup).
+    returns:
+        str - the content, None if there is no such file
+    """
+    path = _cgroup_paths().get(controller, "/").lstrip("/")
+    folder = CGROUP_ROOT / controller if controller else CGROUP_ROOT
+    for candidate in (folder / path / name, folder / name):
+        try:
+            return candidate.read_text().strip()
+        except OSError:
+            continue
+    return None
+
+
+def cgroup_cpu_quota():
+    """
+    returns:
+        float - CPUs of the cgroup quota, e.g. 2.5 for `--cpus 2.5`, None without quota
+    """
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    cpu_max = _read_cgroup_file("", "cpu.max")
+    if cpu_max is not None:
+        quota, period = cpu_max.split()
+        return None if quota == "max" else int(quota) / int(period)
+    # cgroup v1: a quota of -1 is no quota
+    quota = _read_cgroup_file("cpu", "cpu.cfs_quota_us")
+    period = _read_cgroup_file("cpu", "cpu.cfs_period_us")
+    if quota is None or period is None or int(quota) <= 0:
+        return None
+    return int(quota) / int(period)
+
+
+def cgroup_cpu_throttled_seconds():
+    """
+    returns:
+        float - total time the cgroup was throttled for exceeding its CPU quota,
+            None without cpu.stat
+    """
+    stat = _read_cgroup_file("", "cpu.stat")
+    if stat is not None and "throttled_usec" in stat:
+        scale, key = 1e-6, "throttled_usec"
+    else:
+        stat = _read_cgroup_file("cpu", "cpu.stat")
+        scale, key = 1e-9, "throttled_time"
+    if stat is None:
+        return None
+    values = dict(line.split() for line in stat.splitlines())
+    return int(values[key]) * scale if key in values else None
+
+
+def available_cpus():
+    """
+    returns:
+        int - CPUs this process can use: TOPCOW_THREADS if set, otherwise the CPUs it may
+            run on, at most the cgroup quota rounded up
+    """
+    value = os.environ.get(THREADS_ENV, "").strip()
+    if value:
+        return max(1, int(value))
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+def configure_threads():
+    """
+    Sets the thread counts of SimpleITK, BLAS and OpenMP to `available_cpus`, unless
+    they are set, and those of SimpleITK and torch right away if they are imported.
+    Logs the budget.
+    NOTE: call it before numpy is imported, BLAS and OpenMP only read their thread
+    counts when they are loaded
+    returns:
+        int - number of threads
+    """
+    threads = available_cpus()
+    for name in THREAD_POOL_ENVS:
+        os.environ.setdefault(name, str(threads))
+    if "SimpleITK" in sys.modules:
+        sys.modules["SimpleITK"].ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(threads)
+
+    quota = cgroup_cpu_quota()
+    print(
+        f"CPU budget: {threads} threads "
+        f"({os.cpu_count()} CPUs, cgroup quota "
+        f"{'none' if quota is None else f'{quota:g} CPUs'})"
+    )
+    return threads
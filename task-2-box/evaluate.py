@@ -0,0 +1,132 @@
+"""
+Evaluation of task 2 bounding boxes against the ground truth, e.g. ./test/expected_output.
+
+    python evaluate.py                     # ./test/output against ./test/expected_output
+    python evaluate.py --predictions <output_dir> --ground-truth <gt_dir> --json scores.json
+
+With folders of cases, e.g. the output of `python inference.py --batch`,
+<output_dir>/<case>/cow-roi.json is compared with <gt_dir>/<case>/cow-roi.json.
+The score of a case is the intersection over union (IoU) of the two boxes in voxels.
+A single case may also be given as the two JSON files, it is named after the
+ground-truth file.
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+
+OUTPUT_FILE = "cow-roi.json"
+
+
+def box_iou(prediction, ground_truth):
+    """
+    Intersection over union of two boxes in the form {"size": [x, y, z], "location": [x, y, z]}.
+    returns:
+        float - between 0 (no overlap) and 1 (the same box)
+    """
+    intersection = 1
+    for location_a, size_a, location_b, size_b in zip(
+        prediction["location"],
+        prediction["size"],
+        ground_truth["location"],
+        ground_truth["size"],
+    ):
+        start = max(location_a, location_b)
+        stop = min(location_a + size_a, location_b + size_b)
+        intersection *= max(stop - start, 0)
+    union = (
+        int(np.prod(prediction["size"]))
+        + int(np.prod(ground_truth["size"]))
+        - intersection
+    )
+    return intersection / union if union else 1.0
+
+
+def _output_file(path):
+    # the file itself, or the output file of inference.py in the folder
+    return path if path.is_file() else path / OUTPUT_FILE
+
+
+def find_cases(*, predictions_path, ground_truth_path):
+    """
+    Pairs the predictions with the ground truth, a single case if the ground-truth
+    path is the box file or a folder that holds it, named after that file,
+    otherwise one case per subfolder, named after the subfolder.
+    returns:
+        dict - (prediction file, ground-truth file) by case name,
+            the prediction file is None if it is missing
+    """
+    if ground_truth_path.is_file() or (ground_truth_path / OUTPUT_FILE).is_file():
+        ground_truth = _output_file(ground_truth_path)
+        cases = {ground_truth.stem: (predictions_path, ground_truth_path)}
+    else:
+        cases = {
+            p.name: (predictions_path / p.name, p)
+            for p in sorted(ground_truth_path.iterdir())
+            if (p / OUTPUT_FILE).is_file()
+        }
+    return {
+        name: (
+            _output_file(prediction) if _output_file(prediction).is_file() else None,
+            _output_file(ground_truth),
+        )
+        for name, (prediction, ground_truth) in cases.items()
+    }
+
+
+def evaluate(*, predictions_path, ground_truth_path):
+    """
+    returns:
+        dict - the IoU of every case, their mean and the cases without prediction
+    """
+    cases = find_cases(
+        predictions_path=predictions_path, ground_truth_path=ground_truth_path
+    )
+    # NOTE: reading a box takes microseconds, so unlike the label maps of task 1
+    # the cases are not worth spreading over processes
+    scores = {
+        name: box_iou(
+            json.loads(prediction.read_text()), json.loads(ground_truth.read_text())
+        )
+        for name, (prediction, ground_truth) in cases.items()
+        if prediction is not None
+    }
+    missing = [name for name, (prediction, _) in cases.items() if prediction is None]
+    mean = float(np.mean(list(scores.values()))) if scores else None
+    return {"cases": scores, "mean": mean, "missing": missing}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--predictions", type=Path, default=Path("./test/output"))
+    parser.add_argument(
+        "--ground-truth", type=Path, default=Path("./test/expected_output")
+    )
+    parser.add_argument("--json", type=Path, help="also write the scores as JSON")
+    args = parser.parse_args()
+
+    results = evaluate(
+        predictions_path=args.predictions, ground_truth_path=args.ground_truth
+    )
+
+    for name, value in results["cases"].items():
+        print(f"{name:24}{value:>8.4f}")
+    mean = results["mean"]
+    print(
+        f"Mean IoU of {len(results['cases'])} case(s): "
+        f"{'-' if mean is None else f'{mean:.4f}'}"
+    )
+    if results["missing"]:
+        print(
+            f"[WARNING] No prediction for {len(results['missing'])} case(s): "
+            f"{', '.join(results['missing'])}"
+        )
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=4))
+    return 1 if results["missing"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
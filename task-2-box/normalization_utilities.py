@@ -0,0 +1,269 @@
+"""
+Intensity normalization of the input CTA/MRA, with statistics from a histogram.
+
+Models are usually trained on clipped and z-scored intensities:
+CTA in a fixed window of Hounsfield units, MRA (which has no absolute scale) between
+two percentiles. `np.percentile` sorts a copy of the whole volume for that.
+The input images are integer-valued, so here the statistics come from a histogram
+counted with `np.bincount`, slab by slab along z, in a single pass:
+
+    from normalization_utilities import normalize_intensities
+
+    image = normalize_intensities(mr_input_array, modality="MR")  # float32 in (x,y,z)
+
+The percentiles are exact (the same as `np.percentile`), the statistics are cached
+per input image, and the normalization is done in place on a single float32 buffer.
+
+The mean and standard deviation are those of the head, not of the whole volume: in an
+MRA most voxels are dark background, which would dominate the z-score. The foreground
+is the voxels above an Otsu threshold of the histogram, also found without a pass over
+the image. The CT window already starts above the air, there it is the whole window.
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+
+# Hounsfield window of CTA: soft tissue up to the contrast-filled vessels,
+# most of the bone is clipped
+CT_WINDOW_HU = (-100.0, 900.0)
+
+# Percentiles of MRA, the inflowing blood is the brightest signal of a TOF-MRA
+MR_PERCENTILES = (0.5, 99.5)
+
+# Slices per slab, the memory of the temporaries is that of a few slabs
+CHUNK_SLICES = 16
+
+# A histogram with more bins than this is not worth it, e.g. for int32 with outliers
+MAX_BINS = 1 << 24
+
+
+class IntensityHistogram:
+    """
+    Histogram of integer intensities with bins of width 1, filled chunk by chunk:
+
+        histogram = IntensityHistogram()
+        for slab in slabs:
+            histogram.update(slab)
+        low, high = histogram.percentile([0.5, 99.5])
+
+    Float intensities (e.g. after resampling) are rounded to integers.
+    """
+
+    def __init__(self):
+        # counts[i] is the number of voxels of intensity offset + i
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    @property
+    def values(self):
+        return np.arange(self.offset, self.offset + len(self.counts), dtype=np.float64)
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk)
+        if chunk.size == 0:
+            return
+        if chunk.dtype.kind == "f":
+            assert np.isfinite(chunk).all(), "Intensities must be finite!"
+            chunk = np.rint(chunk)
+        low, high = int(chunk.min()), int(chunk.max())
+        if len(self.counts) == 0:
+            self.offset = low
+        start, stop = min(low, self.offset), max(
+            high + 1, self.offset + len(self.counts)
+        )
+        if stop - start > MAX_BINS:
+            raise ValueError(
+                f"Intensities from {start} to {stop - 1} are too many for a histogram"
+            )
+        if start < self.offset or stop > self.offset + len(self.counts):
+            # grow the histogram to the new range
+            counts = np.zeros(stop - start, dtype=np.int64)
+            counts[self.offset - start : self.offset - start + len(self.counts)] = (
+                self.counts
+            )
+            self.offset, self.counts = start, counts
+
+        # NOTE: ravel(order="K") does not copy a contiguous slab, e.g. a z-slab of an
+        # (x,y,z) view of a SimpleITK array
+        indices = chunk.ravel(order="K").astype(np.intp) - self.offset
+        self.counts += np.bincount(indices, minlength=len(self.counts))
+
+    def percentile(self, q):
+        """
+        Exact percentiles, the same as `np.percentile` (linear interpolation).
+        args:
+            q: float or sequence of float - percentiles between 0 and 100
+        returns:
+            float or np.array
+        """
+        assert self.count > 0, "The histogram is empty!"
+        cumulative = np.cumsum(self.counts)
+        ranks = np.asarray(q, dtype=np.float64) / 100 * (cumulative[-1] - 1)
+        below = np.floor(ranks)
+
+        def value(rank):
+            # intensity of the voxel at a 0-based rank in sorted order
+            return self.offset + np.searchsorted(cumulative, rank, side="right")
+
+        lower = value(below)
+        upper = value(np.minimum(below + 1, cumulative[-1] - 1))
+        return lower + (ranks - below) * (upper - lower)
+
+    def mean_std(self, *, low=-np.inf, high=np.inf):
+        """
+        Mean and standard deviation of the intensities between `low` and `high`.
+        returns:
+            tuple - (mean, std), (nan, nan) if there are no such intensities
+        """
+        values = self.values
+        counts = np.where((values >= low) & (values <= high), self.counts, 0)
+        n = counts.sum()
+        if n == 0:
+            return float("nan"), float("nan")
+        mean = (counts * values).sum() / n
+        std = np.sqrt((counts * (values - mean) ** 2).sum() / n)
+        return float(mean), float(std)
+
+    def otsu_threshold(self, *, low=-np.inf, high=np.inf):
+        """
+        Otsu threshold of the intensities between `low` and `high`, i.e. the intensity
+        that splits them into the two classes of the largest between-class variance.
+        returns:
+            float - the lowest intensity of the upper class, `low` if there are not
+                two distinct intensities in the range
+        """
+        values = self.values
+        inside = (values >= low) & (values <= high)
+        values, counts = values[inside], self.counts[inside].astype(np.float64)
+        if np.count_nonzero(counts) < 2:
+            return float(low)
+        # weight and intensity sum of the lower class, thresholds between the bins
+        weight = np.cumsum(counts)[:-1]
+        total = np.cumsum(counts * values)[:-1]
+        upper_weight = counts.sum() - weight
+        upper_total = (counts * values).sum() - total
+        with np.errstate(divide="ignore", invalid="ignore"):
+            variance = (
+                weight
+                * upper_weight
+                * (total / weight - upper_total / upper_weight) ** 2
+            )
+        variance[(weight == 0) | (upper_weight == 0)] = -1
+        return float(values[np.argmax(variance) + 1])
+
+
+def intensity_histogram(volume, *, chunk_slices=CHUNK_SLICES):
+    """
+    Histogram of a volume in (x,y,z), counted slab by slab along z.
+    returns:
+        IntensityHistogram
+    """
+    histogram = IntensityHistogram()
+    for z in range(0, volume.shape[2], chunk_slices):
+        histogram.update(volume[:, :, z : z + chunk_slices])
+    return histogram
+
+
+class IntensityStatistics(NamedTuple):
+    """
+    Clipping range and the mean and standard deviation of the foreground voxels
+    within it, i.e. those from `foreground` to `high`.
+    """
+
+    low: float
+    high: float
+    foreground: float
+    mean: float
+    std: float
+
+
+# Statistics of the input images of this case, keyed by their input folder,
+# see `clear_statistics_cache`
+_statistics_cache = {}
+
+
+def clear_statistics_cache():
+    _statistics_cache.clear()
+
+
+def intensity_statistics(volume, *, modality, chunk_slices=CHUNK_SLICES):
+    """
+    Normalization statistics of a head CTA/MRA, from its histogram.
+    CT: the CT_WINDOW_HU window, MR: the MR_PERCENTILES of all voxels.
+    The mean and standard deviation are those of the foreground: CT the whole window,
+    MR the voxels above the Otsu threshold within the percentiles, not the background.
+    Cached for the input images of inference.py (LazyImageArray), e.g. if your ROI
+    and your main algorithm both normalize the same image.
+    args:
+        volume: np.array - image in (x,y,z), e.g. mr_input_array
+        modality: str - "MR" or "CT"
+    returns:
+        IntensityStatistics
+    """
+    if modality not in ("MR", "CT"):
+        raise ValueError(f"Invalid modality {modality!r}. Choose either 'MR' or 'CT'.")
+    location = getattr(volume, "location", None)
+    key = (str(location), modality, tuple(volume.shape))
+    if location is not None and key in _statistics_cache:
+        return _statistics_cache[key]
+
+    histogram = intensity_histogram(volume, chunk_slices=chunk_slices)
+    if modality == "CT":
+        low, high = CT_WINDOW_HU
+        foreground = low
+    else:
+        low, high = (float(p) for p in histogram.percentile(MR_PERCENTILES))
+        foreground = histogram.otsu_threshold(low=low, high=high)
+    mean, std = histogram.mean_std(low=foreground, high=high)
+    if np.isnan(mean):
+        # nothing within the range, map it to [-1, 1]
+        mean, std = (low + high) / 2, (high - low) / 2
+    statistics = IntensityStatistics(
+        low=low, high=high, foreground=foreground, mean=mean, std=std
+    )
+    if location is not None:
+        _statistics_cache[key] = statistics
+    return statistics
+
+
+def normalize_intensities(
+    volume, *, modality, statistics=None, out=None, chunk_slices=CHUNK_SLICES
+):
+    """
+    Clips a head CTA/MRA to its range and z-scores it with the mean and standard
+    deviation of the foreground within the range, slab by slab into one float32 buffer.
+    args:
+        volume: np.array - image in (x,y,z), e.g. mr_input_array
+        modality: str - "MR" or "CT"
+        statistics: IntensityStatistics - by default `intensity_statistics` of `volume`
+        out: np.array - optional float32 buffer of the shape of `volume` to write into,
+            may be `volume` itself if that is a float32 array
+    returns:
+        np.array - float32 image in (x,y,z), Fortran-ordered like the input arrays
+            of inference.py unless `out` is given
+    """
+    if statistics is None:
+        statistics = intensity_statistics(
+            volume, modality=modality, chunk_slices=chunk_slices
+        )
+    if out is None:
+        # NOTE: Fortran order, so that a z-slab is contiguous
+        out = np.empty(tuple(volume.shape), dtype=np.float32, order="F")
+    assert out.dtype == np.float32 and out.shape == tuple(
+        volume.shape
+    ), "out must be a float32 array of the shape of the volume!"
+    # a flat image has no spread, then only the mean is subtracted
+    scale = 1 / statistics.std if statistics.std > 0 else 1.0
+
+    for z in range(0, volume.shape[2], chunk_slices):
+        slab = out[:, :, z : z + chunk_slices]
+        slab[...] = volume[:, :, z : z + chunk_slices]
+        np.clip(slab, statistics.low, statistics.high, out=slab)
+        slab -= statistics.mean
+        slab *= scale
+    return out
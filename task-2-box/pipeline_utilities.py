@@ -0,0 +1,114 @@
+"""
+Bounded producer/consumer pipeline for running many cases, used by the batch mode of inference.py.
+
+While case N is predicted in the calling thread, case N+1 is already decoded and
+case N-1 is still compressed and written in background threads.
+Reading and writing images with SimpleITK releases the GIL, so threads are enough
+to overlap them with the prediction.
+"""
+
+import time
+from collections import deque
+
+
+def run_pipeline(*, items, read, predict, write, prefetch=1, write_behind=1):
+    """
+    Runs read -> predict -> write for every item, overlapping the stages across items.
+    args:
+        items: list - e.g. the case folders
+        read: callable(item) -> inputs for `predict`
+        predict: callable(inputs) -> prediction, always called in the calling thread
+        write: callable(item, prediction) -> None
+        prefetch: int - how many items are read ahead, 0 reads in the calling thread
+        write_behind: int - how many writes may be in flight, 0 writes in the calling thread
+            NOTE: every prefetched input and pending prediction is held in memory,
+            so large depths need (prefetch + write_behind) times the memory of a case
+    returns:
+        list of dict - per item: the wall time of each stage, the status and the error if any
+    """
+    # NOTE: imported here, so it does not slow down the start-up of every run
+    from concurrent.futures import ThreadPoolExecutor
+
+    records = [{"status": "ok"} for _ in items]
+    read_pool = ThreadPoolExecutor(
+        max_workers=max(prefetch, 1), thread_name_prefix="read"
+    )
+    write_pool = ThreadPoolExecutor(
+        max_workers=max(write_behind, 1), thread_name_prefix="write"
+    )
+    pending_reads = deque()
+    pending_writes = deque()
+    next_items = iter(enumerate(items))
+
+    def timed(function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        return result, time.perf_counter() - start
+
+    def fail(index, stage, error):
+        print(f"[FAIL] {stage} of {items[index]} failed: {error!r}")
+        records[index]["status"] = "failed"
+        records[index]["error"] = f"{stage}: {error!r}"
+
+    def submit_read():
+        index, item = next(next_items, (None, None))
+        if index is not None:
+            pending_reads.append((index, read_pool.submit(timed, read, item)))
+
+    def finish_oldest_write():
+        index, future = pending_writes.popleft()
+        try:
+            _, records[index]["saving_seconds"] = future.result()
+        except Exception as e:
+            fail(index, "saving", e)
+
+    try:
+        # `prefetch` items are read in the background ahead of the prediction
+        for _ in range(prefetch):
+            submit_read()
+
+        for index, item in enumerate(items):
+            record = records[index]
+            try:
+                if prefetch > 0:
+                    submit_read()
+                    _, future = pending_reads.popleft()
+                    start = time.perf_counter()
+                    inputs, record["reading_seconds"] = future.result()
+                    # time the prediction stage sat idle waiting for this read
+                    record["waiting_seconds"] = time.perf_counter() - start
+                else:
+                    inputs, record["reading_seconds"] = timed(read, item)
+            except Exception as e:
+                fail(index, "reading", e)
+                continue
+
+            try:
+                prediction, record["prediction_seconds"] = timed(predict, inputs)
+            except Exception as e:
+                fail(index, "prediction", e)
+                continue
+            # drop our reference, so a prefetched input is freed as soon as possible
+            del inputs
+
+            if write_behind > 0:
+                # backpressure: wait for the oldest write if the queue is full
+                while len(pending_writes) >= write_behind:
+                    finish_oldest_write()
+                pending_writes.append(
+                    (index, write_pool.submit(timed, write, item, prediction))
+                )
+            else:
+                try:
+                    _, record["saving_seconds"] = timed(write, item, prediction)
+                except Exception as e:
+                    fail(index, "saving", e)
+            del prediction
+
+        while pending_writes:
+            finish_oldest_write()
+    finally:
+        read_pool.shutdown(wait=True, cancel_futures=True)
+        write_pool.shutdown(wait=True)
+
+    return records
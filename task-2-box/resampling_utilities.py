@@ -0,0 +1,226 @@
+"""
+Resampling of the input image to a fixed voxel spacing, and of the prediction back to the input grid.
+
+MRA and CTA come in very different voxel spacings, while models are usually trained
+at one spacing. With the environment variable TOPCOW_TARGET_SPACING (in mm, e.g. "0.5"
+or "0.5,0.5,0.8" in (x,y,z)), inference.py resamples the image of your TRACK to that
+spacing before your algorithm and maps the prediction back to the grid of the input image,
+so the output matches the input image voxel for voxel.
+A coarser spacing than that of the image also means fewer voxels to process.
+
+The resampled grid has the same direction as the input image and covers the same
+extent, centred on it: at 0.3 mm -> 1.2 mm the first target voxel covers the first four
+input voxels, its centre lies 0.45 mm after theirs. Voxels on the edge of one grid that
+the other grid misses by a fraction of a voxel (when the extent is not a multiple of the
+target spacing) get the value of the nearest voxel, so every input voxel gets a label back.
+The resampling itself is done by SimpleITK on all threads.
+"""
+
+import functools
+import os
+from typing import NamedTuple
+
+import numpy as np
+import SimpleITK as sitk
+
+TARGET_SPACING_ENV = "TOPCOW_TARGET_SPACING"
+
+
+def target_spacing_from_env():
+    """
+    returns:
+        tuple - target spacing in mm in (x,y,z), None if TOPCOW_TARGET_SPACING is not set
+    """
+    value = os.environ.get(TARGET_SPACING_ENV, "").strip()
+    if not value:
+        return None
+    spacing = tuple(float(v) for v in value.split(","))
+    if len(spacing) == 1:
+        spacing = spacing * 3
+    if len(spacing) != 3 or min(spacing) <= 0:
+        raise ValueError(
+            f"{TARGET_SPACING_ENV} must be one or three positive numbers, got {value!r}"
+        )
+    return spacing
+
+
+class ResamplingGrid(NamedTuple):
+    """
+    An input grid and the grid resampled to the target spacing, both in (x,y,z).
+    """
+
+    size: tuple
+    spacing: tuple
+    target_size: tuple
+    target_spacing: tuple
+
+    @property
+    def target_origin(self):
+        # centre of the first target voxel relative to that of the first input voxel,
+        # in mm along the image axes, so that the extents of both grids share their centre
+        return tuple(
+            (n - 1) * s / 2 - (m - 1) * t / 2
+            for n, s, m, t in zip(
+                self.size, self.spacing, self.target_size, self.target_spacing
+            )
+        )
+
+
+@functools.lru_cache(maxsize=64)
+def resampling_grid(*, size, spacing, target_spacing):
+    """
+    The grid at `target_spacing` that covers the same extent as the input grid.
+    Cached, as cases of the same scanner protocol share their grid.
+    """
+    size = tuple(int(n) for n in size)
+    spacing = tuple(float(s) for s in spacing)
+    target_spacing = tuple(float(s) for s in target_spacing)
+    target_size = tuple(
+        max(1, round(n * s / t)) for n, s, t in zip(size, spacing, target_spacing)
+    )
+    grid = ResamplingGrid(size, spacing, target_size, target_spacing)
+    # round-trip check: every input voxel is mapped back from a target voxel
+    assert all(
+        voxels.min() > 0 for voxels in _target_voxels(grid)
+    ), f"The target grid does not cover every voxel of the input grid {grid}!"
+    return grid
+
+
+@functools.lru_cache(maxsize=64)
+def _resample_filter(*, size, spacing, origin, interpolator, pixel_id):
+    # configured once per output grid, the images are placed with identity direction
+    # and the first input voxel at 0, both grids share their direction
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetSize([int(n) for n in size])
+    resampler.SetOutputSpacing(spacing)
+    resampler.SetOutputOrigin(origin)
+    # points just outside the other grid get its nearest voxel instead of 0
+    resampler.SetUseNearestNeighborExtrapolator(True)
+    resampler.SetInterpolator(interpolator)
+    resampler.SetOutputPixelType(pixel_id)
+    return resampler
+
+
+def _resample(
+    array,
+    *,
+    spacing,
+    origin,
+    size,
+    target_spacing,
+    target_origin,
+    interpolator,
+    pixel_id,
+):
+    # NOTE: SimpleITK npy axis ordering is (z,y,x), the transpose is a view
+    img = sitk.GetImageFromArray(np.ascontiguousarray(np.asarray(array).transpose()))
+    img.SetSpacing(spacing)
+    img.SetOrigin(origin)
+    resampler = _resample_filter(
+        size=size,
+        spacing=target_spacing,
+        origin=target_origin,
+        interpolator=interpolator,
+        pixel_id=pixel_id,
+    )
+    return sitk.GetArrayFromImage(resampler.Execute(img)).transpose()
+
+
+def resample_to_target(array, grid, *, interpolator=sitk.sitkLinear):
+    """
+    Resamples an image to the target spacing of `grid`.
+    args:
+        array: np.array - image in (x,y,z) on the input grid
+        grid: ResamplingGrid
+        interpolator: SimpleITK interpolator, e.g. sitk.sitkBSpline
+    returns:
+        np.array - float32 image in (x,y,z) of shape grid.target_size
+    """
+    assert tuple(array.shape) == grid.size, "The image must be on the input grid!"
+    return _resample(
+        array,
+        spacing=grid.spacing,
+        origin=(0.0, 0.0, 0.0),
+        size=grid.target_size,
+        target_spacing=grid.target_spacing,
+        target_origin=grid.target_origin,
+        interpolator=interpolator,
+        pixel_id=sitk.sitkFloat32,
+    )
+
+
+def resample_to_input(array, grid, *, interpolator=sitk.sitkNearestNeighbor):
+    """
+    Maps a prediction at the target spacing back to the input grid, e.g. a label map.
+    Every input voxel gets the value of the target voxel it lies in.
+    args:
+        array: np.array - in (x,y,z) of shape grid.target_size
+        grid: ResamplingGrid
+        interpolator: SimpleITK interpolator, keep nearest neighbour for label maps
+    returns:
+        np.array - in (x,y,z) of shape grid.size, with the dtype of `array`
+    """
+    assert (
+        tuple(array.shape) == grid.target_size
+    ), f"The prediction must have the resampled shape {grid.target_size}!"
+    array = np.asarray(array)
+    if array.dtype == bool:
+        array = array.view(np.uint8)
+    return _resample(
+        array,
+        spacing=grid.target_spacing,
+        origin=grid.target_origin,
+        size=grid.size,
+        target_spacing=grid.spacing,
+        target_origin=(0.0, 0.0, 0.0),
+        interpolator=interpolator,
+        pixel_id=sitk.sitkUnknown,  # same as the prediction
+    )
+
+
+@functools.lru_cache(maxsize=64)
+def _target_voxels(grid):
+    # per axis, 1 + the target voxel that each input voxel is mapped from by
+    # `resample_to_input` (0 would be a voxel outside of the target grid).
+    # The mapping is separable, so resampling an index ramp along each axis
+    # gives exactly the voxels SimpleITK picks, ties included.
+    lines = []
+    for axis in range(3):
+        shape = [1, 1, 1]
+        shape[axis] = grid.target_size[axis]
+        size = [1, 1, 1]
+        size[axis] = grid.size[axis]
+        ramp = np.arange(1, grid.target_size[axis] + 1, dtype=np.int32)
+        line_grid = grid._replace(size=tuple(size), target_size=tuple(shape))
+        lines.append(resample_to_input(ramp.reshape(shape), line_grid).reshape(-1))
+    return lines
+
+
+def box_to_input(box, grid):
+    """
+    Maps a bounding box at the target spacing back to the input grid.
+    The box covers exactly the input voxels that `resample_to_input` maps from the box,
+    but at least one voxel.
+    args:
+        box: dict - {"size": [x, y, z], "location": [x, y, z]} at the target spacing
+        grid: ResamplingGrid
+    returns:
+        dict - the box on the input grid, as Python int lists
+    """
+    location, size = [], []
+    for start, length, target_voxels in zip(
+        box["location"], box["size"], _target_voxels(grid)
+    ):
+        inside = np.flatnonzero(
+            (target_voxels > start) & (target_voxels <= start + length)
+        )
+        if len(inside) == 0:
+            # a thin box at a finer target spacing can lie in between input voxels,
+            # then it becomes the input voxel right after it
+            after = np.flatnonzero(target_voxels > start + length)
+            location.append(int(after[0]) if len(after) else len(target_voxels) - 1)
+            size.append(1)
+            continue
+        location.append(int(inside[0]))
+        size.append(int(inside[-1] + 1 - inside[0]))
+    return {"size": size, "location": location}
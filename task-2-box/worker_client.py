@@ -0,0 +1,197 @@
+"""
+Local stand-in for how grand-challenge runs the container, cold versus warm.
+
+Cold: one `python inference.py --input <case> --output <folder>` per case,
+    i.e. interpreter start-up, imports and model initialization every time
+    (the container start itself is not included).
+Warm: `python inference.py --serve` is started once and the same case is sent to it
+    over local HTTP, see worker_utilities.
+
+    python worker_client.py                           # ./test/input, 3 runs each
+    python worker_client.py --input <case> --repeats 5 --json results.json
+    python worker_client.py --url http://127.0.0.1:8765   # use a running worker
+
+Both modes run the same `run_case` of inference.py, and their outputs are compared.
+"""
+
+import argparse
+import filecmp
+import json
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _request(url, *, content=None, timeout=3600):
+    data = None if content is None else json.dumps(content).encode()
+    request = urllib.request.Request(
+        url, data=data, headers={"Content-Type": "application/json"}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        # failed cases come back as JSON too
+        return json.loads(e.read())
+
+
+def wait_until_ready(url, *, process=None, timeout=300):
+    """
+    Polls GET /health of a worker.
+    returns:
+        float - seconds until the worker was ready
+    """
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"The worker exited with code {process.returncode}")
+        try:
+            if _request(f"{url}/health", timeout=1)["status"] == "ready":
+                return time.perf_counter() - start
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.05)
+    raise TimeoutError(f"The worker at {url} was not ready after {timeout}s")
+
+
+def run_cold(*, input_path, output_path, verbose=False):
+    # a fresh process per case, like a fresh container per case,
+    # which also gets an existing (empty) /output
+    output_path.mkdir(parents=True)
+    start = time.perf_counter()
+    subprocess.run(
+        [
+            sys.executable,
+            "inference.py",
+            "--input",
+            str(input_path),
+            "--output",
+            str(output_path),
+        ],
+        check=True,
+        stdout=None if verbose else subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+def run_warm(*, url, input_path, output_path):
+    start = time.perf_counter()
+    response = _request(
+        f"{url}/cases",
+        content={"input": str(input_path), "output": str(output_path)},
+    )
+    if response["status"] != "ok":
+        raise RuntimeError(f"The worker failed: {response['error']}")
+    return time.perf_counter() - start
+
+
+def _output_files(folder):
+    # the timings of TOPCOW_PROFILE differ from run to run
+    return sorted(
+        p.relative_to(folder)
+        for p in folder.rglob("*")
+        if p.is_file() and p.name != "inference-profile.json"
+    )
+
+
+def _same_outputs(a, b):
+    files = _output_files(a)
+    return files == _output_files(b) and all(
+        filecmp.cmp(a / f, b / f, shallow=False) for f in files
+    )
+
+
+def _summary(seconds):
+    return {
+        "seconds": seconds,
+        "mean_seconds": sum(seconds) / len(seconds),
+        "min_seconds": min(seconds),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--input", type=Path, default=Path("./test/input"))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--url", help="use the worker running at URL instead of starting one"
+    )
+    parser.add_argument("--json", type=Path, help="also write the results as JSON")
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the output of inference.py"
+    )
+    args = parser.parse_args()
+    input_path = args.input.resolve()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+
+        print(f"Cold: {args.repeats} runs of inference.py on {input_path}")
+        cold = [
+            run_cold(
+                input_path=input_path,
+                output_path=tmp / f"cold-{i}",
+                verbose=args.verbose,
+            )
+            for i in range(args.repeats)
+        ]
+
+        worker = None
+        url = args.url
+        if url is None:
+            url = f"http://127.0.0.1:{_free_port()}"
+            worker = subprocess.Popen(
+                [sys.executable, "inference.py", "--serve", url.rsplit(":", 1)[1]],
+                stdout=None if args.verbose else subprocess.DEVNULL,
+            )
+        try:
+            ready_seconds = wait_until_ready(url, process=worker)
+            print(f"Warm: worker at {url} ready after {ready_seconds:.2f}s")
+            warm = [
+                run_warm(url=url, input_path=input_path, output_path=tmp / f"warm-{i}")
+                for i in range(args.repeats)
+            ]
+        finally:
+            if worker is not None:
+                worker.terminate()
+                worker.wait()
+
+        same_outputs = all(
+            _same_outputs(tmp / "cold-0", tmp / f"{mode}-{i}")
+            for mode in ("cold", "warm")
+            for i in range(args.repeats)
+        )
+
+    results = {
+        "input": str(input_path),
+        "cold": _summary(cold),
+        "warm": {"ready_seconds": ready_seconds, **_summary(warm)},
+        "speedup": (sum(cold) / len(cold)) / (sum(warm) / len(warm)),
+        "same_outputs": same_outputs,
+    }
+    print(f"{'':6}{'mean':>10}{'min':>10}  per case")
+    for mode in ("cold", "warm"):
+        print(
+            f"{mode:6}{results[mode]['mean_seconds']:>9.3f}s"
+            f"{results[mode]['min_seconds']:>9.3f}s"
+        )
+    print(f"Warm is {results['speedup']:.1f}x faster per case")
+    if not same_outputs:
+        print("[WARNING] The outputs of the cold and warm runs differ!")
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=4))
+    return 0 if same_outputs else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -33,8 +33,52 @@ This will start the inference and reads from ./test/input and outputs to ./test/
 To save the container and prep it for upload to Grand-Challenge.org you can call:
   ./save.sh
 """
+import functools
+
 import numpy as np
 
+#######################################################################################
+# TODO-1:
+# Choose your TRACK. Track is either 'MR' or 'CT'.
+TRACK = "MR"  # or 'CT'
+
+# Version of your model, part of the key of the result cache (TOPCOW_RESULT_CACHE)
+# NOTE: change it when your model weights change, see result_cache_utilities.py
+MODEL_VERSION = "1"
+# END OF TODO-1
+#######################################################################################
+
+
+@functools.cache
+def load_your_model():
+    """
+    Load and initialize your model here.
+    It is cached, so the model is only loaded once per process,
+    e.g. when many cases are run with `python inference.py --batch <cases_dir>`.
+    returns:
+        your model (None for this dummy algorithm)
+    """
+
+    # NOTE: import heavy libraries like torch here (or in your algorithm) and not at
+    #       the top of this file, so they are only imported when they are needed
+    # import torch
+
+    # model = ...
+    # device = ...
+
+    # You can also place and load additional files in the resources folder
+    # with open(resources / "some_resource.txt", "r") as f:
+    #     print(f.read())
+
+    # Model weights saved with `weight_store_utilities.save_weights` are memory-mapped,
+    # which is much faster and leaner than torch.load of a checkpoint
+    # from weight_store_utilities import load_weights, as_torch_state_dict
+    # weights = load_weights(resources / "weights")
+    # model.load_state_dict(as_torch_state_dict(weights), assign=True)
+
+    return None
+
+
 def your_detection_algorithm(*, mr_input_array: np.array, ct_input_array: np.array) -> dict:
     """
     This is an example of a prediction algorithm.
@@ -42,12 +86,13 @@ def your_detection_algorithm(*, mr_input_array: np.array, ct_input_array: np.arr
     args:
         mr_input_array: np.array - input image for MR track
         ct_input_array: np.array - input image for CT track
+    NOTE: the inputs are decoded lazily, only the one of your TRACK is read
     returns:
         dict - bounding box prediction in the form {"size": [x, y, z], "location": [x, y, z]}
     """
 
     #######################################################################################
-    # TODO: place your own prediction algorithm here.
+    # TODO-2: place your own prediction algorithm here.
     # You are free to remove everything! Just return to us a dictionary containing 
     # the bounding box prediction in the form {"size": [x, y, z], "location": [x, y, z]}.
     # You can use the input_head_mr_angiography and/or input_head_ct_angiography
@@ -57,18 +102,27 @@ def your_detection_algorithm(*, mr_input_array: np.array, ct_input_array: np.arr
     #              SimpleITK npy array axis order is (z,y,x).
     #              Then you might have to transpose this to (x,y,z)
 
-    #######################################################################################
+    # NOTE: normalize_intensities() in normalization_utilities.py clips and z-scores
+    #       the image of your TRACK (HU window for CT, percentiles for MR) into one
+    #       float32 array, with the statistics from a histogram instead of sorting.
 
-    # load and initialize your model here
-    # model = ...
-    # device = ...
+    # NOTE: If your model segments the CoW (or you threshold the vessels),
+    #       bounding_box() in box_utilities.py gives the box of the mask
+    #       in this output form, with Python int lists.
 
-    # You can also place and load additional files in the resources folder
-    # with open(resources / "some_resource.txt", "r") as f:
-    #     print(f.read())
+    #######################################################################################
+
+    # load and initialize your model in load_your_model()
+    model = load_your_model()
 
-    # For now, let us set make bogus predictions for the MR image
-    output_shape = mr_input_array.shape
+    # For now, let us set make bogus predictions for the image of the chosen track
+    output_shape = tuple()
+    if TRACK == "CT":
+        output_shape = ct_input_array.shape
+    elif TRACK == "MR":
+        output_shape = mr_input_array.shape
+    else:
+        raise ValueError("Invalid TRACK chosen. Choose either 'MR' or 'CT'.")
     
     pred_dict = {
         "size": [l // 2 for l in output_shape],
@@ -0,0 +1,124 @@
+"""
+Task 3 edge classification derived from a multiclass CoW segmentation (as in task 1).
+
+If your model segments the CoW vessels, the eight edges follow from which vessel
+labels are present and which of them touch each other, so no separate classifier is needed:
+
+    from adjacency_utilities import classify_edges
+
+    pred_dict = classify_edges(label_map)
+
+The contact graph of the labels is counted with NumPy in one pass per axis,
+by comparing the label map with itself shifted by one voxel.
+"""
+
+import numpy as np
+
+# TopCoW labels of the CoW vessels
+LABELS = {
+    1: "BA",
+    2: "R-PCA",
+    3: "L-PCA",
+    4: "R-ICA",
+    5: "R-MCA",
+    6: "L-ICA",
+    7: "L-MCA",
+    8: "R-Pcom",
+    9: "L-Pcom",
+    10: "Acom",
+    11: "R-ACA",
+    12: "L-ACA",
+    15: "3rd-A2",
+}
+NUM_LABELS = max(LABELS) + 1
+
+# One label: the edge is present if the label is.
+# Two labels: the edge is present if the two labels touch,
+# e.g. the A1 is the part of the ACA that starts at the ICA.
+EDGES = {
+    "anterior": {
+        "L-A1": (12, 6),
+        "Acom": (10,),
+        "3rd-A2": (15,),
+        "R-A1": (11, 4),
+    },
+    "posterior": {
+        "L-Pcom": (9,),
+        "L-P1": (3, 1),
+        "R-P1": (2, 1),
+        "R-Pcom": (8,),
+    },
+}
+
+
+def label_contacts(label_map, *, num_labels=NUM_LABELS):
+    """
+    Counts the voxels of each label and the contacts between the labels.
+    args:
+        label_map: np.array - integer label map, e.g. in (x,y,z)
+        num_labels: int - labels must be smaller than this
+    returns:
+        np.array - symmetric (num_labels, num_labels) int64 matrix, the diagonal holds
+            the number of voxels of each label, the other entries the number of
+            voxel faces where the two labels touch
+    """
+    label_map = np.asarray(label_map)
+    assert np.issubdtype(label_map.dtype, np.integer), "The label map must be integer!"
+    assert (
+        0 <= label_map.min() and label_map.max() < num_labels
+    ), f"Labels must be between 0 and {num_labels - 1}!"
+
+    # The counts do not depend on the axis order, so walk the axes in memory order:
+    # a (x,y,z) transpose of a SimpleITK array is then compared as fast as a C array
+    label_map = label_map.transpose(np.argsort(label_map.strides)[::-1])
+
+    pairs = np.zeros(num_labels * num_labels, dtype=np.int64)
+    for axis in range(label_map.ndim):
+        # neighbours along `axis`, both are views of the label map
+        lower = label_map[(slice(None),) * axis + (slice(None, -1),)]
+        upper = label_map[(slice(None),) * axis + (slice(1, None),)]
+        differ = lower != upper
+        pairs += np.bincount(
+            lower[differ].astype(np.intp) * num_labels + upper[differ],
+            minlength=num_labels * num_labels,
+        )
+
+    contacts = pairs.reshape(num_labels, num_labels)
+    contacts = contacts + contacts.T
+    # only the sparse foreground is counted, bincount of every voxel is slow
+    voxels = np.bincount(label_map[label_map != 0], minlength=num_labels)
+    voxels[0] = label_map.size - voxels[1:].sum()
+    np.fill_diagonal(contacts, voxels)
+    return contacts
+
+
+def edges_from_contacts(contacts, *, min_voxels=1, min_contacts=1):
+    """
+    Maps the contact graph onto the edge classification of task 3.
+    args:
+        contacts: np.array - see `label_contacts`
+        min_voxels: int - voxels a label needs to count as present
+        min_contacts: int - voxel faces two labels need to touch to count as connected
+    returns:
+        dict - CoW edge classification in the form of write_json_file,
+            { "anterior": { "L-A1": 1/0, ... }, "posterior": { "L-Pcom": 1/0, ... } }
+    """
+
+    def present(labels):
+        if len(labels) == 1:
+            return contacts[labels[0], labels[0]] >= min_voxels
+        return contacts[labels[0], labels[1]] >= min_contacts
+
+    return {
+        part: {edge: int(present(labels)) for edge, labels in edges.items()}
+        for part, edges in EDGES.items()
+    }
+
+
+def classify_edges(label_map, *, min_voxels=1, min_contacts=1):
+    """
+    Task 3 edge classification of a multiclass CoW segmentation, see `edges_from_contacts`.
+    """
+    return edges_from_contacts(
+        label_contacts(label_map), min_voxels=min_voxels, min_contacts=min_contacts
+    )
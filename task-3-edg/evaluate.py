@@ -0,0 +1,139 @@
+"""
+Evaluation of task 3 edge classifications against the ground truth, e.g. ./test/expected_output.
+
+    python evaluate.py                     # ./test/output against ./test/expected_output
+    python evaluate.py --predictions <output_dir> --ground-truth <gt_dir> --json scores.json
+
+With folders of cases, e.g. the output of `python inference.py --batch`,
+<output_dir>/<case>/cow-ant-post-classification.json is compared with
+<gt_dir>/<case>/cow-ant-post-classification.json.
+Reported are the accuracy of each of the eight edges over the cases, and for each case
+the fraction of its edges that are correct.
+A single case may also be given as the two JSON files, it is named after the
+ground-truth file.
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+
+OUTPUT_FILE = "cow-ant-post-classification.json"
+
+
+def edge_matches(prediction, ground_truth):
+    """
+    returns:
+        dict - for each edge ("anterior/L-A1" etc.) whether the prediction is correct
+    """
+    return {
+        f"{part}/{edge}": prediction[part][edge] == value
+        for part, values in ground_truth.items()
+        for edge, value in values.items()
+    }
+
+
+def _output_file(path):
+    # the file itself, or the output file of inference.py in the folder
+    return path if path.is_file() else path / OUTPUT_FILE
+
+
+def find_cases(*, predictions_path, ground_truth_path):
+    """
+    Pairs the predictions with the ground truth, a single case if the ground-truth
+    path is the classification file or a folder that holds it, named after that file,
+    otherwise one case per subfolder, named after the subfolder.
+    returns:
+        dict - (prediction file, ground-truth file) by case name,
+            the prediction file is None if it is missing
+    """
+    if ground_truth_path.is_file() or (ground_truth_path / OUTPUT_FILE).is_file():
+        ground_truth = _output_file(ground_truth_path)
+        cases = {ground_truth.stem: (predictions_path, ground_truth_path)}
+    else:
+        cases = {
+            p.name: (predictions_path / p.name, p)
+            for p in sorted(ground_truth_path.iterdir())
+            if (p / OUTPUT_FILE).is_file()
+        }
+    return {
+        name: (
+            _output_file(prediction) if _output_file(prediction).is_file() else None,
+            _output_file(ground_truth),
+        )
+        for name, (prediction, ground_truth) in cases.items()
+    }
+
+
+def evaluate(*, predictions_path, ground_truth_path):
+    """
+    returns:
+        dict - the fraction of correct edges of every case, the accuracy of each edge
+            over the cases, and the cases without prediction
+    """
+    cases = find_cases(
+        predictions_path=predictions_path, ground_truth_path=ground_truth_path
+    )
+    # NOTE: reading a classification takes microseconds, so unlike the label maps
+    # of task 1 the cases are not worth spreading over processes
+    matches = {
+        name: edge_matches(
+            json.loads(prediction.read_text()), json.loads(ground_truth.read_text())
+        )
+        for name, (prediction, ground_truth) in cases.items()
+        if prediction is not None
+    }
+    missing = [name for name, (prediction, _) in cases.items() if prediction is None]
+
+    edges = {edge for case_matches in matches.values() for edge in case_matches}
+    return {
+        "cases": {
+            name: float(np.mean(list(case_matches.values())))
+            for name, case_matches in matches.items()
+        },
+        "edges": {
+            edge: float(np.mean([m[edge] for m in matches.values()]))
+            for edge in sorted(edges)
+        },
+        "all_correct": (
+            float(np.mean([all(m.values()) for m in matches.values()]))
+            if matches
+            else None
+        ),
+        "missing": missing,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--predictions", type=Path, default=Path("./test/output"))
+    parser.add_argument(
+        "--ground-truth", type=Path, default=Path("./test/expected_output")
+    )
+    parser.add_argument("--json", type=Path, help="also write the scores as JSON")
+    args = parser.parse_args()
+
+    results = evaluate(
+        predictions_path=args.predictions, ground_truth_path=args.ground_truth
+    )
+
+    for name, value in results["cases"].items():
+        print(f"{name:24}{value:>8.4f}")
+    print(f"Accuracy of each edge over {len(results['cases'])} case(s)")
+    for edge, value in results["edges"].items():
+        print(f"{edge:20}{value:>8.4f}")
+    if results["all_correct"] is not None:
+        print(f"All edges correct in {results['all_correct']:.1%} of the cases")
+    if results["missing"]:
+        print(
+            f"[WARNING] No prediction for {len(results['missing'])} case(s): "
+            f"{', '.join(results['missing'])}"
+        )
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=4))
+    return 1 if results["missing"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -31,99 +31,704 @@ To save the container and prep it for upload to Grand-Challenge.org you can call
   ./save.sh
 """
 
+import argparse
 import json
+import os
+import sys
+import time
 from glob import glob
 from pathlib import Path
+from typing import NamedTuple
 
+from cgroup_utilities import configure_threads
+from profiling_utilities import (
+    profile_stage,
+    reset_profile,
+    start_import_timing,
+    write_profile,
+)
+
+# Size the thread pools of SimpleITK and BLAS/OpenMP (numpy, torch) to the CPU quota
+# of the container, before numpy is imported, see cgroup_utilities
+# NOTE: only when run as a script, importing inference.py changes nothing
+if __name__ == "__main__":
+    configure_threads()
+
+# Time the imports below if TOPCOW_PROFILE is set, as the start-up time
+# counts against the time limit too
+start_import_timing()
+
+import numpy as np
 import SimpleITK as sitk
-from your_algorithm import your_classification_algorithm
+from memory_utilities import check_allocation, memory_budget_mb, report_peak_rss
+from your_algorithm import (
+    MODEL_VERSION,
+    TRACK,
+    TTA_BATCHED,
+    load_your_model,
+    your_classification_algorithm,
+    your_roi_algorithm,
+)
+from worker_utilities import DEFAULT_HOST, DEFAULT_PORT, serve
+
 
+def run(*, input_path=None, output_path=None):
+    reset_profile()
 
-def run():
     # Setting correct paths for input, output and resources
     # depending on whether the algorithm is run in a docker container or locally
-    if _is_docker():
-        input_path = Path("/input")
-        output_path = Path("/output")
+    with profile_stage("_is_docker"):
+        exec_in_docker = _is_docker()
+    if exec_in_docker:
+        default_input_path = Path("/input")
+        default_output_path = Path("/output")
     else:
-        input_path = Path("./test/input")
-        output_path = Path("./test/output")
+        default_input_path = Path("./test/input")
+        default_output_path = Path("./test/output")
+    # NOTE: other folders can be given with --input/--output, e.g. by worker_client.py
+    input_path = Path(input_path or default_input_path)
+    output_path = Path(output_path or default_output_path)
 
-    # Read the input
-    input_head_mr_angiography = load_image_file_as_array(
-        location=input_path / "images/head-mr-angio",
-    )
-    input_head_ct_angiography = load_image_file_as_array(
-        location=input_path / "images/head-ct-angio",
-    )
+    run_case(input_path=input_path, output_path=output_path)
 
-    # Check whether torch CUDA is available
+    # Only written if TOPCOW_PROFILE is set, see profiling_utilities
+    write_profile(output_folder=output_path)
+    return 0
 
-    # NOTE: This relies on torch being installed in the environment
-    # _show_torch_cuda_info()
 
-    # Run your prediction algorithm
-    print("Running prediction algorithm...")
-    pred_dict = your_classification_algorithm(
-        mr_input_array=input_head_mr_angiography,
-        ct_input_array=input_head_ct_angiography,
-    )
+def run_case(*, input_path, output_path):
+    """
+    Runs the inference for a single case.
+    args:
+        input_path: Path - folder with the input images inside /images
+        output_path: Path - folder to store the output predictions in
+    returns:
+        dict - wall time in seconds of the prediction and of saving the output
+    """
+    timings = {}
+
+    # Forget about the images of earlier cases
+    _image_information_cache.clear()
+    _clear_statistics_cache()
+
+    # Skip your algorithm if the result cache holds the prediction of these inputs,
+    # see result_cache_utilities
+    key = result_cache_key(input_path=input_path)
+    pred_dict = None
+    if key is not None:
+        from result_cache_utilities import load_result
+
+        pred_dict = load_result(key)
+    if pred_dict is not None:
+        print("Found the prediction in the result cache, skipping your algorithm")
+        timings["prediction_seconds"] = 0.0
+    else:
+        # Read the input
+        # Gives lazy handles that behave like npy arrays with shape (x,y,z)
+        input_head_mr_angiography, input_head_ct_angiography = read_case(
+            input_path=input_path
+        )
+
+        # Check whether torch CUDA is available
+
+        # NOTE: This relies on torch being installed in the environment
+        # _show_torch_cuda_info()
+
+        # Run your prediction algorithm
+        print("Running prediction algorithm...")
+        start = time.perf_counter()
+        pred_dict = predict_case(
+            input_head_mr_angiography=input_head_mr_angiography,
+            input_head_ct_angiography=input_head_ct_angiography,
+        )
+        timings["prediction_seconds"] = time.perf_counter() - start
+        if key is not None:
+            from result_cache_utilities import store_result
+
+            store_result(key, pred_dict)
+        report_peak_rss(stage="prediction")
 
     # Save your output
     print("Saving output...")
+    start = time.perf_counter()
     write_json_file(content=pred_dict, output_folder=output_path)
+    timings["saving_seconds"] = time.perf_counter() - start
+    report_peak_rss(stage="saving output")
 
-    return 0
+    return timings
 
 
 def write_json_file(*, content, output_folder):
     # Make some sanity checks!
-    assert type(content) is dict, "Content must be a dictionary!"
-    assert content.keys() == {
-        "anterior",
-        "posterior",
-    }, "Content must contain the correct keys ('anterior' and 'posterior')!"
-    assert content["anterior"].keys() == {
-        "L-A1",
-        "Acom",
-        "3rd-A2",
-        "R-A1",
-    }, "Content must contain the correct keys for the anterior part!"
-    assert content["posterior"].keys() == {
-        "L-Pcom",
-        "L-P1",
-        "R-P1",
-        "R-Pcom",
-    }, "Content must contain the correct keys for the posterior part!"
-    assert all(
-        value in [0, 1] for value in content["anterior"].values()
-    ), "Values for the anterior part must be 0 or 1!"
-    assert all(
-        value in [0, 1] for value in content["posterior"].values()
-    ), "Values for the posterior part must be 0 or 1!"
+    with profile_stage("validation"):
+        assert type(content) is dict, "Content must be a dictionary!"
+        assert content.keys() == {
+            "anterior",
+            "posterior",
+        }, "Content must contain the correct keys ('anterior' and 'posterior')!"
+        assert content["anterior"].keys() == {
+            "L-A1",
+            "Acom",
+            "3rd-A2",
+            "R-A1",
+        }, "Content must contain the correct keys for the anterior part!"
+        assert content["posterior"].keys() == {
+            "L-Pcom",
+            "L-P1",
+            "R-P1",
+            "R-Pcom",
+        }, "Content must contain the correct keys for the posterior part!"
+        assert all(
+            value in [0, 1] for value in content["anterior"].values()
+        ), "Values for the anterior part must be 0 or 1!"
+        assert all(
+            value in [0, 1] for value in content["posterior"].values()
+        ), "Values for the posterior part must be 0 or 1!"
+
+    # Create the output folder, e.g. a new one given with --output
+    output_folder.mkdir(parents=True, exist_ok=True)
 
     # Writes a json file
-    location = output_folder / "cow-ant-post-classification.json"
-    with open(location, "w") as f:
-        f.write(json.dumps(content, indent=4))
+    with profile_stage("write"):
+        location = output_folder / "cow-ant-post-classification.json"
+        with open(location, "w") as f:
+            f.write(json.dumps(content, indent=4))
 
 
-def load_image_file_as_array(*, location):
-    # Use SimpleITK to read a file
-    input_file = (glob(str(location / "*.mha")) + glob(str(location / "*.nii.gz")))[
+def predict_case(*, input_head_mr_angiography, input_head_ct_angiography):
+    """
+    Runs your algorithm on the inputs of a case.
+    Optionally the image of your TRACK is first preprocessed:
+        TOPCOW_ROI_CASCADE=1: cropped to the region of interest (ROI), see roi_utilities
+        TOPCOW_TARGET_SPACING: resampled to a fixed spacing, see resampling_utilities
+    With TOPCOW_TTA, your algorithm runs on flipped views of it, see tta_utilities.
+    """
+    inputs = {"MR": input_head_mr_angiography, "CT": input_head_ct_angiography}
+    track_input = inputs[TRACK]
+    roi = None
+    grid = None
+
+    # NOTE: the module of each feature is only imported if it is turned on
+    roi_cascade = False
+    if _opted_in("TOPCOW_ROI_CASCADE"):
+        from roi_utilities import roi_cascade_enabled
+
+        roi_cascade = roi_cascade_enabled()
+    if roi_cascade:
+        from roi_utilities import crop_to_roi
+
+        with profile_stage("your_roi_algorithm"):
+            roi = your_roi_algorithm(
+                mr_input_array=input_head_mr_angiography,
+                ct_input_array=input_head_ct_angiography,
+            )
+        # NOTE: the crop is a view of the decoded image, the other modality is left as is
+        inputs[TRACK] = crop_to_roi(track_input, roi)
+        print(
+            f"ROI cascade: {roi['size']} voxels at {roi['location']}, "
+            f"{np.prod(track_input.shape) / np.prod(roi['size']):.1f}x fewer voxels"
+        )
+
+    target_spacing = None
+    if _opted_in("TOPCOW_TARGET_SPACING"):
+        from resampling_utilities import target_spacing_from_env
+
+        target_spacing = target_spacing_from_env()
+    if target_spacing is not None:
+        from resampling_utilities import resample_to_target, resampling_grid
+
+        with profile_stage("resampling"):
+            grid = resampling_grid(
+                size=inputs[TRACK].shape,
+                spacing=track_input.information.spacing,
+                target_spacing=target_spacing,
+            )
+            inputs[TRACK] = resample_to_target(inputs[TRACK], grid)
+        print(f"Resampled to {grid.target_size} voxels of {target_spacing} mm")
+
+    n_flips = 0
+    if _opted_in("TOPCOW_TTA"):
+        from tta_utilities import tta_flips_from_env
+
+        n_flips = tta_flips_from_env()
+    with profile_stage("your_classification_algorithm"):
+        if n_flips:
+            from tta_utilities import classification_tta, tta_batch_size
+
+            pred_dict = classification_tta(
+                inputs[TRACK],
+                predict=lambda views: classify_views(views, inputs=inputs),
+                n_flips=n_flips,
+                batch_size=tta_batch_size(
+                    n_flips=n_flips, n_voxels=int(np.prod(inputs[TRACK].shape))
+                ),
+            )
+        else:
+            pred_dict = your_classification_algorithm(
+                mr_input_array=inputs["MR"], ct_input_array=inputs["CT"]
+            )
+
+    return pred_dict
+
+
+def classify_views(views, *, inputs):
+    """
+    Runs your algorithm on flipped views of the image of your TRACK for TTA.
+    With TTA_BATCHED (see your_algorithm.py), it gets all views as a list in one call
+    and returns a list of edge classifications, otherwise it is called once per view.
+    NOTE: only the image of your TRACK is flipped, the other modality is passed as is.
+    returns:
+        list of dict - edge classification of each view
+    """
+    if not TTA_BATCHED:
+        return [
+            your_classification_algorithm(
+                mr_input_array=view_inputs["MR"], ct_input_array=view_inputs["CT"]
+            )
+            for view_inputs in ({**inputs, TRACK: view} for view in views)
+        ]
+    view_inputs = {**inputs, TRACK: list(views)}
+    pred_dicts = your_classification_algorithm(
+        mr_input_array=view_inputs["MR"], ct_input_array=view_inputs["CT"]
+    )
+    assert len(pred_dicts) == len(
+        views
+    ), "With TTA_BATCHED, return one prediction per view!"
+    return pred_dicts
+
+
+def run_batch(*, cases_path, output_path, prefetch=1, write_behind=1):
+    """
+    Runs the inference for every case folder in `cases_path` in this one process,
+    so that imports and the model (see load_your_model) are only initialized once.
+    Each case folder is laid out like the input folder, i.e. <case>/images/head-mr-angio etc.
+    The outputs of each case are stored in `output_path`/<case>, next to
+    a batch-summary.json with the timings of every case.
+
+    While a case is predicted, the next `prefetch` cases are decoded and the outputs of
+    up to `write_behind` earlier cases are written in the background,
+    see pipeline_utilities.run_pipeline. Set both to 0 to run the cases one after another.
+    """
+    case_paths = sorted(
+        p for p in Path(cases_path).iterdir() if (p / "images").is_dir()
+    )
+    output_path = Path(output_path)
+    print(f"Found {len(case_paths)} cases in {cases_path}")
+
+    from pipeline_utilities import run_pipeline
+
+    # Forget about the images of earlier runs
+    _image_information_cache.clear()
+    _clear_statistics_cache()
+    reset_profile()
+
+    def read(case_path):
+        # NOTE: the key is hashed here, i.e. ahead of the prediction like the decoding
+        key = result_cache_key(input_path=case_path)
+        if key is not None:
+            from result_cache_utilities import load_result
+
+            cached = load_result(key)
+            if cached is not None:
+                return key, cached, None
+        return key, None, read_case(input_path=case_path, decode=True)
+
+    def predict(item):
+        key, cached, inputs = item
+        if cached is not None:
+            print("Found the prediction in the result cache, skipping your algorithm")
+            return cached
+        print("Running prediction algorithm...")
+        input_head_mr_angiography, input_head_ct_angiography = inputs
+        pred_dict = predict_case(
+            input_head_mr_angiography=input_head_mr_angiography,
+            input_head_ct_angiography=input_head_ct_angiography,
+        )
+        if key is not None:
+            from result_cache_utilities import store_result
+
+            store_result(key, pred_dict)
+        return pred_dict
+
+    def write(case_path, pred_dict):
+        case_output_path = output_path / case_path.name
+        case_output_path.mkdir(parents=True, exist_ok=True)
+        write_json_file(content=pred_dict, output_folder=case_output_path)
+
+    start = time.perf_counter()
+    records = run_pipeline(
+        items=case_paths,
+        read=read,
+        predict=predict,
+        write=write,
+        prefetch=prefetch,
+        write_behind=write_behind,
+    )
+    total_seconds = time.perf_counter() - start
+
+    summary = {
+        "cases": [{"case": p.name, **r} for p, r in zip(case_paths, records)],
+        "prefetch": prefetch,
+        "write_behind": write_behind,
+        "total_seconds": total_seconds,
+        "cases_per_minute": 60 * len(case_paths) / total_seconds,
+        "failed_cases": [
+            p.name for p, r in zip(case_paths, records) if r["status"] != "ok"
+        ],
+    }
+
+    output_path.mkdir(parents=True, exist_ok=True)
+    with open(output_path / "batch-summary.json", "w") as f:
+        f.write(json.dumps(summary, indent=4))
+    write_profile(output_folder=output_path)
+    print(
+        f"Ran {len(case_paths)} cases in {total_seconds:.1f}s "
+        f"({summary['cases_per_minute']:.1f} cases per minute)"
+    )
+    return 1 if summary["failed_cases"] else 0
+
+
+def serve_cases(*, host, port):
+    """
+    Warm worker: keeps the imports and your model (see load_your_model) initialized
+    and runs one case per local HTTP request, see worker_utilities.
+    Each case is run like `run` with the input and output folder of the request.
+    """
+    # Initialize the model at start-up, not during the first case
+    load_your_model()
+
+    def handle(*, input_path, output_path):
+        output_path = Path(output_path)
+        output_path.mkdir(parents=True, exist_ok=True)
+        reset_profile()
+        timings = run_case(input_path=Path(input_path), output_path=output_path)
+        write_profile(output_folder=output_path)
+        return timings
+
+    return serve(handle=handle, host=host, port=port)
+
+
+def read_case(*, input_path, decode=False):
+    """
+    Gives the input images of a case as lazy handles that behave like
+    npy arrays with shape (x,y,z), see LazyImageArray.
+    args:
+        input_path: Path - folder with the input images inside /images
+        decode: bool - decode the image of your TRACK right away, e.g. to prefetch it
+    returns:
+        tuple - (MR handle, CT handle)
+    """
+    # NOTE: an image is only decoded when your algorithm accesses it,
+    # so the modality that is not used by your TRACK is never read
+    input_head_mr_angiography = LazyImageArray(
+        location=input_path / "images/head-mr-angio",
+    )
+    input_head_ct_angiography = LazyImageArray(
+        location=input_path / "images/head-ct-angio",
+    )
+    if decode:
+        if TRACK == "MR":
+            input_head_mr_angiography.load()
+        elif TRACK == "CT":
+            input_head_ct_angiography.load()
+    return input_head_mr_angiography, input_head_ct_angiography
+
+
+class ImageInformation(NamedTuple):
+    """
+    Geometry of an input image, i.e. everything but the voxel data.
+    NOTE: size is in SimpleITK (x,y,z) order, the same as the npy arrays
+    returned by `load_image_file_as_array`
+    """
+
+    size: tuple
+    spacing: tuple
+    origin: tuple
+    direction: tuple
+    pixel_id: int
+
+    @classmethod
+    def from_image(cls, img):
+        # works for both sitk.Image and sitk.ImageFileReader
+        return cls(
+            size=tuple(img.GetSize()),
+            spacing=tuple(img.GetSpacing()),
+            origin=tuple(img.GetOrigin()),
+            direction=tuple(img.GetDirection()),
+            pixel_id=img.GetPixelID(),
+        )
+
+    @classmethod
+    def from_dict(cls, geometry):
+        # the counterpart of `._asdict()`, e.g. after a round trip through JSON
+        return cls(
+            **{
+                name: tuple(value) if isinstance(value, list) else value
+                for name, value in geometry.items()
+            }
+        )
+
+    @property
+    def nbytes(self):
+        # Memory needed for the decoded voxel data
+        pixel = sitk.Image([1] * len(self.size), self.pixel_id)
+        return (
+            int(np.prod(self.size))
+            * pixel.GetSizeOfPixelComponent()
+            * pixel.GetNumberOfComponentsPerPixel()
+        )
+
+    def copy_to(self, img):
+        # Same as img.CopyInformation(<input image>)
+        img.SetSpacing(self.spacing)
+        img.SetOrigin(self.origin)
+        img.SetDirection(self.direction)
+
+
+# Geometry of the images read in this run, keyed by their input folder.
+# This avoids decoding an input image a second time just for its metadata
+_image_information_cache = {}
+
+
+def result_cache_key(*, input_path):
+    """
+    Key of the prediction of a case in the result cache (TOPCOW_RESULT_CACHE),
+    from the input images of both modalities, see result_cache_utilities.
+    NOTE: a case may lack one modality, only the images that exist are hashed
+    returns:
+        str - the key, None if the result cache is off
+    """
+    if not _opted_in("TOPCOW_RESULT_CACHE"):
+        return None
+    from result_cache_utilities import result_key
+
+    input_files = []
+    for folder in ("images/head-mr-angio", "images/head-ct-angio"):
+        location = input_path / folder
+        # same file as `_find_image_file`, which fails without one
+        image_files = glob(str(location / "*.mha")) + glob(str(location / "*.nii.gz"))
+        input_files += [Path(f) for f in image_files[:1]]
+    return result_key(
+        input_files=input_files,
+        model_version=MODEL_VERSION,
+        track=TRACK,
+    )
+
+
+def _opted_in(env):
+    """
+    Whether the environment variable of an opt-in feature is set at all.
+    NOTE: the module of a feature is only imported if it is, so that the features that
+    are off cost no start-up time; the module then parses the value, e.g. "0" is off
+    """
+    return bool(os.environ.get(env, "").strip())
+
+
+def _clear_statistics_cache():
+    # Only if your algorithm uses normalization_utilities, it is not imported here
+    normalization_utilities = sys.modules.get("normalization_utilities")
+    if normalization_utilities is not None:
+        normalization_utilities.clear_statistics_cache()
+
+
+def _find_image_file(*, input_path):
+    return (glob(str(input_path / "*.mha")) + glob(str(input_path / "*.nii.gz")))[
         0
     ]  # There is just one file in the input folder!
-    img = sitk.ReadImage(input_file)
+
+
+def load_image_file(*, input_path):
+    # Use SimpleITK to read a file
+    with profile_stage("load image", location=str(input_path)):
+        img = sitk.ReadImage(_find_image_file(input_path=input_path))
+    _image_information_cache[Path(input_path)] = ImageInformation.from_image(img)
+    return img
+
+
+def load_image_information(*, input_path):
+    # Gives the geometry of the image without decoding the voxel data
+    # if the image was not already loaded in this run
+    key = Path(input_path)
+    if key not in _image_information_cache:
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(_find_image_file(input_path=input_path))
+        reader.ReadImageInformation()
+        _image_information_cache[key] = ImageInformation.from_image(reader)
+    return _image_information_cache[key]
+
+
+def load_transcoded_image(*, input_path):
+    """
+    Gives the voxel data of an input image from the transcoding cache
+    (TOPCOW_TRANSCODE_CACHE), the image is decoded and stored on first access,
+    see transcoding_utilities.
+    returns:
+        np.memmap - copy-on-write, in the SimpleITK axis order (z,y,x)
+    """
+    from transcoding_utilities import load_transcoded, store_transcoded
+
+    image_file = _find_image_file(input_path=input_path)
+    with profile_stage("load image", location=str(input_path)):
+        cached = load_transcoded(image_file)
+        if cached is None:
+            img = sitk.ReadImage(image_file)
+            cached = store_transcoded(
+                image_file,
+                array=sitk.GetArrayViewFromImage(img),
+                geometry=ImageInformation.from_image(img)._asdict(),
+            )
+    array, geometry = cached
+    _image_information_cache[Path(input_path)] = ImageInformation.from_dict(geometry)
+    return array
+
+
+def load_image_file_as_array(*, location, layout="xyz"):
+    if _opted_in("TOPCOW_TRANSCODE_CACHE"):
+        # NOTE: a memory map of the raw volume, nothing is decoded
+        return _reorder_axes(load_transcoded_image(input_path=location), layout=layout)
+
+    img = load_image_file(input_path=location)
 
     # Convert it to a Numpy array
+    # Gives a npy array with shape (x,y,z) by default, see `image_to_array`
+    return image_to_array(img, layout=layout)
 
+
+def _reorder_axes(array, *, layout):
     # NOTE: SimpleITK npy axis ordering is (z,y,x)!
-    img_array = sitk.GetArrayFromImage(img)
+    # Reordering is a transpose, which gives a view and never copies
+    if layout == "xyz":
+        return array.transpose((2, 1, 0))
+    if layout == "zyx":
+        return array
+    raise ValueError(f"Invalid layout {layout!r}. Choose either 'xyz' or 'zyx'.")
+
+
+def image_to_array(img, *, layout="xyz", copy=True):
+    """
+    Converts a SimpleITK image to a npy array with at most one copy.
+    args:
+        img: sitk.Image
+        layout: str - "xyz" (default) gives the (x,y,z) axis order used in this template,
+                "zyx" gives the SimpleITK npy axis order (z,y,x)
+        copy: bool - if False, gives a read-only view of the image buffer without any copy
+              NOTE: then you must keep `img` alive while the view is in use!
+    returns:
+        np.array - C-contiguous for "zyx", Fortran-contiguous for "xyz"
+    """
+    if copy:
+        array = sitk.GetArrayFromImage(img)
+    else:
+        array = sitk.GetArrayViewFromImage(img)
+    return _reorder_axes(array, layout=layout)
+
+
+class LazyImageArray(np.lib.mixins.NDArrayOperatorsMixin):
+    """
+    Handle to an input image that is only decoded on first access.
+
+    It can be used like the npy array with shape (x,y,z) returned by
+    `load_image_file_as_array`: indexing, attributes, arithmetic and numpy
+    functions all decode the image once and then work on the decoded array.
+    Only `.shape` and `.information` are served from the image header.
+    Use `np.asarray(handle)` if you need the plain npy array,
+    e.g. for `torch.from_numpy`.
+
+    Writing through the handle (`handle[...] = value`, `out=handle`) works in every
+    mode. With TOPCOW_MEMORY_BUDGET_MB the decoded array is a read-only view of the
+    image buffer, so the first write replaces it with an owned copy (copy-on-write),
+    which needs the memory of the image a second time; arrays taken with
+    `np.asarray(handle)` before that stay read-only.
+    """
+
+    def __init__(self, *, location):
+        self.location = location
+        self._image = None
+        self._zyx_array = None
+
+    @property
+    def is_loaded(self):
+        return self._zyx_array is not None
+
+    def load(self, *, layout="xyz"):
+        """
+        Decodes the image on first call.
+        args:
+            layout: str - "xyz" (default) or "zyx", see `image_to_array`
+        returns:
+            np.array - the image in the requested axis order, as a view on the same data
+        """
+        if not self.is_loaded:
+            # NOTE: the transcoding cache gives a memory map, which needs no budget
+            if memory_budget_mb() is None or _opted_in("TOPCOW_TRANSCODE_CACHE"):
+                self._zyx_array = load_image_file_as_array(
+                    location=self.location, layout="zyx"
+                )
+            else:
+                # Memory-budget mode: no copy, the npy array is a read-only view
+                # of the image buffer, so the handle also keeps the image alive
+                check_allocation(
+                    nbytes=self.information.nbytes, what=f"decoding {self.location}"
+                )
+                self._image = load_image_file(input_path=self.location)
+                self._zyx_array = image_to_array(self._image, layout="zyx", copy=False)
+                report_peak_rss(stage=f"loading {self.location}")
+        return _reorder_axes(self._zyx_array, layout=layout)
 
-    # reorder from (z,y,x) to (x,y,z)
-    img_array = img_array.transpose((2, 1, 0))
+    @property
+    def shape(self):
+        # Read from the image header, so this does not decode the image
+        return load_image_information(input_path=self.location).size
 
-    return img_array
+    @property
+    def information(self):
+        # Spacing, origin and direction of the image, see ImageInformation
+        return load_image_information(input_path=self.location)
+
+    def __array__(self, dtype=None, copy=None):
+        if copy:
+            return np.array(self.load(), dtype=dtype, copy=True)
+        return np.asarray(self.load(), dtype=dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = tuple(x.load() if isinstance(x, LazyImageArray) else x for x in inputs)
+        if "out" in kwargs:
+            kwargs["out"] = tuple(
+                x._writable() if isinstance(x, LazyImageArray) else x
+                for x in kwargs["out"]
+            )
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __getattr__(self, name):
+        # Only called for attributes not defined on the handle itself,
+        # everything else (shape, dtype, transpose, ...) comes from the array
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __setitem__(self, key, value):
+        self._writable()[key] = value
+
+    def _writable(self):
+        # Copy-on-write: the read-only view of memory-budget mode is replaced by an
+        # owned copy on the first write
+        # NOTE: the image is kept alive, earlier views of its buffer may still be in use
+        if not self.load(layout="zyx").flags.writeable:
+            check_allocation(
+                nbytes=self._zyx_array.nbytes, what=f"writing to {self.location}"
+            )
+            self._zyx_array = self._zyx_array.copy()
+        return self.load()
+
+    def __len__(self):
+        return len(self.load())
+
+    def __repr__(self):
+        state = "loaded" if self.is_loaded else "not loaded"
+        return f"LazyImageArray(location={str(self.location)!r}, {state})"
 
 
 def _is_docker():
@@ -144,4 +749,63 @@ def _is_docker():
 
 
 if __name__ == "__main__":
-    raise SystemExit(run())
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--batch",
+        type=Path,
+        metavar="CASES_DIR",
+        help="run all case folders in CASES_DIR instead of the single input case",
+    )
+    parser.add_argument(
+        "--input",
+        type=Path,
+        metavar="INPUT_DIR",
+        help="input folder of the single case (default: /input or ./test/input)",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        metavar="OUTPUT_DIR",
+        help="where to store the outputs "
+        "(default: /output or ./test/output, CASES_DIR-output in batch mode)",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=1,
+        help="batch mode: number of cases decoded ahead of the prediction (default: 1)",
+    )
+    parser.add_argument(
+        "--write-behind",
+        type=int,
+        default=1,
+        help="batch mode: number of outputs written in the background (default: 1)",
+    )
+    parser.add_argument(
+        "--serve",
+        type=int,
+        nargs="?",
+        const=DEFAULT_PORT,
+        metavar="PORT",
+        help=f"run as a warm worker that serves cases over HTTP on PORT "
+        f"(default: {DEFAULT_PORT}), see worker_utilities",
+    )
+    parser.add_argument(
+        "--host",
+        default=DEFAULT_HOST,
+        help=f"worker mode: address to listen on (default: {DEFAULT_HOST})",
+    )
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        raise SystemExit(serve_cases(host=args.host, port=args.serve))
+    if args.batch is None:
+        raise SystemExit(run(input_path=args.input, output_path=args.output))
+    raise SystemExit(
+        run_batch(
+            cases_path=args.batch,
+            output_path=args.output or Path(f"{args.batch}-output"),
+            prefetch=args.prefetch,
+            write_behind=args.write_behind,
+        )
+    )
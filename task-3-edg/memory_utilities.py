@@ -0,0 +1,67 @@
+"""
+Helpers to keep the memory use of the inference within the container's RAM limit.
+
+The memory-budget mode is turned on by setting the environment variable
+TOPCOW_MEMORY_BUDGET_MB, e.g. to the RAM limit of your grand-challenge container:
+    TOPCOW_MEMORY_BUDGET_MB=16000 python inference.py
+In this mode the input images are handed to your algorithm as read-only
+zero-copy views of the SimpleITK image buffers, and the peak RSS (resident set size)
+of the process is reported after each stage of `run()`.
+"""
+
+import os
+import resource
+import sys
+
+MEMORY_BUDGET_ENV = "TOPCOW_MEMORY_BUDGET_MB"
+
+
+def memory_budget_mb():
+    """
+    returns:
+        float - the memory budget in MB, or None if the memory-budget mode is off
+    """
+    value = os.environ.get(MEMORY_BUDGET_ENV, "").strip()
+    return float(value) if value else None
+
+
+def peak_rss_mb():
+    """
+    returns:
+        float - the peak resident set size of this process so far in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # NOTE: ru_maxrss is in bytes on macOS but in kilobytes on Linux
+    if sys.platform == "darwin":
+        return peak / 1024**2
+    return peak / 1024
+
+
+def report_peak_rss(*, stage):
+    """
+    Prints the peak RSS after a stage if the memory-budget mode is on,
+    with a warning if the budget has been exceeded.
+    """
+    budget = memory_budget_mb()
+    if budget is None:
+        return
+    peak = peak_rss_mb()
+    print(f"[memory] peak RSS after {stage}: {peak:.0f} MB (budget {budget:.0f} MB)")
+    if peak > budget:
+        print(f"[memory] WARNING: {stage} exceeded the memory budget!")
+
+
+def check_allocation(*, nbytes, what):
+    """
+    Warns before allocating `nbytes` for `what` if the memory-budget mode is on
+    and the allocation on top of the current peak RSS would exceed the budget.
+    """
+    budget = memory_budget_mb()
+    if budget is None:
+        return
+    required = nbytes / 1024**2
+    if peak_rss_mb() + required > budget:
+        print(
+            f"[memory] WARNING: {what} needs {required:.0f} MB, "
+            f"which might not fit the budget of {budget:.0f} MB!"
+        )
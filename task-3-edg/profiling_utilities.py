@@ -0,0 +1,172 @@
+"""
+Opt-in instrumentation of the stages of inference.py.
+
+Set the environment variable TOPCOW_PROFILE=1 to record the wall time, CPU time and
+peak RSS (resident set size) of every stage of `run()`: _is_docker, each image load,
+your algorithm, the validation of its output and writing the output.
+The records are written as JSON sidecar inference-profile.json to the output folder,
+e.g. to find regressions against the time limit of grand-challenge without a profiler.
+NOTE: the CPU time is that of the whole process, i.e. of all threads.
+
+The start-up time of the container counts against the time limit too, and most of it
+is spent importing modules (numpy, SimpleITK, torch, ...). `start_import_timing()`
+records the time of every import after it, like `python -X importtime`, and the profile
+then also holds them, summarized per top-level package.
+NOTE: only stdlib modules are imported here, so that all others can be timed.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+from memory_utilities import peak_rss_mb
+
+PROFILE_ENV = "TOPCOW_PROFILE"
+PROFILE_FILENAME = "inference-profile.json"
+
+_records = []
+_lock = threading.Lock()
+
+
+def profiling_enabled():
+    return os.environ.get(PROFILE_ENV, "").strip().lower() not in ("", "0", "false")
+
+
+@contextlib.contextmanager
+def profile_stage(name, **details):
+    """
+    Records the wall time, CPU time and peak RSS of the code in the `with` block
+    if the profiling is enabled.
+    args:
+        name: str - name of the stage
+        details: extra fields for the record, e.g. the location of an image
+    """
+    if not profiling_enabled():
+        yield
+        return
+
+    peak_before = peak_rss_mb()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        peak_after = peak_rss_mb()
+        record = {
+            "stage": name,
+            **details,
+            "wall_seconds": time.perf_counter() - wall_start,
+            "cpu_seconds": time.process_time() - cpu_start,
+            "peak_rss_mb": peak_after,
+            # by how much this stage raised the peak RSS of the process
+            "peak_rss_increase_mb": peak_after - peak_before,
+            "thread": threading.current_thread().name,
+        }
+        with _lock:
+            _records.append(record)
+
+
+# Import time per module: [self seconds, cumulative seconds], see `start_import_timing`
+_import_times = {}
+_import_stack = threading.local()
+
+
+class _ImportTimer:
+    """
+    Meta path finder that only wraps the loaders found by the other finders,
+    to time the execution of each imported module.
+    """
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        # NOTE: builtin and frozen modules share their loader class, they are not timed
+        loader = spec.loader
+        if loader is not None and not isinstance(loader, type):
+            loader.exec_module = _timed_exec_module(loader.exec_module, fullname)
+        return spec
+
+
+def _timed_exec_module(exec_module, fullname):
+    def timed_exec_module(module):
+        # the time spent in nested imports is not part of the self time
+        stack = _import_stack.__dict__.setdefault("children", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            exec_module(module)
+        finally:
+            cumulative = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += cumulative
+            with _lock:
+                _import_times[fullname] = [cumulative - children, cumulative]
+
+    return timed_exec_module
+
+
+def start_import_timing():
+    """
+    Times all imports from now on, if the profiling is enabled.
+    Call it before the imports to time, e.g. at the top of inference.py.
+    """
+    if profiling_enabled() and not any(
+        isinstance(finder, _ImportTimer) for finder in sys.meta_path
+    ):
+        sys.meta_path.insert(0, _ImportTimer())
+
+
+def import_time_summary(*, top=10):
+    """
+    returns:
+        dict - total import time, the self time summed per top-level package and
+            the `top` modules by cumulative time, in seconds
+    """
+    with _lock:
+        times = dict(_import_times)
+    packages = {}
+    for name, (self_seconds, _) in times.items():
+        package = name.partition(".")[0]
+        packages[package] = packages.get(package, 0.0) + self_seconds
+    slowest = sorted(times.items(), key=lambda item: item[1][1], reverse=True)[:top]
+    return {
+        "total_seconds": sum(packages.values()),
+        "packages": dict(sorted(packages.items(), key=lambda item: -item[1])),
+        "slowest_modules": {name: cumulative for name, (_, cumulative) in slowest},
+    }
+
+
+def reset_profile():
+    with _lock:
+        _records.clear()
+
+
+def write_profile(*, output_folder):
+    """
+    Writes the records since the last `reset_profile()` to the output folder,
+    if the profiling is enabled.
+    """
+    if not profiling_enabled():
+        return
+    with _lock:
+        records = list(_records)
+    profile = {"stages": records}
+    if _import_times:
+        profile["imports"] = imports = import_time_summary()
+        print(f"Imports took {imports['total_seconds']:.3f}s:")
+        for package, seconds in list(imports["packages"].items())[:5]:
+            print(f"\t{package:<30} {seconds:.3f}s")
+    location = output_folder / PROFILE_FILENAME
+    with open(location, "w") as f:
+        f.write(json.dumps(profile, indent=4))
+    print(f"Wrote the profile of {len(records)} stages to {location}")
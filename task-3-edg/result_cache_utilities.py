@@ -0,0 +1,143 @@
+"""
+On-disk cache of predictions, to skip your algorithm on inputs it has already seen.
+
+Local runs (test_run.sh, validation sets with `--batch`) often repeat the same inputs
+after changes that do not affect the prediction. With the environment variable
+TOPCOW_RESULT_CACHE=<folder>, inference.py stores each prediction (a label map as .npy,
+a dict as .json) under a key of the inputs and your model, and on the next run with the
+same key goes straight to writing the output:
+
+    TOPCOW_RESULT_CACHE=~/.cache/topcow python inference.py
+
+The key is a BLAKE2 hash of:
+    - the bytes of the input image files with their folder, e.g. head-mr-angio (both
+      modalities if present, as your algorithm may use both)
+    - MODEL_VERSION, TRACK and the source of your_algorithm.py, i.e. any change to your
+      algorithm code starts over; change MODEL_VERSION when your model weights change
+    - the settings that change the prediction (TOPCOW_ROI_CASCADE etc.)
+
+The cache is bounded by TOPCOW_RESULT_CACHE_MB (default 4096 MB), the least recently
+used results are removed first. It is off unless TOPCOW_RESULT_CACHE is set, so don't
+set it in the container of your submission.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+RESULT_CACHE_ENV = "TOPCOW_RESULT_CACHE"
+RESULT_CACHE_MB_ENV = "TOPCOW_RESULT_CACHE_MB"
+DEFAULT_RESULT_CACHE_MB = 4096
+
+# Settings of inference.py that change the prediction, part of the key
+PREDICTION_ENVS = (
+    "TOPCOW_ROI_CASCADE",
+    "TOPCOW_TARGET_SPACING",
+    "TOPCOW_TTA",
+)
+
+_ALGORITHM_FILE = Path(__file__).parent / "your_algorithm.py"
+
+
+def result_cache_path():
+    """
+    returns:
+        Path - the cache folder, None if the cache is off
+    """
+    value = os.environ.get(RESULT_CACHE_ENV, "").strip()
+    return Path(value).expanduser() if value else None
+
+
+def _max_bytes():
+    value = os.environ.get(RESULT_CACHE_MB_ENV, "").strip()
+    return float(value or DEFAULT_RESULT_CACHE_MB) * 2**20
+
+
+def _file_digest(path):
+    # NOTE: not hashlib.file_digest, it needs Python 3.11 and the containers run 3.10
+    digest = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def result_key(*, input_files, model_version, track):
+    """
+    args:
+        input_files: list of Path - the input image files of the case that exist
+        model_version: str - MODEL_VERSION of your_algorithm.py
+        track: str - "MR" or "CT"
+    returns:
+        str - hex key of the prediction
+    """
+    key = hashlib.blake2b(digest_size=20)
+    key.update(json.dumps([str(model_version), track]).encode())
+    key.update(_file_digest(_ALGORITHM_FILE))
+    key.update(
+        json.dumps(
+            {name: os.environ.get(name, "") for name in PREDICTION_ENVS}
+        ).encode()
+    )
+    for path in input_files:
+        # the folder tells the modalities apart, e.g. when a case has only one
+        key.update(Path(path).parent.name.encode())
+        key.update(_file_digest(path))
+    return key.hexdigest()
+
+
+def load_result(key):
+    """
+    returns:
+        np.array (memory-mapped, read-only) or dict - the cached prediction,
+            None if there is none
+    """
+    folder = result_cache_path()
+    for path in (folder / f"{key}.npy", folder / f"{key}.json"):
+        if path.is_file():
+            # mark as recently used for the eviction
+            os.utime(path)
+            if path.suffix == ".npy":
+                return np.load(path, mmap_mode="r")
+            return json.loads(path.read_text())
+    return None
+
+
+def store_result(key, result):
+    """
+    Stores a prediction (label map or dict) and removes the least recently used
+    results beyond TOPCOW_RESULT_CACHE_MB.
+    """
+    folder = result_cache_path()
+    folder.mkdir(parents=True, exist_ok=True)
+    is_array = isinstance(result, np.ndarray)
+    path = folder / f"{key}.{'npy' if is_array else 'json'}"
+    # written to a temporary file first, so that a cut-off write is never read
+    temporary = folder / f".{key}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        if is_array:
+            np.save(f, result)
+        else:
+            f.write(json.dumps(result).encode())
+    os.replace(temporary, path)
+    evict(max_bytes=_max_bytes())
+
+
+def evict(*, max_bytes):
+    """
+    Removes the least recently used results until the cache is at most `max_bytes`.
+    """
+    entries = []
+    for path in result_cache_path().glob("*.*"):
+        if path.suffix in (".npy", ".json"):
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
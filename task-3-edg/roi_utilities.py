@@ -0,0 +1,103 @@
+"""
+ROI cascade: localize the circle of Willis (CoW) once, then run the algorithm on the crop.
+
+The CoW fills only a small part of a head MRA/CTA. With the environment variable
+TOPCOW_ROI_CASCADE=1, inference.py first finds a region of interest (ROI) and hands
+only that crop of the image of your TRACK to your algorithm.
+The ROI is a bounding box in the same form as the output of task 2,
+{"size": [x, y, z], "location": [x, y, z]}, and the crop is a view, i.e. no copy.
+
+`find_roi` is a cheap heuristic: a box of fixed physical size around the bright vessels,
+found on a strided (downsampled) view of the image. You can use your own detector
+instead, e.g. your task 2 model, see `your_roi_algorithm` in your_algorithm.py.
+"""
+
+import os
+
+import numpy as np
+
+ROI_CASCADE_ENV = "TOPCOW_ROI_CASCADE"
+
+# Physical size of the ROI in mm, the CoW spans about 60x60x40 mm
+ROI_SIZE_MM = (80.0, 80.0, 60.0)
+
+
+def roi_cascade_enabled():
+    return os.environ.get(ROI_CASCADE_ENV, "").strip().lower() not in ("", "0", "false")
+
+
+def find_roi(volume, *, spacing, modality, roi_size_mm=ROI_SIZE_MM, stride=4):
+    """
+    Finds a box of `roi_size_mm` centred on the bright vessels of a head MRA/CTA.
+    args:
+        volume: np.array - image in (x,y,z), e.g. mr_input_array
+        spacing: tuple - voxel spacing in mm in (x,y,z)
+        modality: str - "MR" or "CT"
+        roi_size_mm: tuple - size of the box in mm in (x,y,z)
+        stride: int - only every `stride`th voxel along each axis is looked at
+    returns:
+        dict - {"size": [x, y, z], "location": [x, y, z]} in voxels, within the image
+    """
+    shape = tuple(volume.shape)
+    coarse = np.asarray(volume[::stride, ::stride, ::stride], dtype=np.float32)
+
+    if modality == "CT":
+        # contrast-filled vessels, without air, soft tissue and most of the bone
+        bright = (coarse > 150) & (coarse < 600)
+    elif modality == "MR":
+        # the inflowing blood is the brightest signal of a TOF-MRA
+        bright = coarse > np.percentile(coarse, 99.5)
+    else:
+        raise ValueError(f"Invalid modality {modality!r}. Choose either 'MR' or 'CT'.")
+
+    coordinates = np.argwhere(bright)
+    if len(coordinates) == 0:
+        print("[WARNING] ROI cascade found no vessels, using the whole image")
+        return {"size": list(shape), "location": [0, 0, 0]}
+
+    # the median is robust to bright spots away from the CoW
+    centre = np.median(coordinates, axis=0) * stride
+    size = [
+        min(s, int(np.ceil(mm / sp))) for s, mm, sp in zip(shape, roi_size_mm, spacing)
+    ]
+    location = [
+        int(np.clip(round(c - n / 2), 0, s - n)) for c, n, s in zip(centre, size, shape)
+    ]
+    return {"size": size, "location": location}
+
+
+def roi_slices(roi):
+    return tuple(
+        slice(location, location + size)
+        for location, size in zip(roi["location"], roi["size"])
+    )
+
+
+def crop_to_roi(volume, roi):
+    """
+    returns:
+        np.array - the ROI of `volume` in (x,y,z), a view without copy
+    """
+    assert all(
+        0 <= location and 0 < size and location + size <= n
+        for location, size, n in zip(roi["location"], roi["size"], volume.shape)
+    ), f"The ROI {roi} must lie within the image of shape {volume.shape}!"
+    return volume[roi_slices(roi)]
+
+
+def paste_roi(array, roi, *, shape):
+    """
+    Pastes the label map of the ROI into a full-size zero label map.
+    args:
+        array: np.array - label map of the ROI in (x,y,z)
+        roi: dict - the ROI the label map was predicted for
+        shape: tuple - shape of the full image in (x,y,z)
+    returns:
+        np.array - uint8 label map of `shape`
+    """
+    assert tuple(np.shape(array)) == tuple(
+        roi["size"]
+    ), f"The prediction must have the shape of the ROI {roi['size']}!"
+    label_map = np.zeros(shape, dtype=np.uint8)
+    label_map[roi_slices(roi)] = array
+    return label_map
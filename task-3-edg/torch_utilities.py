@@ -1,11 +1,12 @@
-import torch
-
 def _show_torch_cuda_info():
     """
     Function to show information about the availability of Torch CUDA.
     Might be useful for testing availability inside the docker container.
     Torch must be installed in the docker environment for this to work.
     """
+    # NOTE: torch is imported here and not at the top of this file,
+    # as importing torch takes seconds and only pays off if it is used
+    import torch
 
     print("=+=" * 10)
     print("Collecting Torch CUDA information")
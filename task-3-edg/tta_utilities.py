@@ -0,0 +1,357 @@
+"""
+Flip test-time augmentation (TTA): predict on flipped views of the image and merge.
+
+With the environment variable TOPCOW_TTA=<n> (2 to 8), inference.py runs your algorithm
+on up to n of the 8 flips of the image of your TRACK (the image itself first) and merges
+the predictions, mapped back to the image, by majority vote (the label of the
+most views, see MajorityVote). The flipped images are views, i.e. no copies, and the
+merge is streamed, so only the vote and the predictions of one batch are in memory.
+
+Early exit: once the first EARLY_EXIT_VIEWS predictions agree (on at least
+SEGMENTATION_AGREEMENT of the voxels any of them labels as vessel, or on all edges),
+further views hardly change the vote and are skipped.
+
+Your model can also use this directly, with a batched prediction of several views:
+
+    from tta_utilities import segmentation_tta
+
+    pred_array = segmentation_tta(
+        mr_input_array,
+        predict=lambda views: list(model_predict_batch(views)),  # one label map per view
+        batch_size=4,
+    )
+
+NOTE: the flipped views have negative strides, use np.ascontiguousarray(view) before
+torch.from_numpy (which also does the copy torch.flip would do).
+"""
+
+import os
+
+import numpy as np
+from memory_utilities import memory_budget_mb, peak_rss_mb
+
+TTA_ENV = "TOPCOW_TTA"
+
+# Flipped axes of (x,y,z): the image itself, then flips of one, two and all three axes
+FLIPS = ((), (0,), (1,), (2,), (0, 1), (0, 2), (1, 2), (0, 1, 2))
+
+# x runs from right to left in the TopCoW images, so a flip of x mirrors the head:
+# left vessels appear on the right, and their labels have to be swapped back
+LR_AXIS = 0
+# R-PCA/L-PCA, R-ICA/L-ICA, R-MCA/L-MCA, R-Pcom/L-Pcom, R-ACA/L-ACA
+LR_LABEL_PAIRS = ((2, 3), (4, 6), (5, 7), (8, 9), (11, 12))
+LR_EDGE_PAIRS = {
+    "anterior": (("L-A1", "R-A1"),),
+    "posterior": (("L-Pcom", "R-Pcom"), ("L-P1", "R-P1")),
+}
+
+# Majority vote of label maps: up to 8 views of labels up to 15, 4 bits per label
+_LABEL_BITS = 4
+_LABEL_MASK = np.uint32(2**_LABEL_BITS - 1)
+MAX_VOTE_LABEL = 2**_LABEL_BITS - 1
+MAX_VOTES = len(FLIPS)
+
+# Slices per slab of the vote, the memory of the temporaries is that of a few slabs
+CHUNK_SLICES = 16
+
+# Early exit after this many views if they agree well enough
+EARLY_EXIT_VIEWS = 3
+
+# Memory of a view in a batch: a float32 copy for the model and a uint8 prediction
+VIEW_BYTES_PER_VOXEL = 5
+SEGMENTATION_AGREEMENT = 0.95
+CLASSIFICATION_AGREEMENT = 1.0
+
+
+def tta_flips_from_env():
+    """
+    returns:
+        int - number of flips of TOPCOW_TTA, 0 if TTA is off
+    """
+    value = os.environ.get(TTA_ENV, "").strip().lower()
+    if value in ("", "0", "1", "false"):
+        return 0
+    n_flips = int(value)
+    if not 2 <= n_flips <= len(FLIPS):
+        raise ValueError(f"{TTA_ENV} must be between 2 and {len(FLIPS)}, got {value!r}")
+    return n_flips
+
+
+def flip(array, axes):
+    """
+    returns:
+        `array` flipped along `axes` as a view, `array` itself for no axes
+    """
+    if not axes:
+        return array
+    index = [slice(None)] * len(array.shape)
+    for axis in axes:
+        index[axis] = slice(None, None, -1)
+    return array[tuple(index)]
+
+
+def _lr_swap_table():
+    table = np.arange(256, dtype=np.uint8)
+    for a, b in LR_LABEL_PAIRS:
+        table[a], table[b] = b, a
+    return table
+
+
+_LR_SWAP_TABLE = _lr_swap_table()
+
+
+def unflip_label_map(label_map, axes):
+    """
+    Maps a label map predicted on a flipped view back to the image.
+    """
+    label_map = flip(np.asarray(label_map), axes)
+    if LR_AXIS in axes:
+        label_map = _LR_SWAP_TABLE[label_map]
+    return label_map
+
+
+def unflip_edges(edges, axes):
+    """
+    Maps an edge classification (see write_json_file of task 3) predicted
+    on a flipped view back to the image.
+    """
+    edges = {part: dict(values) for part, values in edges.items()}
+    if LR_AXIS in axes:
+        for part, pairs in LR_EDGE_PAIRS.items():
+            for left, right in pairs:
+                edges[part][left], edges[part][right] = (
+                    edges[part][right],
+                    edges[part][left],
+                )
+    return edges
+
+
+class MajorityVote:
+    """
+    Streaming plurality vote of up to 8 label maps with labels up to 15: at each voxel
+    the label predicted by the most views wins, ties go to the label that appeared
+    first, i.e. in the earliest view. The labels of all views are packed into 4 bits
+    each, so the vote needs 4 bytes per voxel, and counted only where the views disagree.
+
+    >>> vote = MajorityVote()
+    >>> for label in (1, 2, 3):
+    ...     vote.add(np.full((1, 1, 1), label, dtype=np.uint8))
+    >>> int(vote.result[0, 0, 0])
+    1
+    >>> vote = MajorityVote()
+    >>> for label in (0, 0, 0, 1, 1, 1, 2, 2):
+    ...     vote.add(np.full((1, 1, 1), label, dtype=np.uint8))
+    >>> int(vote.result[0, 0, 0])
+    0
+    """
+
+    def __init__(self):
+        self.packed = None
+        self.n_views = 0
+
+    def add(self, label_map):
+        label_map = np.asarray(label_map)
+        assert self.n_views < MAX_VOTES, f"At most {MAX_VOTES} views can be merged!"
+        assert (
+            label_map.size == 0 or int(label_map.max()) <= MAX_VOTE_LABEL
+        ), f"The vote only holds labels up to {MAX_VOTE_LABEL}!"
+        if self.packed is None:
+            self.packed = np.zeros_like(label_map, dtype=np.uint32)
+        shift = np.uint32(_LABEL_BITS * self.n_views)
+        # slab by slab along z, so the temporaries stay small
+        for z in range(0, label_map.shape[-1], CHUNK_SLICES):
+            packed = self.packed[..., z : z + CHUNK_SLICES]
+            packed |= label_map[..., z : z + CHUNK_SLICES].astype(np.uint32) << shift
+        self.n_views += 1
+
+    def _vote(self, packed):
+        winner = (packed & _LABEL_MASK).astype(np.uint8)
+        # the views agree where all labels equal that of the first view
+        repeat = np.uint32(sum(1 << (_LABEL_BITS * i) for i in range(self.n_views)))
+        disagree = packed != winner * repeat
+        if not disagree.any():
+            return winner
+        # only the voxels where the views disagree are unpacked and counted
+        packed = packed[disagree]
+        views = [
+            ((packed >> np.uint32(_LABEL_BITS * i)) & _LABEL_MASK).astype(np.uint8)
+            for i in range(self.n_views)
+        ]
+        best_label = views[0]
+        best_count = sum((view == best_label).view(np.uint8) for view in views)
+        for label in views[1:]:
+            count = sum((view == label).view(np.uint8) for view in views)
+            # strictly more votes, so ties keep the label of the earlier view
+            better = count > best_count
+            best_label = np.where(better, label, best_label)
+            best_count = np.where(better, count, best_count)
+        winner[disagree] = best_label
+        return winner
+
+    @property
+    def result(self):
+        result = np.empty_like(self.packed, dtype=np.uint8)
+        for z in range(0, self.packed.shape[-1], CHUNK_SLICES):
+            result[..., z : z + CHUNK_SLICES] = self._vote(
+                self.packed[..., z : z + CHUNK_SLICES]
+            )
+        return result
+
+
+def tta_batch_size(*, n_flips, n_voxels):
+    """
+    Views per call of your algorithm: all `n_flips` views, or in memory-budget mode
+    (TOPCOW_MEMORY_BUDGET_MB) as many as fit the budget left, at least one.
+    returns:
+        int - batch size
+    """
+    budget = memory_budget_mb()
+    if budget is None:
+        return n_flips
+    left = (budget - peak_rss_mb()) * 2**20
+    return int(min(n_flips, max(1, left // (n_voxels * VIEW_BYTES_PER_VOXEL))))
+
+
+def _batches(n_flips, batch_size, early_exit_views):
+    # a batch also ends after the first `early_exit_views` views, for the early exit
+    start = 0
+    while start < n_flips:
+        end = min(start + batch_size, n_flips)
+        if start < early_exit_views < end:
+            end = early_exit_views
+        yield FLIPS[start:end]
+        start = end
+
+
+def segmentation_tta(
+    volume,
+    *,
+    predict,
+    n_flips=len(FLIPS),
+    batch_size=1,
+    early_exit_views=EARLY_EXIT_VIEWS,
+    agreement=SEGMENTATION_AGREEMENT,
+):
+    """
+    Segments flipped views of a volume and merges the label maps by majority vote.
+    args:
+        volume: np.array - image in (x,y,z)
+        predict: callable(views) -> label maps
+            views: list of np.array - flipped views of `volume`, up to `batch_size`
+            label maps: list of np.array - label map in (x,y,z) of each view
+        n_flips: int - number of views, see FLIPS
+        batch_size: int - views per call of `predict`, see `tta_batch_size`; the first
+            `early_exit_views` views are one batch, so that the others can be skipped
+        early_exit_views: int - stop after this many views if they agree, 0 never stops early
+        agreement: float - fraction of the voxels labelled as vessel by any of the
+            first `early_exit_views` views that they all label the same
+    returns:
+        np.array - uint8 label map in (x,y,z)
+    """
+    vote = MajorityVote()
+    first = agree = vessel = None
+    n_views = 0
+    for axes_batch in _batches(n_flips, batch_size, early_exit_views):
+        label_maps = predict([flip(volume, axes) for axes in axes_batch])
+        assert len(label_maps) == len(axes_batch), "Need one label map per view!"
+        for axes, label_map in zip(axes_batch, label_maps):
+            label_map = unflip_label_map(label_map, axes)
+            vote.add(label_map)
+            n_views += 1
+            if n_views <= early_exit_views:
+                if first is None:
+                    first = label_map
+                    agree = np.ones(label_map.shape, dtype=bool)
+                    vessel = first != 0
+                else:
+                    agree &= label_map == first
+                    vessel |= label_map != 0
+            del label_map
+        del label_maps
+
+        if first is not None and n_views >= early_exit_views and n_views < n_flips:
+            n_vessel = np.count_nonzero(vessel)
+            fraction = np.count_nonzero(agree & vessel) / n_vessel if n_vessel else 1.0
+            first = agree = vessel = None
+            if fraction >= agreement:
+                print(
+                    f"TTA: the first {n_views} views agree on {fraction:.1%} of the "
+                    f"vessel voxels, skipping the other {n_flips - n_views}"
+                )
+                break
+    else:
+        print(f"TTA: merged {n_views} views")
+    return vote.result
+
+
+def classification_tta(
+    volume,
+    *,
+    predict,
+    n_flips=len(FLIPS),
+    batch_size=1,
+    early_exit_views=EARLY_EXIT_VIEWS,
+    agreement=CLASSIFICATION_AGREEMENT,
+):
+    """
+    Classifies the edges of flipped views of a volume and merges them by majority vote,
+    ties go to the image itself.
+    args:
+        volume: np.array - image in (x,y,z)
+        predict: callable(views) -> edge classifications
+            views: list of np.array - flipped views of `volume`, up to `batch_size`
+            edge classifications: list of dict - in the form of write_json_file
+        n_flips: int - number of views, see FLIPS
+        batch_size: int - views per call of `predict`, see `tta_batch_size`; the first
+            `early_exit_views` views are one batch, so that the others can be skipped
+        early_exit_views: int - stop after this many views if they agree, 0 never stops early
+        agreement: float - fraction of the edges the first `early_exit_views` views
+            must all classify the same
+    returns:
+        dict - edge classification in the form of write_json_file
+    """
+    votes = None
+    first = None
+    agree = None
+    n_views = 0
+    for axes_batch in _batches(n_flips, batch_size, early_exit_views):
+        predictions = predict([flip(volume, axes) for axes in axes_batch])
+        assert len(predictions) == len(axes_batch), "Need one prediction per view!"
+        for axes, edges in zip(axes_batch, predictions):
+            edges = unflip_edges(edges, axes)
+            if votes is None:
+                first = edges
+                votes = {
+                    part: dict.fromkeys(values, 0) for part, values in edges.items()
+                }
+                agree = {(part, edge): True for part in edges for edge in edges[part]}
+            for part, values in edges.items():
+                for edge, value in values.items():
+                    votes[part][edge] += int(value)
+                    if n_views < early_exit_views:
+                        agree[part, edge] &= value == first[part][edge]
+            n_views += 1
+
+        if n_views >= early_exit_views and n_views < n_flips and agree is not None:
+            fraction = sum(agree.values()) / len(agree)
+            agree = None
+            if fraction >= agreement:
+                print(
+                    f"TTA: the first {n_views} views agree on {fraction:.0%} of the "
+                    f"edges, skipping the other {n_flips - n_views}"
+                )
+                break
+    else:
+        print(f"TTA: merged {n_views} views")
+
+    return {
+        part: {
+            edge: (
+                int(2 * count > n_views)
+                if 2 * count != n_views
+                else int(first[part][edge])
+            )
+            for edge, count in values.items()
+        }
+        for part, values in votes.items()
+    }
@@ -0,0 +1,129 @@
+"""
+Store for model weights in the resources folder that is memory-mapped instead of unpickled.
+
+`torch.load` (or pickle) reads the whole checkpoint and copies every tensor into
+freshly allocated memory. Here the weights are saved once as uncompressed, page-aligned
+arrays in a single weights.bin next to an index.json with their names, dtypes and shapes:
+
+    # once, outside of the container
+    save_weights(model.state_dict(), "resources/weights")
+
+    # in load_your_model()
+    weights = load_weights(resources / "weights")
+    model.load_state_dict(as_torch_state_dict(weights), assign=True)
+
+Loading maps weights.bin into memory and gives numpy views on it, so loading takes
+milliseconds, pages are only read from disk when they are first used, and processes
+(e.g. workers) that load the same weights share their memory through the page cache.
+NOTE: the mapping is copy-on-write, a weight that is written to gets a private copy
+and the file is never changed.
+NOTE: without assign=True (torch >= 2.1), load_state_dict copies the weights into
+the parameters of the model, which reads all of them and does not share memory.
+"""
+
+import functools
+import json
+import mmap
+from pathlib import Path
+
+import numpy as np
+
+INDEX_FILENAME = "index.json"
+DATA_FILENAME = "weights.bin"
+
+# Each array starts at a page boundary, so pages are never shared between arrays
+ALIGNMENT = 4096
+
+
+def _to_numpy(value):
+    # torch tensors (also on the GPU) and anything np.asarray understands
+    if hasattr(value, "detach"):
+        value = value.detach().cpu().numpy()
+    # NOTE: not np.ascontiguousarray, that makes 0-d arrays (e.g. num_batches_tracked) 1-d
+    return np.asarray(value, order="C")
+
+
+def save_weights(weights, path):
+    """
+    Saves model weights as uncompressed aligned arrays.
+    args:
+        weights: dict - name to array, e.g. model.state_dict()
+        path: Path - folder to save weights.bin and index.json in
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    index = {}
+    offset = 0
+    with open(path / DATA_FILENAME, "wb") as f:
+        for name, value in weights.items():
+            array = _to_numpy(value)
+            padding = -offset % ALIGNMENT
+            f.write(bytes(padding))
+            offset += padding
+            index[name] = {
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+                "offset": offset,
+            }
+            f.write(array.tobytes())
+            offset += array.nbytes
+    # written last, so a store without index.json is recognized as incomplete
+    with open(path / INDEX_FILENAME, "w") as f:
+        f.write(json.dumps(index, indent=4))
+
+
+def load_weights(path, *, warm=False):
+    """
+    Memory-maps weights saved with `save_weights`.
+    Cached: loading the same unchanged store again in this process gives the same arrays,
+    e.g. for many cases in the batch mode.
+    args:
+        path: Path - folder with weights.bin and index.json
+        warm: bool - ask the OS to read all weights into the page cache in the background,
+            e.g. right at start-up, long before the model is used
+    returns:
+        dict - name to np.array, views on the mapped file in the order they were saved
+    """
+    path = Path(path).resolve()
+    index_location = path / INDEX_FILENAME
+    weights, mapped = _load_weights(str(path), index_location.stat().st_mtime_ns)
+    if warm and mapped is not None and hasattr(mmap, "MADV_WILLNEED"):
+        mapped.madvise(mmap.MADV_WILLNEED)
+    return weights
+
+
+@functools.lru_cache(maxsize=8)
+def _load_weights(path, mtime_ns):
+    path = Path(path)
+    with open(path / INDEX_FILENAME) as f:
+        index = json.load(f)
+    with open(path / DATA_FILENAME, "rb") as f:
+        if f.seek(0, 2) == 0:
+            # mmap can not map empty files, e.g. if all weights are empty
+            mapped = None
+        else:
+            # NOTE: the mapping stays valid after the file is closed
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    weights = {}
+    for name, entry in index.items():
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"]))
+        if count == 0 or mapped is None:
+            weights[name] = np.empty(entry["shape"], dtype=dtype)
+            continue
+        weights[name] = np.frombuffer(
+            mapped, dtype=dtype, count=count, offset=entry["offset"]
+        ).reshape(entry["shape"])
+    return weights, mapped
+
+
+def as_torch_state_dict(weights):
+    """
+    returns:
+        dict - name to torch.Tensor sharing the memory of the arrays, for model.load_state_dict
+    """
+    # NOTE: imported here, so the weight store can be used without torch
+    import torch
+
+    return {name: torch.from_numpy(array) for name, array in weights.items()}
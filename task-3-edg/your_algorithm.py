@@ -35,7 +35,82 @@ This will start the inference and reads from ./test/input and outputs to ./test/
 To save the container and prep it for upload to Grand-Challenge.org you can call:
   ./save.sh
 """
+import functools
+
 import numpy as np
+from roi_utilities import find_roi
+
+#######################################################################################
+# TODO-1:
+# Choose your TRACK. Track is either 'MR' or 'CT'.
+TRACK = "MR"  # or 'CT'
+
+# Version of your model, part of the key of the result cache (TOPCOW_RESULT_CACHE)
+# NOTE: change it when your model weights change, see result_cache_utilities.py
+MODEL_VERSION = "1"
+
+# With TOPCOW_TTA, your algorithm gets the flipped views of the image of your TRACK
+# as a list in one call (e.g. for one batched model call) and returns a list with
+# one prediction per view, see tta_utilities.py
+# NOTE: set it to False if your algorithm only takes one image, it is then called
+#       once per view
+TTA_BATCHED = True
+# END OF TODO-1
+#######################################################################################
+
+
+@functools.cache
+def load_your_model():
+    """
+    Load and initialize your model here.
+    It is cached, so the model is only loaded once per process,
+    e.g. when many cases are run with `python inference.py --batch <cases_dir>`.
+    returns:
+        your model (None for this dummy algorithm)
+    """
+
+    # NOTE: import heavy libraries like torch here (or in your algorithm) and not at
+    #       the top of this file, so they are only imported when they are needed
+    # import torch
+
+    # model = ...
+    # device = ...
+
+    # You can also place and load additional files in the resources folder
+    # with open(resources / "some_resource.txt", "r") as f:
+    #     print(f.read())
+
+    # Model weights saved with `weight_store_utilities.save_weights` are memory-mapped,
+    # which is much faster and leaner than torch.load of a checkpoint
+    # from weight_store_utilities import load_weights, as_torch_state_dict
+    # weights = load_weights(resources / "weights")
+    # model.load_state_dict(as_torch_state_dict(weights), assign=True)
+
+    return None
+
+
+def your_roi_algorithm(*, mr_input_array: np.array, ct_input_array: np.array) -> dict:
+    """
+    Region of interest (ROI) for the ROI cascade, only used with TOPCOW_ROI_CASCADE=1.
+    `your_classification_algorithm` then only gets this crop of the image of your TRACK,
+    see roi_utilities.py.
+    By default a cheap heuristic, a box of fixed size around the bright vessels.
+    You can also use your own detector here, e.g. your task 2 model.
+    args:
+        mr_input_array: np.array - input image for MR track
+        ct_input_array: np.array - input image for CT track
+    returns:
+        dict - bounding box in the form {"size": [x, y, z], "location": [x, y, z]}
+    """
+    if TRACK == "CT":
+        input_array = ct_input_array
+    elif TRACK == "MR":
+        input_array = mr_input_array
+    else:
+        raise ValueError("Invalid TRACK chosen. Choose either 'MR' or 'CT'.")
+
+    # NOTE: the inputs are lazy handles of the images, their geometry is in `.information`
+    return find_roi(input_array, spacing=input_array.information.spacing, modality=TRACK)
 
 
 def your_classification_algorithm(*, mr_input_array: np.array, ct_input_array: np.array) -> dict:
@@ -45,13 +120,14 @@ def your_classification_algorithm(*, mr_input_array: np.array, ct_input_array: n
     args:
         mr_input_array: np.array - input image for MR track
         ct_input_array: np.array - input image for CT track
+    NOTE: the inputs are decoded lazily, only the one of your TRACK is read
     returns:
         dict - CoW edge classification in the form { "anterior": { "L-A1": 1/0, "Acom": 1/0, "3rd-A2": 1/0, "R-A1": 1/0 }, 
                "posterior": { "L-Pcom": 1/0, "L-P1": 1/0, "R-P1": 1/0, "R-Pcom": 1/0 } }
     """
 
     #######################################################################################
-    # TODO: place your own prediction algorithm here.
+    # TODO-2: place your own prediction algorithm here.
     # You are free to remove everything! Just return to us a dictionary containing 
     # the CoW edge classification prediction in the form { "anterior": { "L-A1": 1/0, "Acom": 1/0, "3rd-A2": 1/0, "R-A1": 1/0 }, 
     # "posterior": { "L-Pcom": 1/0, "L-P1": 1/0, "R-P1": 1/0, "R-Pcom": 1/0 } }.
@@ -62,15 +138,22 @@ def your_classification_algorithm(*, mr_input_array: np.array, ct_input_array: n
     #              SimpleITK npy array axis order is (z,y,x).
     #              Then you might have to transpose this to (x,y,z)
 
-    #######################################################################################
+    # NOTE: normalize_intensities() in normalization_utilities.py clips and z-scores
+    #       the image of your TRACK (HU window for CT, percentiles for MR) into one
+    #       float32 array, with the statistics from a histogram instead of sorting.
 
-    # load and initialize your model here
-    # model = ...
-    # device = ...
+    # NOTE: If your model segments the CoW vessels (like in task 1), classify_edges()
+    #       in adjacency_utilities.py derives the edges from the label map,
+    #       i.e. from which vessels are present and which of them touch.
 
-    # You can also place and load additional files in the resources folder
-    # with open(resources / "some_resource.txt", "r") as f:
-    #     print(f.read())
+    # NOTE: TOPCOW_TTA=<n> runs this function on up to n flipped views of the image,
+    #       see tta_utilities.py. With TTA_BATCHED, the input of your TRACK is then
+    #       a list of views and you return a list of classifications, one per view.
+
+    #######################################################################################
+
+    # load and initialize your model in load_your_model()
+    model = load_your_model()
 
     # For now, let us set make bogus predictions
     pred_dict = {
@@ -82,4 +165,9 @@ def your_classification_algorithm(*, mr_input_array: np.array, ct_input_array: n
         }
     }
 
+    # With TOPCOW_TTA and TTA_BATCHED, one prediction per flipped view
+    track_input = mr_input_array if TRACK == "MR" else ct_input_array
+    if isinstance(track_input, list):
+        return [pred_dict for _ in track_input]
+
     return pred_dict
\ No newline at end of file